@@ -1,14 +1,32 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
 from django.contrib.auth.admin import UserAdmin
 from django.utils.html import format_html
 from django.urls import path
 from django.shortcuts import render, redirect
 from django.contrib import messages
-from django.db.models import Count, Q
-from django.http import HttpResponse
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.core.exceptions import PermissionDenied
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 import csv
-from datetime import datetime
-from .models import CustomUser, Category, Product, Cart, CartItem, Order, OrderItem
+from datetime import datetime, time, timedelta
+from .models import CustomUser, Category, Product, Cart, CartItem, Order, OrderItem, StockMovement
+from .forms import OrderExportForm, ProductAdminForm
+from . import inventory, search
+from .cart import PRICE_FIELD
+from .order_workflow import apply_transition
+from .signals import products_updated
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+class Echo:
+    """Псевдо-буфер для csv.writer: возвращает строку вместо записи в память"""
+    def write(self, value):
+        return value
+
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -18,25 +36,72 @@ class CategoryAdmin(admin.ModelAdmin):
     list_editable = ['is_active']
     prepopulated_fields = {'slug': ('name',)}
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(products_total=Count('product'))
+    
     def products_count(self, obj):
-        return obj.product_set.count()
+        return obj.products_total
     products_count.short_description = 'Количество товаров'
+    products_count.admin_order_field = 'products_total'
+
+class ProductChangeList(ChangeList):
+    def get_ordering(self, request, queryset):
+        # Результаты поиска без выбранной сортировки по столбцу идут по релевантности
+        if 'search_rank' in queryset.query.extra_select and ORDER_VAR not in self.params:
+            return list(queryset.query.order_by)
+        return super().get_ordering(request, queryset)
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
+    form = ProductAdminForm
     list_display = ['name', 'price', 'category', 'stock_quantity', 'in_stock', 'is_published', 'created_at']
     list_filter = ['category', 'in_stock', 'is_published', 'created_at']
-    search_fields = ['name', 'description', 'model']
+    search_fields = ['=sku', 'name', 'description', 'model']
     list_editable = ['price', 'stock_quantity', 'is_published']
     actions = ['publish_products', 'unpublish_products']
     
+    def get_queryset(self, request):
+        # Остаток для формы считается в том же запросе
+        return inventory.with_available(super().get_queryset(request))
+    
+    def get_search_results(self, request, queryset, search_term):
+        # Полнотекстовый индекс вместо icontains по четырем полям; артикул тоже в индексе
+        if not search_term.strip() or not search.is_enabled():
+            return super().get_search_results(request, queryset, search_term)
+        return search.ranked_queryset(queryset, search_term), False
+    
+    def get_changelist(self, request, **kwargs):
+        return ProductChangeList
+    
+    def get_changelist_form(self, request, **kwargs):
+        # Редактирование в списке тоже показывает остаток по журналу и сохраняет корректировку
+        kwargs.setdefault('form', ProductAdminForm)
+        return super().get_changelist_form(request, **kwargs)
+    
+    def response_action(self, request, queryset):
+        # Действия выполняют UPDATE и DELETE, которые не видят присоединенную таблицу поиска
+        return super().response_action(request, Product.objects.filter(pk__in=queryset.values('pk')))
+    
+    def save_model(self, request, obj, form, change):
+        if not change:
+            super().save_model(request, obj, form, change)
+            return
+        # Снимок не перезаписывается: изменение остатка идет через журнал
+        target = obj.stock_quantity
+        obj.stock_quantity = form.stock_snapshot
+        super().save_model(request, obj, form, change)
+        if 'stock_quantity' in form.changed_data:
+            inventory.stock_take({obj.pk: target}, comment=f'Изменено в админке: {request.user.username}')
+    
     def publish_products(self, request, queryset):
         updated = queryset.update(is_published=True)
+        products_updated.send(sender=Product)
         self.message_user(request, f'{updated} товаров опубликовано')
     publish_products.short_description = 'Опубликовать выбранные товары'
     
     def unpublish_products(self, request, queryset):
         updated = queryset.update(is_published=False)
+        products_updated.send(sender=Product)
         self.message_user(request, f'{updated} товаров снято с публикации')
     unpublish_products.short_description = 'Снять с публикации выбранные товары'
 
@@ -64,6 +129,9 @@ class OrderItemInline(admin.TabularInline):
     def has_add_permission(self, request, obj=None):
         return False
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+    
     def get_total(self, obj):
         return f"{obj.quantity * obj.price} ₽"
     get_total.short_description = 'Сумма'
@@ -118,7 +186,7 @@ class OrderAdmin(admin.ModelAdmin):
     )
     
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('user').prefetch_related('orderitem_set')
+        return super().get_queryset(request).select_related('user').annotate(items_total=Count('orderitem'))
     
     def user_full_name(self, obj):
         return obj.get_user_full_name()
@@ -126,12 +194,12 @@ class OrderAdmin(admin.ModelAdmin):
     user_full_name.admin_order_field = 'user__last_name'
     
     def items_count(self, obj):
-        count = obj.get_items_count()
         return format_html(
             '<span style="font-weight: bold; color: #E91E63;">{}</span>',
-            f"{count} шт."
+            f"{obj.items_total} шт."
         )
     items_count.short_description = 'Товаров'
+    items_count.admin_order_field = 'items_total'
     
     def status_badge(self, obj):
         status_config = {
@@ -197,7 +265,7 @@ class OrderAdmin(admin.ModelAdmin):
     user_info.short_description = 'Информация о пользователе'
     
     def order_details(self, obj):
-        items = obj.orderitem_set.all()
+        items = obj.orderitem_set.select_related('product')
         if items:
             items_html = "<br>".join([
                 f"<div style='margin: 5px 0; padding: 5px; background: #f8f9fa; border-radius: 3px;'>"
@@ -218,10 +286,8 @@ class OrderAdmin(admin.ModelAdmin):
     
     # Кастомные действия
     def confirm_selected_orders(self, request, queryset):
-        orders = queryset.filter(status='pending')
-        count = orders.count()
+        count = apply_transition(queryset, 'confirm')
         if count:
-            orders.update(status='processing')
             self.message_user(
                 request, 
                 f'✅ {count} заказ(ов) подтверждено и переведено в статус "Подтвержден"', 
@@ -236,10 +302,8 @@ class OrderAdmin(admin.ModelAdmin):
     confirm_selected_orders.short_description = '✅ Подтвердить выбранные заказы'
     
     def complete_selected_orders(self, request, queryset):
-        orders = queryset.filter(status='processing')
-        count = orders.count()
+        count = apply_transition(queryset, 'complete')
         if count:
-            orders.update(status='completed')
             self.message_user(
                 request, 
                 f'🏁 {count} заказ(ов) завершено', 
@@ -260,14 +324,8 @@ class OrderAdmin(admin.ModelAdmin):
                 self.message_user(request, '❌ Необходимо указать причину отказа', messages.ERROR)
                 return
             
-            orders = queryset.filter(status='pending')
-            count = orders.count()
+            count = apply_transition(queryset, 'cancel', reason=reason)
             if count:
-                for order in orders:
-                    order.status = 'cancelled'
-                    order.cancellation_reason = reason
-                    order.save()
-                
                 self.message_user(
                     request, 
                     f'❌ {count} заказ(ов) отменено с причиной: {reason}', 
@@ -289,30 +347,71 @@ class OrderAdmin(admin.ModelAdmin):
     cancel_selected_orders.short_description = '❌ Отменить выбранные заказы'
     
     def export_orders_csv(self, request, queryset):
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename="orders_{datetime.now().strftime("%Y%m%d_%H%M")}.csv"'
+        return self.stream_orders_csv(queryset)
+    export_orders_csv.short_description = '📊 Экспорт в CSV'
+    
+    def stream_orders_csv(self, queryset):
+        """
+        Отдает CSV потоково: заказы читаются пачками через iterator(),
+        количество товаров считается в том же запросе, пользователь - через JOIN.
+        """
+        orders = (
+            queryset
+            .select_related('user')
+            .prefetch_related(None)
+            .annotate(export_items_count=Count('orderitem'))
+            .order_by('created_at', 'id')
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        )
+        writer = csv.writer(Echo())
         
-        writer = csv.writer(response)
-        writer.writerow(['ID', 'Дата заказа', 'ФИО заказчика', 'Email', 'Товаров', 'Сумма', 'Статус'])
-        
-        for order in queryset:
-            writer.writerow([
-                order.id,
-                order.created_at.strftime("%d.%m.%Y %H:%M"),
-                order.get_user_full_name(),
-                order.user.email,
-                order.get_items_count(),
-                order.total_price,
-                order.get_status_display()
-            ])
+        def rows():
+            yield writer.writerow(['ID', 'Дата заказа', 'ФИО заказчика', 'Email', 'Товаров', 'Сумма', 'Статус'])
+            for order in orders:
+                yield writer.writerow([
+                    order.id,
+                    timezone.localtime(order.created_at).strftime("%d.%m.%Y %H:%M"),
+                    order.get_user_full_name(),
+                    order.user.email,
+                    order.export_items_count,
+                    order.total_price,
+                    order.get_status_display()
+                ])
         
+        response = StreamingHttpResponse(rows(), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="orders_{datetime.now().strftime("%Y%m%d_%H%M")}.csv"'
         return response
-    export_orders_csv.short_description = '📊 Экспорт в CSV'
+    
+    def export_orders_view(self, request):
+        """Выгрузка всех заказов за период, без выбора на странице списка"""
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        
+        if 'export' in request.GET:
+            form = OrderExportForm(request.GET)
+            if form.is_valid():
+                date_from = form.cleaned_data['date_from']
+                date_to = form.cleaned_data['date_to']
+                start = timezone.make_aware(datetime.combine(date_from, time.min))
+                end = timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time.min))
+                return self.stream_orders_csv(
+                    Order.objects.filter(created_at__gte=start, created_at__lt=end)
+                )
+        else:
+            today = timezone.localdate()
+            form = OrderExportForm(initial={'date_from': today.replace(month=1, day=1), 'date_to': today})
+        
+        return render(request, 'admin/export_orders.html', {
+            **self.admin_site.each_context(request),
+            'form': form,
+            'title': 'Экспорт заказов за период',
+        })
     
     # Кастомные URL для быстрых действий
     def get_urls(self):
         urls = super().get_urls()
         custom_urls = [
+            path('export/', self.admin_site.admin_view(self.export_orders_view), name='order_export'),
             path('<path:object_id>/confirm/', self.admin_site.admin_view(self.confirm_order), name='order_confirm'),
             path('<path:object_id>/complete/', self.admin_site.admin_view(self.complete_order), name='order_complete'),
             path('<path:object_id>/cancel/', self.admin_site.admin_view(self.cancel_order), name='order_cancel'),
@@ -320,29 +419,19 @@ class OrderAdmin(admin.ModelAdmin):
         return custom_urls + urls
     
     def confirm_order(self, request, object_id):
-        order = Order.objects.get(id=object_id)
-        if order.status == 'pending':
-            order.status = 'processing'
-            order.save()
-            self.message_user(request, f'✅ Заказ #{order.id} подтвержден', messages.SUCCESS)
-        return redirect('admin:shop_order_changelist')
+        if apply_transition(Order.objects.filter(id=object_id), 'confirm'):
+            self.message_user(request, f'✅ Заказ #{object_id} подтвержден', messages.SUCCESS)
+        return redirect('admin:main_order_changelist')
     
     def complete_order(self, request, object_id):
-        order = Order.objects.get(id=object_id)
-        if order.status == 'processing':
-            order.status = 'completed'
-            order.save()
-            self.message_user(request, f'🏁 Заказ #{order.id} завершен', messages.SUCCESS)
-        return redirect('admin:shop_order_changelist')
+        if apply_transition(Order.objects.filter(id=object_id), 'complete'):
+            self.message_user(request, f'🏁 Заказ #{object_id} завершен', messages.SUCCESS)
+        return redirect('admin:main_order_changelist')
     
     def cancel_order(self, request, object_id):
-        order = Order.objects.get(id=object_id)
-        if order.status == 'pending':
-            order.status = 'cancelled'
-            order.cancellation_reason = 'Отменен администратором'
-            order.save()
-            self.message_user(request, f'❌ Заказ #{order.id} отменен', messages.SUCCESS)
-        return redirect('admin:shop_order_changelist')
+        if apply_transition(Order.objects.filter(id=object_id), 'cancel', reason='Отменен администратором'):
+            self.message_user(request, f'❌ Заказ #{object_id} отменен', messages.SUCCESS)
+        return redirect('admin:main_order_changelist')
     
     class Media:
         css = {
@@ -364,19 +453,48 @@ class CartAdmin(admin.ModelAdmin):
     list_display = ['user', 'created_at', 'updated_at', 'get_total_quantity', 'get_total_price']
     search_fields = ['user__username']
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user').annotate(
+            total_quantity=Coalesce(Sum('items__quantity'), 0),
+            total_price=Coalesce(
+                Sum(F('items__quantity') * F('items__product__price'), output_field=PRICE_FIELD),
+                Value(0, output_field=PRICE_FIELD),
+            ),
+        )
+    
     def get_total_quantity(self, obj):
-        return obj.get_total_quantity()
+        return obj.total_quantity
     get_total_quantity.short_description = 'Общее количество'
+    get_total_quantity.admin_order_field = 'total_quantity'
     
     def get_total_price(self, obj):
-        return f"{obj.get_total_price()} ₽"
+        return f"{obj.total_price:.2f} ₽"
     get_total_price.short_description = 'Общая стоимость'
+    get_total_price.admin_order_field = 'total_price'
 
 @admin.register(CartItem)
 class CartItemAdmin(admin.ModelAdmin):
-    list_display = ['cart', 'product', 'quantity', 'get_total_price']
+    list_display = ['cart', 'product', 'quantity', 'reserved_until', 'get_total_price']
     search_fields = ['product__name', 'cart__user__username']
     
     def get_total_price(self, obj):
         return f"{obj.get_total_price()} ₽"
-    get_total_price.short_description = 'Общая стоимость'
\ No newline at end of file
+    get_total_price.short_description = 'Общая стоимость'
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ['created_at', 'product', 'kind', 'quantity', 'order', 'applied', 'comment']
+    list_filter = ['kind', 'applied', 'created_at']
+    search_fields = ['=product__sku', 'product__name', '=order__id']
+    list_select_related = ['product', 'order__user']
+    raw_id_fields = ['product', 'order']
+    
+    # Журнал только для чтения: остаток меняется через товары и заказы
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,84 @@
+"""
+Общие функции нагрузочных замеров: перцентили, сводка по URL и сравнение
+двух прогонов.
+"""
+import math
+import re
+from collections import defaultdict
+
+SERVER_TIMING_ITEM = re.compile(r'(?P<name>[\w-]+)(?:;dur=(?P<dur>[\d.]+))?(?:;desc="(?P<desc>[^"]*)")?')
+
+
+def percentile(values, p):
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def server_timing(header):
+    """Разбирает заголовок Server-Timing: {имя: (длительность в мс, описание)}"""
+    result = {}
+    for item in (header or '').split(','):
+        match = SERVER_TIMING_ITEM.match(item.strip())
+        if match:
+            dur = match.group('dur')
+            result[match.group('name')] = (float(dur) if dur else None, match.group('desc'))
+    return result
+
+
+def server_timing_queries(header):
+    """Количество SQL-запросов из заголовка Server-Timing, который добавляет PerformanceMiddleware"""
+    dur, desc = server_timing(header).get('sql', (None, None))
+    match = re.match(r'(\d+) queries', desc or '')
+    return int(match.group(1)) if match else None
+
+
+def summarize(samples, wall_time):
+    """
+    Сводка по именам URL.
+
+    samples - список словарей с ключами url_name, time_ms, status, queries
+    (queries может быть None, если количество запросов неизвестно).
+    """
+    groups = defaultdict(list)
+    for sample in samples:
+        groups[sample['url_name']].append(sample)
+
+    summary = {}
+    for url_name, group in sorted(groups.items()):
+        times = [sample['time_ms'] for sample in group]
+        queries = [sample['queries'] for sample in group if sample['queries'] is not None]
+        errors = sum(1 for sample in group if sample['status'] is None or sample['status'] >= 400)
+        summary[url_name] = {
+            'requests': len(group),
+            'rps': round(len(group) / wall_time, 2) if wall_time else None,
+            'p50_ms': round(percentile(times, 50), 2),
+            'p95_ms': round(percentile(times, 95), 2),
+            'p99_ms': round(percentile(times, 99), 2),
+            'queries': round(sum(queries) / len(queries), 2) if queries else None,
+            'error_rate': round(errors / len(group), 4),
+        }
+    return summary
+
+
+def compare(baseline, current):
+    """Изменение метрик текущего прогона относительно базового, в процентах"""
+    result = {}
+    for url_name in sorted(set(baseline) | set(current)):
+        before, after = baseline.get(url_name), current.get(url_name)
+        if before is None or after is None:
+            result[url_name] = None
+            continue
+        result[url_name] = {}
+        for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries', 'error_rate'):
+            old, new = before.get(key), after.get(key)
+            if old is None or new is None:
+                result[url_name][key] = None
+            elif old == 0:
+                result[url_name][key] = 0.0 if new == 0 else math.inf
+            else:
+                result[url_name][key] = round((new - old) / old * 100, 1)
+    return result
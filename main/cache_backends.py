@@ -0,0 +1,24 @@
+"""
+Файловый кеш, общий для всех процессов сервера.
+
+FileBasedCache из Django перед каждой записью перечисляет весь каталог
+кеша, чтобы решить, не пора ли удалять старые записи. На десятках тысяч
+карточек товаров запись одной страницы каталога занимает сотни
+миллисекунд, поэтому здесь каталог проверяется раз в CULL_EVERY записей.
+"""
+import itertools
+
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+class SharedFileCache(FileBasedCache):
+    CULL_EVERY = 500
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        self._writes = itertools.count()
+
+    def _cull(self):
+        # Между проверками кеш может превысить MAX_ENTRIES не больше чем на CULL_EVERY записей
+        if next(self._writes) % self.CULL_EVERY == 0:
+            super()._cull()
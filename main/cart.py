@@ -0,0 +1,372 @@
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import DateTimeField, DecimalField, Exists, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .guest_cart import get_guest_cart
+from .inventory import attach_available, reserve_until, with_available
+from .models import Cart, CartItem, Product, StockMovement
+
+PRICE_FIELD = DecimalField(max_digits=12, decimal_places=2)
+
+
+class CartSummary:
+    """
+    Итоги корзины пользователя, вычисляемые не более одного раза за запрос.
+
+    Для шапки сайта достаточно одного агрегирующего запроса, для страницы
+    корзины - одного запроса элементов вместе с товарами. Для гостя
+    элементы строятся по cookie без сохранения в базу.
+    """
+
+    def __init__(self, user, guest=None):
+        self.user = user
+        self.guest = guest
+
+    def _items_queryset(self):
+        return CartItem.objects.filter(cart__user=self.user)
+
+    def _guest_items(self):
+        if not self.guest:
+            return []
+        products = (
+            with_available(Product.objects.filter(id__in=self.guest.items))
+            .select_related('category')
+            .in_bulk()
+        )
+        return [
+            CartItem(product=products[product_id], quantity=quantity)
+            for product_id, quantity in self.guest.items.items()
+            if product_id in products
+        ]
+
+    @cached_property
+    def items(self):
+        if not self.user.is_authenticated:
+            return self._guest_items()
+        items = list(
+            self._items_queryset()
+            .select_related('product__category')
+            .order_by('id')
+        )
+        attach_available([item.product for item in items])
+        return items
+
+    @cached_property
+    def totals(self):
+        if not self.user.is_authenticated and not self.guest:
+            return {'total_quantity': 0, 'total_price': Decimal('0.00')}
+        if 'items' in self.__dict__ or not self.user.is_authenticated:
+            # Элементы уже загружены - считаем итоги без обращения к базе
+            return {
+                'total_quantity': sum(item.quantity for item in self.items),
+                'total_price': sum((item.get_total_price() for item in self.items), Decimal('0.00')),
+            }
+        totals = self._items_queryset().aggregate(
+            total_quantity=Coalesce(Sum('quantity'), 0),
+            total_price=Coalesce(
+                Sum(F('quantity') * F('product__price'), output_field=PRICE_FIELD),
+                Value(0, output_field=PRICE_FIELD),
+            ),
+        )
+        totals['total_price'] = Decimal(totals['total_price']).quantize(Decimal('0.01'))
+        return totals
+
+    @property
+    def total_quantity(self):
+        if self.guest is not None and 'totals' not in self.__dict__:
+            # Шапке сайта хватает количества из cookie
+            return self.guest.total_quantity
+        return self.totals['total_quantity']
+
+    @property
+    def total_price(self):
+        return self.totals['total_price']
+
+    @property
+    def has_shortage(self):
+        return any(item.exceeds_stock() for item in self.items)
+
+
+def get_cart_summary(request):
+    if not hasattr(request, '_cart_summary'):
+        guest = None if request.user.is_authenticated else get_guest_cart(request)
+        request._cart_summary = CartSummary(request.user, guest)
+    return request._cart_summary
+
+
+# Изменения корзины одним SQL-запросом. Проверка остатка идет в том же
+# операторе, что и запись, поэтому клик по кнопке корзины стоит одного
+# запроса плюс запрос нового итога корзины.
+
+def _tables():
+    quote = connection.ops.quote_name
+    return {
+        'cart': quote(Cart._meta.db_table),
+        'item': quote(CartItem._meta.db_table),
+        'product': quote(Product._meta.db_table),
+        'movement': quote(StockMovement._meta.db_table),
+    }
+
+
+# Сколько единиц товара может быть в корзине cart: остаток на складе
+# минус активные резервы остальных корзин
+_LIMIT_SQL = """(
+    {stock}
+    + COALESCE((SELECT SUM(m.quantity) FROM {movement} m
+                WHERE m.product_id = %(product)s AND NOT m.applied), 0)
+    - COALESCE((SELECT SUM(h.quantity) FROM {item} h
+                WHERE h.product_id = %(product)s AND h.reserved_until > %(now)s
+                  AND h.cart_id <> {cart_id}), 0)
+)"""
+
+_ADD_SQL = """
+INSERT INTO {item} (cart_id, product_id, quantity, reserved_until)
+SELECT c.id, p.id, 1, %(until)s
+FROM {cart} c, {product} p
+WHERE c.user_id = %(user)s AND p.id = %(product)s AND p.in_stock
+  AND 1 <= {insert_limit}
+ON CONFLICT (cart_id, product_id) DO UPDATE
+SET quantity = {item}.quantity + 1, reserved_until = excluded.reserved_until
+WHERE {item}.quantity + 1 <= {update_limit}
+RETURNING quantity
+"""
+
+_REMOVE_SQL = """
+UPDATE {item}
+SET quantity = quantity - 1,
+    reserved_until = CASE WHEN reserved_until > %(now)s THEN %(until)s ELSE reserved_until END
+WHERE cart_id = (SELECT id FROM {cart} WHERE user_id = %(user)s)
+  AND product_id = %(product)s AND quantity > 1
+RETURNING quantity
+"""
+
+_DELETE_SQL = """
+DELETE FROM {item}
+WHERE cart_id = (SELECT id FROM {cart} WHERE user_id = %(user)s)
+  AND product_id = %(product)s {condition}
+RETURNING quantity
+"""
+
+
+def _execute(sql, user, product_id):
+    now = timezone.now()
+    params = {
+        'user': user.pk,
+        'product': product_id,
+        'now': connection.ops.adapt_datetimefield_value(now),
+        'until': connection.ops.adapt_datetimefield_value(reserve_until()),
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def add_item(user, product_id):
+    """
+    Добавляет единицу товара в корзину и продлевает резерв.
+    Возвращает новое количество или None, если добавить нельзя.
+    """
+    tables = _tables()
+    sql = _ADD_SQL.format(
+        insert_limit=_LIMIT_SQL.format(stock='p.stock_quantity', cart_id='c.id', **tables),
+        update_limit=_LIMIT_SQL.format(
+            stock=f'(SELECT stock_quantity FROM {tables["product"]} WHERE id = %(product)s)',
+            cart_id=f'{tables["item"]}.cart_id',
+            **tables,
+        ),
+        **tables,
+    )
+    return _execute(sql, user, product_id)
+
+
+def remove_item(user, product_id):
+    """
+    Убирает единицу товара из корзины. Возвращает оставшееся количество
+    (0, если позиция удалена) или None, если товара в корзине нет.
+    """
+    tables = _tables()
+    quantity = _execute(_REMOVE_SQL.format(**tables), user, product_id)
+    if quantity is not None:
+        return quantity
+    # Последняя единица: позиция удаляется целиком
+    if _execute(_DELETE_SQL.format(condition='AND quantity <= 1', **tables), user, product_id) is None:
+        return None
+    return 0
+
+
+def delete_item(user, product_id):
+    """Удаляет позицию из корзины; False, если ее там не было"""
+    return _execute(_DELETE_SQL.format(condition='', **_tables()), user, product_id) is not None
+
+
+def add_rejection(user, product_id):
+    """
+    Почему add_item ничего не изменил - одним запросом. None, если товара
+    нет или он закончился; иначе наличие корзины, количество в ней и
+    сколько единиц можно держать в корзине.
+    """
+    own = CartItem.objects.filter(cart__user=user, product_id=OuterRef('pk'))
+    state = (
+        with_available(Product.objects.filter(id=product_id, in_stock=True))
+        .annotate(
+            has_cart=Exists(Cart.objects.filter(user=user)),
+            in_cart=Subquery(own.values('quantity')),
+            reserved_until=Subquery(own.values('reserved_until'), output_field=DateTimeField()),
+        )
+        .values('available_quantity', 'has_cart', 'in_cart', 'reserved_until')
+        .first()
+    )
+    if state is None:
+        return None
+    in_cart = state['in_cart'] or 0
+    held = in_cart if state['reserved_until'] and state['reserved_until'] > timezone.now() else 0
+    return {
+        'has_cart': state['has_cart'],
+        'in_cart': in_cart,
+        'limit': max(state['available_quantity'] + held, 0),
+    }
+
+
+# Сколько товаров можно изменить одним запросом синхронизации
+MAX_SYNC_ITEMS = 100
+
+
+def parse_sync_changes(payload):
+    """
+    Разбирает тело запроса синхронизации:
+    {"items": [{"product_id": 1, "quantity": 3}, {"product_id": 2, "delta": 1}]}.
+    quantity - нужное количество, delta - сколько добавить к текущему.
+    Возвращает {product_id: ('set' | 'add', число)}, ValueError при ошибке.
+    """
+    items = payload.get('items') if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError('нет списка items')
+    if len(items) > MAX_SYNC_ITEMS:
+        raise ValueError(f'не больше {MAX_SYNC_ITEMS} товаров за запрос')
+    changes = {}
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError('элемент items должен быть объектом')
+        mode, key = ('set', 'quantity') if 'quantity' in item else ('add', 'delta')
+        product_id, value = item.get('product_id'), item.get(key)
+        # bool - подкласс int, но количеством быть не может
+        if not all(isinstance(v, int) and not isinstance(v, bool) for v in (product_id, value)):
+            raise ValueError('product_id и количество должны быть целыми числами')
+        if mode == 'set' and value < 0:
+            raise ValueError('количество не может быть отрицательным')
+        changes[product_id] = (mode, value)
+    return changes
+
+
+def _resolve_change(mode, value, in_cart, limit):
+    """
+    Новое количество позиции и запрошенное количество, если его пришлось урезать.
+    Увеличение сверх limit урезается до него, уменьшение проходит всегда.
+    """
+    wanted = max(value if mode == 'set' else in_cart + value, 0)
+    if wanted > in_cart and wanted > limit:
+        return max(limit, in_cart), wanted
+    return wanted, None
+
+
+def sync_items(user, changes):
+    """
+    Приводит корзину к нужным количествам сразу для многих товаров.
+
+    Остатки всех товаров и текущие позиции корзины читаются одним
+    запросом, изменения пишутся одним INSERT ... ON CONFLICT и одним
+    DELETE в общей транзакции. Увеличение сверх доступного остатка
+    урезается до него и попадает в конфликты; уменьшение проходит всегда.
+    Возвращает итоговые позиции и конфликты.
+    """
+    cart, created = Cart.objects.get_or_create(user=user)
+    own = CartItem.objects.filter(cart=cart, product_id=OuterRef('pk'))
+    with transaction.atomic():
+        rows = (
+            with_available(Product.objects.filter(id__in=changes))
+            .annotate(
+                in_cart=Subquery(own.values('quantity')),
+                reserved_until=Subquery(own.values('reserved_until'), output_field=DateTimeField()),
+            )
+            .values_list('id', 'name', 'available_quantity', 'in_cart', 'reserved_until')
+        )
+        state = {row[0]: row[1:] for row in rows}
+
+        now = timezone.now()
+        until = reserve_until()
+        to_save, to_delete, items, conflicts = [], [], [], []
+        for product_id, (mode, value) in changes.items():
+            if product_id not in state:
+                continue
+            name, available, in_cart, reserved = state[product_id]
+            in_cart = in_cart or 0
+            held = in_cart if reserved and reserved > now else 0
+            limit = max(available + held, 0)
+            quantity, conflict = _resolve_change(mode, value, in_cart, limit)
+            if conflict:
+                conflicts.append({'product_id': product_id, 'name': name, 'requested': conflict, 'available': limit})
+
+            if quantity:
+                # Резерв продлевается, только если количество укладывается в остаток
+                to_save.append(CartItem(
+                    cart=cart,
+                    product_id=product_id,
+                    quantity=quantity,
+                    reserved_until=until if quantity <= limit else reserved,
+                ))
+            elif in_cart:
+                to_delete.append(product_id)
+            items.append({'product_id': product_id, 'quantity': quantity, 'max_quantity': limit})
+
+        if to_save:
+            CartItem.objects.bulk_create(
+                to_save,
+                update_conflicts=True,
+                unique_fields=['cart', 'product'],
+                update_fields=['quantity', 'reserved_until'],
+            )
+        if to_delete:
+            CartItem.objects.filter(cart=cart, product_id__in=to_delete).delete()
+    return items, conflicts
+
+
+def sync_guest_items(guest, changes):
+    """То же для гостевой корзины: один запрос остатков, запись только в cookie"""
+    rows = with_available(Product.objects.filter(id__in=changes)).values_list('id', 'name', 'available_quantity')
+    state = {product_id: (name, available) for product_id, name, available in rows}
+    items, conflicts = [], []
+    for product_id, (mode, value) in changes.items():
+        if product_id not in state:
+            # Товар удален из каталога
+            guest.set(product_id, 0)
+            continue
+        name, available = state[product_id]
+        in_cart = guest.quantity(product_id)
+        limit = max(available, 0)
+        quantity, conflict = _resolve_change(mode, value, in_cart, limit)
+        if not guest.set(product_id, quantity):
+            quantity, conflict = in_cart, quantity
+        if conflict:
+            conflicts.append({'product_id': product_id, 'name': name, 'requested': conflict, 'available': limit})
+        items.append({'product_id': product_id, 'quantity': quantity, 'max_quantity': limit})
+    return items, conflicts
+
+
+def merge_guest_cart(request, user):
+    """
+    Переносит гостевую корзину в Cart пользователя после входа или регистрации.
+    Количества складываются с уже лежащими в корзине и урезаются по остатку;
+    запись - один INSERT ... ON CONFLICT. Cookie очищается при сохранении
+    гостевой корзины в ответ. Возвращает True, если что-то перенесено.
+    """
+    guest = get_guest_cart(request)
+    if not guest:
+        return False
+    sync_items(user, {product_id: ('add', quantity) for product_id, quantity in guest.items.items()})
+    guest.clear()
+    return True
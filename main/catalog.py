@@ -0,0 +1,141 @@
+from decimal import Decimal, InvalidOperation
+
+from django.core.paginator import Paginator
+from django.db.models import Count, Max
+
+from . import search
+from .models import Product
+
+PAGE_SIZE = 24
+
+SORT_OPTIONS = {
+    # Порядок по релевантности задает search.ranked_queryset
+    'relevance': (),
+    'new': ('-created_at', '-id'),
+    'name_asc': ('name', 'id'),
+    'name_desc': ('-name', '-id'),
+    'price_asc': ('price', 'id'),
+    'price_desc': ('-price', '-id'),
+    'year_asc': ('year', 'id'),
+    'year_desc': ('-year', '-id'),
+}
+DEFAULT_SORT = 'new'
+RELEVANCE_SORT = 'relevance'
+
+SORT_CHOICES = [
+    ('relevance', 'По релевантности'),
+    ('new', 'Сначала новые'),
+    ('name_asc', 'По названию (А-Я)'),
+    ('name_desc', 'По названию (Я-А)'),
+    ('price_asc', 'По цене (↑ дешевые)'),
+    ('price_desc', 'По цене (↓ дорогие)'),
+    ('year_asc', 'По году (↑ старые)'),
+    ('year_desc', 'По году (↓ новые)'),
+]
+
+
+def _to_decimal(value):
+    try:
+        return Decimal(value) if value else None
+    except (InvalidOperation, TypeError):
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(value) if value else None
+    except (ValueError, TypeError):
+        return None
+
+
+def parse_filters(params):
+    """Разбирает GET-параметры каталога, некорректные значения игнорируются"""
+    q = params.get('q', '').strip()
+    # С поисковым запросом по умолчанию сортируем по релевантности, без него она не имеет смысла
+    sort = params.get('sort') or (RELEVANCE_SORT if q else DEFAULT_SORT)
+    if sort not in SORT_OPTIONS or (sort == RELEVANCE_SORT and not q):
+        sort = DEFAULT_SORT
+    return {
+        'category': params.get('category', '').strip(),
+        'min_price': _to_decimal(params.get('min_price')),
+        'max_price': _to_decimal(params.get('max_price')),
+        'year': _to_int(params.get('year')),
+        'q': q,
+        'sort': sort,
+    }
+
+
+def base_queryset():
+    """Товары, которые видны покупателям"""
+    return Product.objects.filter(in_stock=True, is_published=True)
+
+
+def apply_filters(queryset, filters, with_category=True, with_search=True):
+    if with_category and filters['category']:
+        queryset = queryset.filter(category__slug=filters['category'])
+    if filters['min_price'] is not None:
+        queryset = queryset.filter(price__gte=filters['min_price'])
+    if filters['max_price'] is not None:
+        queryset = queryset.filter(price__lte=filters['max_price'])
+    if filters['year']:
+        queryset = queryset.filter(year=filters['year'])
+    if with_search and filters['q']:
+        queryset = search.filter_queryset(queryset, filters['q'])
+    return queryset
+
+
+def facets_queryset(filters):
+    """Количество товаров по категориям с учетом всех фильтров, кроме самой категории"""
+    return (
+        apply_filters(base_queryset(), filters, with_category=False)
+        .order_by()
+        .values('category__slug', 'category__name')
+        .annotate(count=Count('id'))
+        .order_by('category__name')
+    )
+
+
+def category_facets(filters):
+    """Одним GROUP BY запросом получаем и бейджи категорий, и общее число найденных товаров"""
+    rows = facets_queryset(filters)
+    return [
+        {'slug': row['category__slug'], 'name': row['category__name'], 'count': row['count']}
+        for row in rows
+    ]
+
+
+def search_catalog(params, page_number=None):
+    """Возвращает одну страницу каталога и данные для боковой панели фильтров"""
+    filters = parse_filters(params)
+    facets = category_facets(filters)
+
+    if filters['category']:
+        total = sum(f['count'] for f in facets if f['slug'] == filters['category'])
+    else:
+        total = sum(f['count'] for f in facets)
+
+    if filters['sort'] == RELEVANCE_SORT:
+        products = search.ranked_queryset(apply_filters(base_queryset(), filters, with_search=False),
+                                          filters['q'], total)
+    else:
+        products = apply_filters(base_queryset(), filters).order_by(*SORT_OPTIONS[filters['sort']])
+    products = products.select_related('category')
+    paginator = Paginator(products, PAGE_SIZE)
+    # Общее количество уже известно из запроса по категориям, лишний COUNT не нужен
+    paginator.count = total
+    page = paginator.get_page(page_number)
+
+    return {
+        'filters': filters,
+        'facets': facets,
+        'total': total,
+        'page': page,
+    }
+
+
+def filter_options():
+    """Диапазон цен и список годов для формы фильтров"""
+    queryset = base_queryset().order_by()
+    max_price = queryset.aggregate(max_price=Max('price'))['max_price'] or 0
+    years = queryset.values_list('year', flat=True).distinct().order_by('-year')
+    return {'max_price': max_price, 'available_years': list(years)}
@@ -0,0 +1,186 @@
+"""
+Версионированный кеш каталога.
+
+Все ключи содержат номер версии каталога. При изменении товаров или
+категорий версия увеличивается, и старые записи просто перестают читаться,
+поэтому удалять их по одной не нужно.
+
+Кеш должен быть общим для процессов: версию увеличивают и воркеры
+сайта, и команды управления (импорт, инвентаризация).
+"""
+import hashlib
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.paginator import Page, Paginator
+from django.middleware.cache import CacheMiddleware
+from django.template.loader import render_to_string
+from django.utils.decorators import decorator_from_middleware_with_args
+from django.utils.safestring import mark_safe
+
+from . import catalog, metrics
+from .models import Product
+
+VERSION_KEY = 'catalog:version'
+STATS_KINDS = ('page', 'query', 'card')
+
+# Сколько первых карточек на первой странице получают бейдж "Популярный"
+POPULAR_COUNT = 3
+
+logger = logging.getLogger(__name__)
+_local_cache_warned = False
+
+
+def is_process_local():
+    """Кеш виден только текущему процессу (LocMemCache) или не хранит ничего"""
+    return isinstance(caches['default'], (LocMemCache, DummyCache))
+
+
+def get_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, time.time_ns(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def invalidate():
+    # Новая версия - текущее время, а не incr: файловый кеш увеличивает
+    # значение неатомарно, и два одновременных сброса дали бы одну версию.
+    # Время также не повторяет номер, под которым лежат старые данные
+    cache.set(VERSION_KEY, time.time_ns(), None)
+    global _local_cache_warned
+    if is_process_local() and not _local_cache_warned:
+        _local_cache_warned = True
+        logger.warning('Кеш каталога локален для процесса: сброс не дойдет до других воркеров и команд')
+
+
+def record(kind, hits=0, misses=0):
+    """
+    Учитывает попадания и промахи кеша в метриках процесса (main.metrics):
+    запись в общий кеш на каждый запрос была бы дороже самого попадания
+    """
+    for result, value in (('hit', hits), ('miss', misses)):
+        if value:
+            metrics.catalog_cache_events.inc(value, kind=kind, result=result)
+
+
+def get_stats():
+    """Попадания и промахи кеша в текущем процессе"""
+    return {
+        kind: {name: metrics.catalog_cache_events.get(kind=kind, result=result)
+               for name, result in (('hits', 'hit'), ('misses', 'miss'))}
+        for kind in STATS_KINDS
+    }
+
+
+def _digest(data):
+    raw = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+def render_cards(product_ids, version, products=None, first_page=False):
+    """
+    Возвращает HTML карточек в порядке product_ids.
+    Готовые карточки берутся из кеша одним запросом, недостающие рендерятся.
+    """
+    products = products or {}
+    keys = {}
+    for position, product_id in enumerate(product_ids):
+        popular = first_page and position < POPULAR_COUNT
+        keys[product_id] = (f'catalog:{version}:card:{product_id}:{int(popular)}', popular)
+
+    cards = cache.get_many([key for key, popular in keys.values()])
+    missing = [product_id for product_id, (key, popular) in keys.items() if key not in cards]
+    record('card', hits=len(product_ids) - len(missing), misses=len(missing))
+
+    if missing:
+        to_load = [product_id for product_id in missing if product_id not in products]
+        if to_load:
+            products.update(Product.objects.select_related('category').in_bulk(to_load))
+        rendered = {}
+        for product_id in missing:
+            if product_id not in products:
+                continue
+            key, popular = keys[product_id]
+            rendered[key] = render_to_string('includes/product_card.html', {
+                'product': products[product_id],
+                'popular': popular,
+            })
+        cache.set_many(rendered, settings.CATALOG_CACHE_TIMEOUT)
+        cards.update(rendered)
+
+    return [mark_safe(cards[key]) for key, popular in keys.values() if key in cards]
+
+
+def catalog_page(params, page_number=None):
+    """
+    Страница каталога: результат запроса (id товаров, фасеты, количество)
+    и карточки кешируются отдельно, чтобы разные комбинации фильтров
+    переиспользовали уже отрендеренные карточки.
+    """
+    version = get_version()
+    filters = catalog.parse_filters(params)
+    key = f'catalog:{version}:query:{_digest([filters, page_number])}'
+
+    result = cache.get(key)
+    record('query', hits=int(result is not None), misses=int(result is None))
+    products = {}
+    if result is None:
+        data = catalog.search_catalog(params, page_number)
+        page = data['page']
+        products = {product.id: product for product in page.object_list}
+        result = {
+            'facets': data['facets'],
+            'total': data['total'],
+            'number': page.number,
+            'ids': list(products),
+        }
+        cache.set(key, result, settings.CATALOG_CACHE_TIMEOUT)
+
+    cards = render_cards(result['ids'], version, products, first_page=result['number'] == 1)
+
+    paginator = Paginator(Product.objects.none(), catalog.PAGE_SIZE)
+    paginator.count = result['total']
+    return {
+        'filters': filters,
+        'facets': result['facets'],
+        'total': result['total'],
+        'page': Page(cards, result['number'], paginator),
+    }
+
+
+def filter_options():
+    key = f'catalog:{get_version()}:options'
+    options = cache.get(key)
+    record('query', hits=int(options is not None), misses=int(options is None))
+    if options is None:
+        options = catalog.filter_options()
+        cache.set(key, options, settings.CATALOG_CACHE_TIMEOUT)
+    return options
+
+
+class VersionedCacheMiddleware(CacheMiddleware):
+    """Кеш страниц, ключи которого зависят от версии каталога"""
+
+    @property
+    def key_prefix(self):
+        return f'{self._key_prefix}page:{get_version()}'
+
+    @key_prefix.setter
+    def key_prefix(self, value):
+        self._key_prefix = value
+
+    def process_request(self, request):
+        response = super().process_request(request)
+        if request.method in ('GET', 'HEAD'):
+            record('page', hits=int(response is not None), misses=int(response is None))
+        return response
+
+
+versioned_cache_page = decorator_from_middleware_with_args(VersionedCacheMiddleware)
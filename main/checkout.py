@@ -0,0 +1,102 @@
+from django.db import transaction
+
+from . import inventory
+from .models import CartItem, Order, OrderItem, Product, StockMovement
+
+
+class EmptyCartError(Exception):
+    pass
+
+
+class StockConflictError(Exception):
+    """Одного или нескольких товаров не хватает на складе"""
+
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super().__init__(conflicts)
+
+    @property
+    def message(self):
+        first = self.conflicts[0]
+        return f'Недостаточно товара "{first["name"]}" на складе. Доступно: {first["available"]} шт.'
+
+
+def _find_conflicts(cart_items):
+    return [
+        {
+            'product_id': item.product_id,
+            'name': item.product.name,
+            'requested': item.quantity,
+            'available': item.max_quantity,
+        }
+        for item in cart_items
+        if item.exceeds_stock()
+    ]
+
+
+def place_order(cart):
+    """
+    Оформляет заказ из корзины в одной транзакции.
+
+    Списание записывается в журнал движений, строки товаров не
+    переписываются. Позиции с активным резервом уже обеспечены товаром
+    и превращаются в продажу без блокировок. Строки товаров блокируются
+    в порядке id только для позиций, чей резерв истек, - на время
+    повторной проверки остатка. Число запросов не зависит от размера корзины.
+    """
+    with transaction.atomic():
+        cart_items = list(
+            CartItem.objects
+            .filter(cart=cart)
+            .select_related('product')
+            .order_by('product_id')
+        )
+        if not cart_items:
+            raise EmptyCartError()
+
+        unreserved = [item.product_id for item in cart_items if not item.held_quantity]
+        if unreserved:
+            # Блокировка - отдельным запросом: в PostgreSQL подзапросы остатка
+            # внутри SELECT ... FOR UPDATE видели бы снимок до ожидания блокировки,
+            # и два заказа последней единицы прошли бы проверку
+            list(
+                Product.objects.filter(id__in=unreserved)
+                .select_for_update()
+                .order_by('id')
+                .values_list('id', flat=True)
+            )
+        # Остатки читаются после блокировки. Для зарезервированных позиций они
+        # проверяются без нее: отрицательным остаток станет, только если склад уменьшили вручную
+        inventory.attach_available([item.product for item in cart_items])
+        conflicts = _find_conflicts(cart_items)
+        if conflicts:
+            raise StockConflictError(conflicts)
+
+        order = Order.objects.create(
+            user_id=cart.user_id,
+            total_price=sum(item.product.price * item.quantity for item in cart_items),
+            status='pending',
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order,
+                product_id=item.product_id,
+                quantity=item.quantity,
+                price=item.product.price,
+            )
+            for item in cart_items
+        ])
+        inventory.record([
+            StockMovement(
+                product_id=item.product_id,
+                order=order,
+                kind=StockMovement.SELL,
+                quantity=-item.quantity,
+            )
+            for item in cart_items
+        ])
+
+        # Удаление элементов корзины снимает их резервы в той же транзакции
+        CartItem.objects.filter(cart=cart).delete()
+
+    return order
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.views.decorators.cache import cache_control
+
+from .catalog_cache import versioned_cache_page
+
+
+def public_page(view_func):
+    """
+    Страница без пользовательских данных: один ответ для всех посетителей.
+
+    На сервере ответ хранится в версионированном кеше каталога и сбрасывается
+    при изменении товаров. Браузерам и промежуточным кешам разрешено хранить
+    его только PUBLIC_PAGE_MAX_AGE секунд, так как их сбросить нельзя.
+    Данные пользователя для шапки страница получает отдельно через header_state.
+    """
+    view_func = cache_control(public=True, max_age=settings.PUBLIC_PAGE_MAX_AGE)(view_func)
+    return versioned_cache_page(page_timeout=settings.PUBLIC_PAGE_CACHE_TIMEOUT)(view_func)
@@ -2,7 +2,7 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth import authenticate
 from django.core.exceptions import ValidationError
-from .models import CustomUser
+from .models import CustomUser, Product
 import re
 
 class RegistrationForm(UserCreationForm):
@@ -149,10 +149,53 @@ class OrderConfirmationForm(forms.Form):
 
     def __init__(self, *args, **kwargs):
         self.user = kwargs.pop('user', None)
+        # Пароль недавно подтвержден - повторно не спрашиваем и не хешируем
+        self.recently_authenticated = kwargs.pop('recently_authenticated', False)
         super().__init__(*args, **kwargs)
+        if self.recently_authenticated:
+            self.fields['password'].required = False
 
     def clean_password(self):
         password = self.cleaned_data.get('password')
+        if self.recently_authenticated:
+            return password
         if self.user and not self.user.check_password(password):
             raise ValidationError('Неверный пароль')
-        return password
\ No newline at end of file
+        return password
+
+class OrderExportForm(forms.Form):
+    date_from = forms.DateField(
+        label='С даты',
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    date_to = forms.DateField(
+        label='По дату (включительно)',
+        widget=forms.DateInput(attrs={'type': 'date'})
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        date_to = cleaned_data.get('date_to')
+
+        if date_from and date_to and date_from > date_to:
+            self.add_error('date_to', 'Дата окончания раньше даты начала')
+
+        return cleaned_data
+
+
+class ProductAdminForm(forms.ModelForm):
+    """
+    В поле количества показывается остаток на складе с учетом журнала
+    движений, а не снимок. Новое значение сохраняется как корректировка.
+    """
+
+    class Meta:
+        model = Product
+        fields = '__all__'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stock_snapshot = self.instance.stock_quantity
+        if self.instance.pk and 'stock_quantity' in self.fields:
+            self.initial['stock_quantity'] = self.instance.on_hand
@@ -0,0 +1,88 @@
+"""
+Корзина гостя в подписанной cookie.
+
+Пока покупатель не вошел, корзина хранится у него в браузере в виде
+строки "id:количество,id:количество", подписанной SECRET_KEY.
+Изменения такой корзины не пишут в базу ничего, а для товаров на
+экране нужен один запрос. Резервы остатка гостевая корзина не держит:
+они появляются при переносе в Cart после входа или регистрации.
+"""
+from django.conf import settings
+
+COOKIE_SALT = 'main.guest_cart'
+# Подписанная cookie должна уложиться в 4 КБ
+MAX_ITEMS = 50
+MAX_QUANTITY = 999
+
+
+def _decode(value):
+    items = {}
+    for part in value.split(','):
+        product_id, _, quantity = part.partition(':')
+        try:
+            product_id, quantity = int(product_id), int(quantity)
+        except ValueError:
+            continue
+        if product_id > 0 and 0 < quantity <= MAX_QUANTITY:
+            items[product_id] = quantity
+    return items
+
+
+class GuestCart:
+    def __init__(self, request):
+        # Поддельная или устаревшая cookie дает пустую корзину
+        value = request.get_signed_cookie(
+            settings.GUEST_CART_COOKIE, default='', salt=COOKIE_SALT, max_age=settings.GUEST_CART_MAX_AGE,
+        )
+        self.items = _decode(value)
+        self.changed = False
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def quantity(self, product_id):
+        return self.items.get(product_id, 0)
+
+    @property
+    def total_quantity(self):
+        return sum(self.items.values())
+
+    def set(self, product_id, quantity):
+        """Возвращает False, если товар не помещается в корзину"""
+        if quantity > 0 and product_id not in self.items and len(self.items) >= MAX_ITEMS:
+            return False
+        if quantity > 0:
+            self.items[product_id] = min(quantity, MAX_QUANTITY)
+        else:
+            self.items.pop(product_id, None)
+        self.changed = True
+        return True
+
+    def clear(self):
+        self.items = {}
+        self.changed = True
+
+    def save(self, response):
+        """Записывает корзину в cookie ответа, если она менялась"""
+        if not self.changed:
+            return response
+        if self.items:
+            response.set_signed_cookie(
+                settings.GUEST_CART_COOKIE,
+                ','.join(f'{product_id}:{quantity}' for product_id, quantity in self.items.items()),
+                salt=COOKIE_SALT,
+                max_age=settings.GUEST_CART_MAX_AGE,
+                httponly=True,
+                samesite='Lax',
+            )
+        else:
+            response.delete_cookie(settings.GUEST_CART_COOKIE, samesite='Lax')
+        return response
+
+
+
+def get_guest_cart(request):
+    """Гостевая корзина читается из cookie один раз за запрос"""
+    if not hasattr(request, '_guest_cart'):
+        request._guest_cart = GuestCart(request)
+    return request._guest_cart
@@ -0,0 +1,156 @@
+"""
+Уменьшенные копии изображений товаров для srcset.
+
+Для каждого изображения с именем по содержимому (main.storage) строятся
+копии нескольких ширин в WebP и JPEG без EXIF:
+products/variants/ab/ab12...ef-640w.webp. Имя копии выводится из имени
+исходника, поэтому шаблонам не нужно проверять диск, а браузеры могут
+кешировать копии так же долго, как исходники.
+
+Копии строятся в пуле процессов: при загрузке через админку (после
+коммита, не задерживая ответ) и командой generate_image_variants.
+Недостающая копия строится при первом запросе (views.product_image).
+"""
+import os
+import posixpath
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+from .storage import HASHED_NAME_RE, product_image_storage
+
+WIDTHS = (320, 640, 960)
+
+# Расширение файла: (формат Pillow, параметры сохранения)
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+VARIANTS_DIR = 'products/variants'
+
+VARIANT_NAME_RE = re.compile(
+    r'^' + VARIANTS_DIR + r'/([0-9a-f]{2})/(\1[0-9a-f]{62})-(\d+)w\.(' + '|'.join(FORMATS) + r')$'
+)
+
+_executor = None
+
+
+def variant_name(name, width, extension):
+    """Имя копии изображения name; для старых имен (не по содержимому) - None"""
+    match = HASHED_NAME_RE.search(name)
+    if match is None:
+        return None
+    digest = posixpath.splitext(posixpath.basename(name))[0]
+    return f'{VARIANTS_DIR}/{match.group(1)}/{digest}-{width}w.{extension}'
+
+
+def variant_names(name):
+    return [variant_name(name, width, extension) for width in WIDTHS for extension in FORMATS]
+
+
+def missing_variants(name):
+    names = variant_names(name)
+    if None in names:
+        return []
+    return [variant for variant in names if not product_image_storage.exists(variant)]
+
+
+def render_variants(source_path, targets):
+    """
+    Строит копии одного исходника: targets - список (путь, ширина, расширение).
+    Выполняется в процессе пула, поэтому работает с путями, а не с хранилищем.
+    Возвращает количество записанных файлов.
+    """
+    targets = sorted(targets, key=lambda target: -target[1])
+    with Image.open(source_path) as source:
+        icc_profile = source.info.get('icc_profile')
+        # JPEG декодируется сразу в уменьшенном масштабе, если исходник
+        # намного больше самой крупной копии; квадрат - чтобы хватило
+        # при любом повороте из EXIF
+        source.draft('RGB', (targets[0][1], targets[0][1]))
+        image = ImageOps.exif_transpose(source)
+        image.load()
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    written = 0
+    for path, width, extension in targets:
+        # Копии идут от крупной к мелкой, каждая уменьшается из предыдущей;
+        # исходник уже нужной ширины не увеличивается
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        if os.path.exists(path):
+            continue
+        output = image
+        pil_format, options = FORMATS[extension]
+        if pil_format == 'JPEG' and has_alpha:
+            output = Image.new('RGB', image.size, (255, 255, 255))
+            output.paste(image, mask=image.getchannel('A'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Запись через временный файл: параллельный запрос не увидит копию наполовину.
+        # EXIF не передается, поэтому в копию не попадают ни координаты, ни модель камеры
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        output.save(tmp_path, pil_format, icc_profile=icc_profile, **options)
+        os.replace(tmp_path, path)
+        written += 1
+    return written
+
+
+def _task(name, variants=None):
+    """Аргументы render_variants для исходника name (все или только перечисленные копии)"""
+    targets = []
+    for width in WIDTHS:
+        for extension in FORMATS:
+            variant = variant_name(name, width, extension)
+            if variants is None or variant in variants:
+                targets.append((product_image_storage.path(variant), width, extension))
+    return product_image_storage.path(name), targets
+
+
+def generate(names, workers=None):
+    """Строит недостающие копии изображений names в пуле процессов; возвращает количество файлов"""
+    tasks = []
+    for name in names:
+        missing = missing_variants(name)
+        if missing:
+            tasks.append(_task(name, set(missing)))
+    if not tasks:
+        return 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(render_variants, *zip(*tasks), chunksize=4))
+
+
+def schedule(name):
+    """Ставит построение копий в общий пул процессов и не ждет результата"""
+    global _executor
+    missing = missing_variants(name)
+    if not missing:
+        return None
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=1)
+    return _executor.submit(render_variants, *_task(name, set(missing)))
+
+
+def ensure_variant(variant):
+    """
+    Строит копию по ее имени при первом запросе. Возвращает False, если имя
+    не соответствует ни одной допустимой копии или исходника нет.
+    """
+    match = VARIANT_NAME_RE.match(variant)
+    if match is None or int(match.group(3)) not in WIDTHS:
+        return False
+    if product_image_storage.exists(variant):
+        return True
+    shard, digest = match.group(1), match.group(2)
+    try:
+        directories, files = product_image_storage.listdir(f'products/{shard}')
+    except FileNotFoundError:
+        return False
+    sources = [filename for filename in files if filename.startswith(f'{digest}.')]
+    if not sources:
+        return False
+    # Запрос все равно ждет копию, поэтому она строится в этом же процессе
+    render_variants(*_task(f'products/{shard}/{sources[0]}', {variant}))
+    return True
@@ -0,0 +1,227 @@
+"""
+Остатки товаров на журнале движений.
+
+Доступный остаток = Product.stock_quantity (снимок) + сумма движений
+с applied=False. Продажи и возвраты только добавляют строки в журнал,
+поэтому популярный товар не превращается в строку, которую каждый
+покупатель переписывает по очереди. Строка товара меняется лишь при
+смене in_stock и при свертке журнала в снимок.
+
+Резервы корзин живут в самих элементах корзины (CartItem.reserved_until),
+а не в журнале: они истекают сами, без парной записи об отмене.
+Остаток на складе (on_hand) - снимок плюс журнал, доступный остаток
+(available) - он же за вычетом активных резервов. in_stock отражает
+остаток на складе, чтобы каталог не мигал из-за чужих корзин.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import CartItem, Product, StockMovement
+from .signals import products_updated
+
+
+def pending_subquery(product_ref='pk'):
+    """Сумма неучтенных движений товара для annotate"""
+    return Coalesce(
+        Subquery(
+            StockMovement.objects
+            .filter(product_id=OuterRef(product_ref), applied=False)
+            .order_by()
+            .values('product_id')
+            .annotate(total=Sum('quantity'))
+            .values('total'),
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    )
+
+
+def reserved_subquery(product_ref='pk'):
+    """Сумма активных резервов товара в корзинах для annotate"""
+    return Coalesce(
+        Subquery(
+            CartItem.objects
+            .filter(product_id=OuterRef(product_ref), reserved_until__gt=timezone.now())
+            .order_by()
+            .values('product_id')
+            .annotate(total=Sum('quantity'))
+            .values('total'),
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    )
+
+
+def with_available(queryset):
+    """Добавляет к queryset товаров поля on_hand_quantity и available_quantity"""
+    return queryset.annotate(
+        on_hand_quantity=F('stock_quantity') + pending_subquery(),
+    ).annotate(
+        available_quantity=F('on_hand_quantity') - reserved_subquery(),
+    )
+
+
+def stock_levels(product_ids):
+    """{product_id: (остаток на складе, доступный остаток)} одним запросом"""
+    rows = with_available(Product.objects.filter(id__in=product_ids)).values_list(
+        'id', 'on_hand_quantity', 'available_quantity',
+    )
+    return {product_id: (on_hand, available) for product_id, on_hand, available in rows}
+
+
+def attach_available(products):
+    """Проставляет остатки уже загруженным товарам одним запросом"""
+    products = [product for product in products if 'available_quantity' not in product.__dict__]
+    if products:
+        levels = stock_levels({product.id for product in products})
+        for product in products:
+            product.on_hand_quantity, product.available_quantity = levels[product.id]
+    return products
+
+
+def record(movements):
+    """Добавляет движения в журнал одним INSERT и обновляет флаг in_stock"""
+    StockMovement.objects.bulk_create(movements)
+    return sync_in_stock({movement.product_id for movement in movements})
+
+
+def sync_in_stock(product_ids):
+    """
+    Приводит in_stock в соответствие с доступным остатком.
+    Обычно ничего не пишет: строка товара меняется только при переходе через ноль.
+    """
+    rows = (
+        Product.objects.filter(id__in=product_ids)
+        .annotate(on_hand_quantity=F('stock_quantity') + pending_subquery())
+        .values_list('id', 'in_stock', 'on_hand_quantity')
+    )
+    sold_out, back_in_stock = [], []
+    for product_id, in_stock, on_hand in rows:
+        if in_stock and on_hand <= 0:
+            sold_out.append(product_id)
+        elif not in_stock and on_hand > 0:
+            back_in_stock.append(product_id)
+    if sold_out:
+        Product.objects.filter(id__in=sold_out).update(in_stock=False)
+    if back_in_stock:
+        Product.objects.filter(id__in=back_in_stock).update(in_stock=True)
+    if sold_out or back_in_stock:
+        # Состав каталога изменился - сбрасываем его кеш
+        transaction.on_commit(lambda: products_updated.send(sender=Product))
+    return len(sold_out) + len(back_in_stock)
+
+
+def _lock_pending(product_ids=None, limit=None):
+    movements = StockMovement.objects.filter(applied=False).select_for_update().order_by('id')
+    if product_ids is not None:
+        movements = movements.filter(product_id__in=product_ids)
+    if limit is not None:
+        movements = movements[:limit]
+    return list(movements.values_list('id', 'product_id', 'quantity'))
+
+
+def _add_to_snapshot(deltas):
+    Product.objects.filter(id__in=deltas.keys()).update(
+        stock_quantity=Case(
+            *[When(id=product_id, then=F('stock_quantity') + delta) for product_id, delta in deltas.items()],
+            default=F('stock_quantity'),
+        )
+    )
+
+
+def fold(limit=5000):
+    """
+    Переносит до limit неучтенных движений в снимок Product.stock_quantity.
+    Возвращает количество учтенных движений.
+    """
+    with transaction.atomic():
+        # Блокируются и помечаются ровно те строки, которые просуммированы:
+        # движения, добавленные во время свертки, останутся на следующий раз
+        movements = _lock_pending(limit=limit)
+        if not movements:
+            return 0
+        deltas = {}
+        for movement_id, product_id, quantity in movements:
+            deltas[product_id] = deltas.get(product_id, 0) + quantity
+        _add_to_snapshot({product_id: delta for product_id, delta in deltas.items() if delta})
+        StockMovement.objects.filter(id__in=[movement[0] for movement in movements]).update(applied=True)
+    return len(movements)
+
+
+def stock_take(targets, comment=''):
+    """
+    Устанавливает остаток на складе: {product_id: количество}.
+    Разница с текущим остатком записывается в журнал как корректировка,
+    а снимок сразу принимает новое значение. Возвращает количество
+    товаров, у которых остаток изменился.
+    """
+    if not targets:
+        return 0
+    with transaction.atomic():
+        # Блокировка строк товаров согласована с оформлением заказа
+        snapshot = dict(
+            Product.objects.filter(id__in=targets.keys())
+            .select_for_update()
+            .order_by('id')
+            .values_list('id', 'stock_quantity')
+        )
+        pending = _lock_pending(product_ids=snapshot.keys())
+        on_hand = dict(snapshot)
+        for movement_id, product_id, quantity in pending:
+            on_hand[product_id] += quantity
+
+        adjustments = [
+            StockMovement(
+                product_id=product_id,
+                kind=StockMovement.ADJUST,
+                quantity=targets[product_id] - on_hand[product_id],
+                comment=comment,
+                applied=True,
+            )
+            for product_id in snapshot
+            if targets[product_id] != on_hand[product_id]
+        ]
+        if not adjustments:
+            return 0
+        changed = [movement.product_id for movement in adjustments]
+        StockMovement.objects.bulk_create(adjustments)
+        StockMovement.objects.filter(
+            id__in=[movement_id for movement_id, product_id, quantity in pending if product_id in changed]
+        ).update(applied=True)
+        _add_to_snapshot({
+            product_id: targets[product_id] - snapshot[product_id]
+            for product_id in changed
+            if targets[product_id] != snapshot[product_id]
+        })
+        sync_in_stock(changed)
+    return len(changed)
+
+
+def reserve_until():
+    """Срок резерва, который ставится при изменении корзины"""
+    return timezone.now() + timedelta(seconds=settings.CART_RESERVATION_TTL)
+
+
+def release_expired(limit=5000):
+    """
+    Снимает до limit истекших резервов. Возвращает количество снятых.
+
+    Истекший резерв и так не учитывается в доступном остатке, но пока
+    у строки есть reserved_until, она остается в частичном индексе резервов.
+    Чистка держит этот индекс маленьким.
+    """
+    expired = list(
+        CartItem.objects
+        .filter(reserved_until__lte=timezone.now())
+        .order_by('reserved_until')
+        .values_list('id', flat=True)[:limit]
+    )
+    if not expired:
+        return 0
+    # Повторная проверка срока: резерв могли продлить, пока шла выборка
+    return CartItem.objects.filter(id__in=expired, reserved_until__lte=timezone.now()).update(reserved_until=None)
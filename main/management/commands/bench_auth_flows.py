@@ -0,0 +1,121 @@
+# main/management/commands/bench_auth_flows.py
+import json
+import secrets
+import tempfile
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from main import benchmark
+from main.forms import LoginForm
+from main.models import Cart, CartItem, Category, CustomUser, Product
+
+
+class Command(BaseCommand):
+    help = ('Замеряет процессорное время входа и оформления заказа с настоящими хешерами паролей. '
+            'Все изменения в базе откатываются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20, help='Сколько раз выполнить каждый сценарий')
+        parser.add_argument('--host', default='localhost', help='Заголовок Host запросов')
+        parser.add_argument('--output', help='Сохранить результат в JSON')
+
+    def handle(self, *args, **options):
+        self.client = Client(HTTP_HOST=options['host'])
+        self.password = secrets.token_urlsafe(12)
+        # Метрики замера не должны попасть в снимки работающего сайта
+        with tempfile.TemporaryDirectory() as metrics_dir, override_settings(METRICS_DIR=metrics_dir):
+            with transaction.atomic():
+                self.create_fixtures()
+                results = {
+                    name: self.measure(flow, options['iterations'])
+                    for name, flow in [
+                        ('password_hash', self.password_hash),
+                        ('login_double_hash', self.login_double_hash),
+                        ('login', self.login),
+                        ('checkout_password', self.checkout_password),
+                        ('checkout_reauth', self.checkout_reauth),
+                    ]
+                }
+                transaction.set_rollback(True)
+
+        self.stdout.write(f'{"Сценарий":<20} {"CPU p50, мс":>12} {"CPU p95, мс":>12} {"хеши, мс":>10} {"запросы":>8}')
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:<20} {result["cpu_p50_ms"]:>12} {result["cpu_p95_ms"]:>12} '
+                f'{result["hashing_ms"] if result["hashing_ms"] is not None else "-":>10} '
+                f'{result["queries"] if result["queries"] is not None else "-":>8}'
+            )
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'✅ Хешер паролей: {settings.PASSWORD_HASHERS[0].rsplit(".", 1)[-1]}'))
+
+    def create_fixtures(self):
+        self.user = CustomUser.objects.create_user(
+            f'bench-{secrets.token_hex(4)}', 'bench@example.com', self.password,
+        )
+        self.cart = Cart.objects.create(user=self.user)
+        category = Category.objects.create(name='Замер', slug=f'bench-{secrets.token_hex(4)}')
+        self.product = Product.objects.create(
+            name='Товар для замера', price=Decimal('100'), category=category, year=2024, stock_quantity=10 ** 6,
+        )
+
+    def measure(self, flow, iterations):
+        """Каждая итерация: подготовка вне замера, затем сам сценарий"""
+        cpu, hashing, queries = [], [], []
+        for _ in range(iterations):
+            run = flow()
+            started = time.process_time()
+            response = run()
+            cpu.append((time.process_time() - started) * 1000)
+            if response is not None:
+                timing = benchmark.server_timing(response.get('Server-Timing'))
+                hashing.append(timing.get('hashing', (0.0, None))[0])
+                queries.append(benchmark.server_timing_queries(response.get('Server-Timing')))
+        return {
+            'iterations': iterations,
+            'cpu_p50_ms': round(benchmark.percentile(cpu, 50), 1),
+            'cpu_p95_ms': round(benchmark.percentile(cpu, 95), 1),
+            'hashing_ms': round(benchmark.percentile(hashing, 50), 1) if hashing else None,
+            'queries': queries[-1] if queries else None,
+        }
+
+    # Сценарии возвращают функцию, время которой замеряется
+
+    def password_hash(self):
+        return lambda: self.user.check_password(self.password) and None
+
+    def login_double_hash(self):
+        """Вход в прежнем виде: AuthenticationForm и еще один authenticate во view"""
+        def run():
+            form = LoginForm(None, data={'username': self.user.username, 'password': self.password})
+            form.is_valid()
+            authenticate(None, username=self.user.username, password=self.password)
+        return run
+
+    def login(self):
+        self.client.logout()
+        return lambda: self.client.post(reverse('login'), {'username': self.user.username, 'password': self.password})
+
+    def fill_cart(self):
+        CartItem.objects.get_or_create(cart=self.cart, product=self.product)
+
+    def checkout_password(self):
+        self.client.force_login(self.user)
+        self.client.cookies.pop(settings.REAUTH_COOKIE, None)
+        self.fill_cart()
+        return lambda: self.client.post(reverse('cart'), {'password': self.password})
+
+    def checkout_reauth(self):
+        if settings.REAUTH_COOKIE not in self.client.cookies:
+            self.client.post(reverse('login'), {'username': self.user.username, 'password': self.password})
+        self.fill_cart()
+        return lambda: self.client.post(reverse('cart'))
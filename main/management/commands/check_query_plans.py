@@ -0,0 +1,84 @@
+# main/management/commands/check_query_plans.py
+import json
+import re
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from main import catalog, inventory, order_history, search
+from main.models import CartItem, Category, CustomUser, Order, OrderItem, Product
+
+# Строки плана, означающие полный просмотр таблицы
+FULL_SCAN_PATTERNS = {
+    'sqlite': re.compile(r'\bSCAN (?P<table>\w+)(?! USING)\s*$'),
+    'postgresql': re.compile(r'Seq Scan on (?P<table>\w+)'),
+}
+
+
+def hot_queries():
+    """Запросы самых нагруженных страниц с параметрами из текущей базы"""
+    category = Category.objects.order_by('id').first()
+    product = Product.objects.order_by('id').first()
+    order = Order.objects.order_by('id').first()
+    user = order.user if order else None
+    if not (category and product and user):
+        raise CommandError('База пуста: сначала заполните ее товарами, пользователями и заказами')
+
+    visible = catalog.base_queryset()
+    now = timezone.now()
+    return {
+        'Каталог: новинки': visible.order_by('-created_at')[:catalog.PAGE_SIZE],
+        'Каталог: категория': visible.filter(category__slug=category.slug).order_by('-created_at')[:catalog.PAGE_SIZE],
+        'Каталог: количество по категориям': catalog.facets_queryset(catalog.parse_filters({})),
+        'Поиск: товары по релевантности': search.ranked_queryset(visible, product.name)[:catalog.PAGE_SIZE],
+        'Поиск: количество по категориям': catalog.facets_queryset(catalog.parse_filters({'q': product.name})),
+        'Карточка товара': inventory.with_available(Product.objects.filter(id=product.id, in_stock=True)),
+        'Остаток: неучтенные движения и резервы': inventory.with_available(Product.objects.filter(id__in=[product.id])),
+        'Резервы: поиск истекших': CartItem.objects.filter(reserved_until__lte=now).order_by('reserved_until')[:5000],
+        'Профиль: заказы пользователя': order_history.orders_queryset(user)[:order_history.PAGE_SIZE + 1],
+        'Профиль: состав заказа': OrderItem.objects.filter(order_id=order.id, order__user=user),
+        'Админка: заказы по статусу': Order.objects.filter(status='pending').order_by('-created_at')[:20],
+        'Админка: заказы за период': Order.objects.filter(created_at__gte=now - timedelta(days=365), created_at__lt=now),
+        'Регистрация: поиск email': CustomUser.objects.filter(email=user.email),
+        'Корзина: итоги': CartItem.objects.filter(cart__user=user),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Проверяет планы выполнения горячих запросов: ни один не должен читать таблицу целиком'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='Сохранить планы запросов в JSON-файл')
+
+    def handle(self, *args, **options):
+        pattern = FULL_SCAN_PATTERNS.get(connection.vendor)
+        if pattern is None:
+            raise CommandError(f'Проверка планов не поддерживается для {connection.vendor}')
+
+        report = []
+        failures = []
+        for label, queryset in hot_queries().items():
+            plan = queryset.explain()
+            scans = sorted({
+                match.group('table')
+                for line in plan.splitlines()
+                for match in [pattern.search(line)] if match
+            })
+            report.append({'query': label, 'sql': str(queryset.query), 'plan': plan, 'full_scans': scans})
+
+            if scans:
+                failures.append(label)
+                self.stdout.write(self.style.ERROR(f'❌ {label}: полный просмотр {", ".join(scans)}'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'✅ {label}'))
+            if options['verbosity'] > 1:
+                self.stdout.write(plan)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+
+        if failures:
+            raise CommandError(f'Запросов с полным просмотром таблицы: {len(failures)}')
@@ -0,0 +1,93 @@
+# main/management/commands/dedupe_product_images.py
+import posixpath
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Case, Value, When
+
+from main.image_variants import VARIANTS_DIR
+from main.models import Product
+from main.signals import products_updated
+from main.storage import is_hashed_name, product_image_storage
+
+IMAGE_DIR = 'products'
+
+
+class Command(BaseCommand):
+    help = ('Переводит изображения товаров на имена по содержимому: одинаковые файлы '
+            'остаются в одном экземпляре, ссылки товаров обновляются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать дубликаты')
+        parser.add_argument('--keep-originals', action='store_true',
+                            help='Не удалять файлы со старыми именами после обновления товаров')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Сколько имен обновлять в товарах одним запросом')
+
+    def handle(self, *args, **options):
+        storage = product_image_storage
+        started = time.perf_counter()
+        renamed, stored = {}, set()
+        duplicates = freed = 0
+        for name in self.walk(IMAGE_DIR):
+            with storage.open(name) as f:
+                target = storage.hashed_name(name, f)
+                if target in stored or storage.exists(target):
+                    duplicates += 1
+                    freed += storage.size(name)
+                elif not options['dry_run']:
+                    storage.save(name, f)
+            stored.add(target)
+            renamed[name] = target
+
+        updated = 0
+        if not options['dry_run']:
+            # Сначала все файлы сохранены под новыми именами, затем меняются
+            # ссылки, и только потом удаляются старые файлы: страница
+            # не сошлется на несуществующее изображение
+            updated = self.update_products(renamed, options['batch_size'])
+            if updated:
+                products_updated.send(sender=Product)
+            if not options['keep_originals']:
+                for name in renamed:
+                    storage.delete(name)
+
+        self.stdout.write(
+            f'Файлов со старыми именами: {len(renamed)}, уникальных: {len(renamed) - duplicates}, '
+            f'дубликатов: {duplicates} ({freed / 1024 / 1024:.1f} МБ), товаров обновлено: {updated}'
+        )
+        message = f'Готово за {time.perf_counter() - started:.1f} с'
+        if options['dry_run']:
+            message += ' (проверка, файлы и база не изменены)'
+        self.stdout.write(self.style.SUCCESS(f'✅ {message}'))
+
+    def walk(self, directory):
+        """Имена файлов каталога и подкаталогов, еще не переименованных по содержимому"""
+        try:
+            directories, files = product_image_storage.listdir(directory)
+        except FileNotFoundError:
+            return
+        for filename in sorted(files):
+            name = posixpath.join(directory, filename)
+            if not is_hashed_name(name):
+                yield name
+        for subdirectory in sorted(directories):
+            subdirectory = posixpath.join(directory, subdirectory)
+            # Уменьшенные копии именуются по исходнику и не переименовываются
+            if subdirectory != VARIANTS_DIR:
+                yield from self.walk(subdirectory)
+
+    def update_products(self, renamed, batch_size):
+        """Один UPDATE ... CASE на пачку старых имен"""
+        names = list(renamed)
+        updated = 0
+        for start in range(0, len(names), batch_size):
+            batch = names[start:start + batch_size]
+            updated += Product.objects.filter(image__in=batch).update(
+                image=Case(
+                    *[When(image=name, then=Value(renamed[name])) for name in batch],
+                    default='image',
+                    output_field=Product._meta.get_field('image'),
+                ),
+            )
+        return updated
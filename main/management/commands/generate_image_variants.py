@@ -0,0 +1,30 @@
+# main/management/commands/generate_image_variants.py
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import image_variants
+from main.models import Product
+from main.storage import is_hashed_name
+
+
+class Command(BaseCommand):
+    help = ('Строит недостающие уменьшенные копии изображений товаров (WebP и JPEG) в пуле процессов. '
+            'Изображения со старыми именами пропускаются: сначала запустите dedupe_product_images')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Количество процессов')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        names = set(Product.objects.exclude(image='').values_list('image', flat=True).distinct())
+        hashed = sorted(name for name in names if is_hashed_name(name))
+        written = image_variants.generate(hashed, workers=options['workers'])
+        if len(hashed) < len(names):
+            self.stdout.write(self.style.WARNING(
+                f'ℹ️ Изображений со старыми именами: {len(names) - len(hashed)}'
+            ))
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ Изображений: {len(hashed)}, построено копий: {written} за {time.perf_counter() - started:.1f} с'
+        ))
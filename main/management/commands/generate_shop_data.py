@@ -0,0 +1,246 @@
+# main/management/commands/generate_shop_data.py
+import io
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, time as dt_time, timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from main import search
+from main.models import Cart, CartItem, Category, CustomUser, Order, OrderItem, Product
+from main.signals import products_updated
+
+ADJECTIVES = ['Веселый', 'Пушистый', 'Большой', 'Маленький', 'Умный', 'Яркий', 'Мягкий',
+              'Волшебный', 'Звездный', 'Радужный', 'Озорной', 'Добрый']
+NOUNS = {
+    'plush': ['медвежонок', 'зайчик', 'котенок', 'щенок', 'единорог', 'дракончик'],
+    'constructor': ['конструктор "Город"', 'конструктор "Ферма"', 'набор "Космос"', 'набор "Замок"'],
+    'doll': ['кукла', 'пупс', 'кукольный домик', 'набор одежды для куклы'],
+    'educational': ['пазл', 'сортер', 'бизиборд', 'набор "Азбука"', 'лото'],
+    'creative': ['набор для лепки', 'набор для рисования', 'набор "Бусины"', 'раскраска'],
+}
+DEFAULT_NOUNS = ['игрушка', 'набор', 'игровой комплект']
+COUNTRIES = [('Россия', 50), ('Китай', 30), ('Германия', 8), ('Дания', 7), ('Польша', 5)]
+FIRST_NAMES = ['Анна', 'Мария', 'Елена', 'Ольга', 'Иван', 'Петр', 'Алексей', 'Дмитрий', 'Наталья', 'Сергей']
+LAST_NAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Волков', 'Соколов', 'Морозов', 'Лебедев']
+
+# Заказы чаще оформляют днем и вечером
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 1, 2, 3, 4, 5, 6, 6, 7, 7, 6, 6, 6, 7, 8, 9, 9, 7, 4, 2]
+
+# Заказы старше двух недель уже закрыты, свежие распределены по всем статусам
+OLD_STATUSES = [('completed', 85), ('cancelled', 15)]
+RECENT_STATUSES = [('pending', 35), ('processing', 35), ('completed', 20), ('cancelled', 10)]
+RECENT_DAYS = 14
+
+
+@contextmanager
+def disable_auto_now(*fields):
+    """Позволяет задать даты создания вручную при bulk_create"""
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def weighted(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+class Command(BaseCommand):
+    help = 'Заполняет базу синтетическими товарами, пользователями и заказами для нагрузочных тестов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--users', type=int, default=50_000)
+        parser.add_argument('--orders', type=int, default=1_000_000)
+        parser.add_argument('--max-order-items', type=int, default=5)
+        parser.add_argument('--cart-share', type=float, default=0.3,
+                            help='Доля пользователей с непустой корзиной')
+        parser.add_argument('--days', type=int, default=730, help='За сколько дней генерировать историю')
+        parser.add_argument('--end-date', help='Последний день истории в формате ГГГГ-ММ-ДД (по умолчанию сегодня)')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--password', default='password', help='Пароль всех сгенерированных пользователей')
+        parser.add_argument('--username-prefix', default='gen')
+
+    def handle(self, *args, **options):
+        self.seed = options['seed']
+        self.rng = random.Random(self.seed)
+        self.batch_size = options['batch_size']
+        self.prefix = f"{options['username_prefix']}{options['seed']}-"
+        if CustomUser.objects.filter(username__startswith=self.prefix).exists():
+            raise CommandError(f'Пользователи с префиксом "{self.prefix}" уже созданы, выберите другой --seed')
+
+        if options['end_date']:
+            end_day = datetime.strptime(options['end_date'], '%Y-%m-%d').date()
+        else:
+            end_day = timezone.localdate()
+        self.end = timezone.make_aware(datetime.combine(end_day, dt_time.max))
+        self.days = options['days']
+
+        call_command('create_categories', stdout=io.StringIO())
+        self.categories = list(Category.objects.filter(is_active=True).order_by('id'))
+        if not self.categories:
+            raise CommandError('Нет активных категорий')
+
+        started = time.perf_counter()
+        products = self.generate_products(options['products'])
+        user_ids = self.generate_users(options['users'], options['password'])
+        self.generate_carts(user_ids, products, options['cart_share'])
+        self.generate_orders(options['orders'], user_ids, products, options['max_order_items'])
+
+        # bulk_create не отправляет post_save - сбрасываем кеш каталога вручную
+        products_updated.send(sender=Product)
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ Данные созданы за {time.perf_counter() - started:.1f} с'
+        ))
+
+    def random_moment(self):
+        """Случайный момент истории: чем ближе к концу периода, тем больше заказов"""
+        age = self.days * self.rng.random() ** 1.5
+        moment = self.end - timedelta(days=int(age))
+        hour = self.rng.choices(range(24), HOUR_WEIGHTS)[0]
+        return moment.replace(hour=hour, minute=self.rng.randrange(60), second=self.rng.randrange(60),
+                              microsecond=0)
+
+    def report(self, label, done, total, started):
+        elapsed = time.perf_counter() - started
+        rate = done / elapsed if elapsed else 0
+        self.stdout.write(f'{label}: {done}/{total} ({rate:.0f} строк/с)')
+
+    def generate_products(self, count):
+        """Создает товары и возвращает список (id, цена) для заказов и корзин"""
+        started = time.perf_counter()
+        created = []
+        with disable_auto_now(Product._meta.get_field('created_at')):
+            for start in range(0, count, self.batch_size):
+                batch = []
+                for i in range(start, min(start + self.batch_size, count)):
+                    category = self.categories[i % len(self.categories)]
+                    nouns = NOUNS.get(category.slug, DEFAULT_NOUNS)
+                    # Цены распределены логнормально: много недорогих игрушек и немного дорогих
+                    price = Decimal(min(max(self.rng.lognormvariate(7, 0.6), 99), 49999)).quantize(Decimal('1'))
+                    stock = 0 if self.rng.random() < 0.05 else self.rng.randint(1, 200)
+                    batch.append(Product(
+                        name=f'{self.rng.choice(ADJECTIVES)} {self.rng.choice(nouns)} №{i + 1}',
+                        price=price,
+                        category=category,
+                        year=self.end.year - self.rng.randint(0, 5),
+                        country=weighted(self.rng, COUNTRIES),
+                        model=f'GEN-{i + 1:06d}',
+                        stock_quantity=stock,
+                        in_stock=stock > 0,
+                        is_published=self.rng.random() > 0.03,
+                        created_at=self.random_moment(),
+                    ))
+                with transaction.atomic():
+                    batch = Product.objects.bulk_create(batch, batch_size=self.batch_size)
+                    # bulk_create не отправляет post_save - индекс поиска обновляется здесь
+                    search.index_instances(batch)
+                created.extend(batch)
+                self.report('Товары', len(created), count, started)
+        return [(product.id, product.price) for product in created]
+
+    def generate_users(self, count, password):
+        started = time.perf_counter()
+        # Хеширование намеренно медленное, поэтому считаем хеш один раз
+        # с фиксированной солью: результат не зависит от запуска
+        password_hash = make_password(password, salt=f'generated{self.seed}')
+        user_ids = []
+        for start in range(0, count, self.batch_size):
+            batch = []
+            for i in range(start, min(start + self.batch_size, count)):
+                last_name = self.rng.choice(LAST_NAMES)
+                first_name = self.rng.choice(FIRST_NAMES)
+                if first_name.endswith('а'):
+                    last_name += 'а'
+                batch.append(CustomUser(
+                    username=f'{self.prefix}{i + 1}',
+                    email=f'{self.prefix}{i + 1}@example.com',
+                    first_name=first_name,
+                    last_name=last_name,
+                    password=password_hash,
+                    date_joined=self.end - timedelta(days=self.days + self.rng.randint(0, 365)),
+                ))
+            with transaction.atomic():
+                user_ids.extend(user.id for user in CustomUser.objects.bulk_create(batch, batch_size=self.batch_size))
+            self.report('Пользователи', len(user_ids), count, started)
+        return user_ids
+
+    def generate_carts(self, user_ids, products, cart_share):
+        started = time.perf_counter()
+        items_total = 0
+        for start in range(0, len(user_ids), self.batch_size):
+            with transaction.atomic():
+                carts = Cart.objects.bulk_create(
+                    [Cart(user_id=user_id) for user_id in user_ids[start:start + self.batch_size]],
+                    batch_size=self.batch_size,
+                )
+                items = []
+                for cart in carts:
+                    if self.rng.random() >= cart_share:
+                        continue
+                    for product_id, price in self.rng.sample(products, min(self.rng.randint(1, 8), len(products))):
+                        items.append(CartItem(cart=cart, product_id=product_id, quantity=self.rng.randint(1, 3)))
+                CartItem.objects.bulk_create(items, batch_size=self.batch_size)
+            items_total += len(items)
+            self.report('Корзины', start + len(carts), len(user_ids), started)
+        self.stdout.write(f'Элементов корзин: {items_total}')
+
+    def popular_product(self, products):
+        # Спрос смещен к небольшой доле популярных товаров
+        return products[int(len(products) * self.rng.random() ** 3)]
+
+    def generate_orders(self, count, user_ids, products, max_items):
+        if not products or not user_ids:
+            return
+        started = time.perf_counter()
+        items_total = 0
+        order_fields = [Order._meta.get_field('created_at'), Order._meta.get_field('updated_at')]
+        with disable_auto_now(*order_fields):
+            for start in range(0, count, self.batch_size):
+                orders = []
+                order_lines = []
+                for _ in range(min(self.batch_size, count - start)):
+                    lines = {}
+                    for _ in range(self.rng.randint(1, max_items)):
+                        product_id, price = self.popular_product(products)
+                        lines[product_id] = (price, self.rng.randint(1, 3))
+                    created_at = self.random_moment()
+                    recent = (self.end - created_at).days < RECENT_DAYS
+                    status = weighted(self.rng, RECENT_STATUSES if recent else OLD_STATUSES)
+                    updated_at = created_at
+                    if status != 'pending':
+                        updated_at = min(created_at + timedelta(hours=self.rng.randint(1, 72)), self.end)
+                    orders.append(Order(
+                        user_id=self.rng.choice(user_ids),
+                        total_price=sum(price * quantity for price, quantity in lines.values()),
+                        status=status,
+                        cancellation_reason='Нет в наличии' if status == 'cancelled' else '',
+                        created_at=created_at,
+                        updated_at=updated_at,
+                    ))
+                    order_lines.append(lines)
+
+                with transaction.atomic():
+                    Order.objects.bulk_create(orders, batch_size=self.batch_size)
+                    items = [
+                        OrderItem(order_id=order.id, product_id=product_id, quantity=quantity, price=price)
+                        for order, lines in zip(orders, order_lines)
+                        for product_id, (price, quantity) in lines.items()
+                    ]
+                    OrderItem.objects.bulk_create(items, batch_size=self.batch_size)
+                items_total += len(items)
+                self.report('Заказы', start + len(orders), count, started)
+        self.stdout.write(f'Элементов заказов: {items_total}')
@@ -0,0 +1,286 @@
+# main/management/commands/import_products.py
+import csv
+import io
+import json
+import sys
+import time
+from decimal import Decimal, InvalidOperation
+from pathlib import PurePosixPath
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from main import inventory, search
+from main.models import Category, Product
+from main.signals import products_updated
+from main.storage import product_image_storage
+
+IMAGE_DIR = 'products'
+
+TRUE_VALUES = {'1', 'true', 'yes', 'да', 'y'}
+FALSE_VALUES = {'0', 'false', 'no', 'нет', 'n', ''}
+
+
+def parse_price(value):
+    try:
+        price = Decimal(str(value).replace(' ', '').replace(',', '.')).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError(f'некорректная цена "{value}"')
+    if price < 0:
+        raise ValueError('отрицательная цена')
+    return price
+
+
+def parse_int(value):
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        raise ValueError(f'ожидается целое число, получено "{value}"')
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError(f'ожидается да/нет, получено "{value}"')
+
+
+def parse_text(value):
+    return str(value).strip()
+
+
+# Поля, которые можно задать в прайс-листе, и функции разбора значений
+FIELDS = {
+    'name': parse_text,
+    'price': parse_price,
+    'description': parse_text,
+    'year': parse_int,
+    'country': parse_text,
+    'model': parse_text,
+    'stock_quantity': parse_int,
+    'is_published': parse_bool,
+}
+REQUIRED_FOR_NEW = ('name', 'price', 'category', 'year')
+
+# Поля, которые обновляются у существующих товаров. Остаток существующих
+# товаров меняется не здесь, а корректировкой через журнал движений
+UPDATE_FIELDS = [field for field in FIELDS if field != 'stock_quantity'] + ['category', 'image']
+COPY_ATTRS = [Product._meta.get_field(field).attname for field in UPDATE_FIELDS]
+NEW_PRODUCT_DEFAULTS = {
+    attname: Product._meta.get_field(attname).get_default() for attname in COPY_ATTRS + ['stock_quantity']
+}
+
+
+class RowError(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Загружает или обновляет товары из прайс-листа CSV или JSONL по артикулу (sku)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл прайс-листа или "-" для чтения из stdin')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Формат файла (по умолчанию определяется по расширению)')
+        parser.add_argument('--delimiter', default=',', help='Разделитель столбцов CSV')
+        parser.add_argument('--encoding', default='utf-8-sig')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--dry-run', action='store_true', help='Проверить файл без записи в базу')
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or ('jsonl' if options['path'].endswith(('.jsonl', '.json')) else 'csv')
+        self.categories = dict(Category.objects.values_list('slug', 'id'))
+        self.images = self.load_image_names()
+        self.hashed_images = {}
+        self.dry_run = options['dry_run']
+        self.stats = {'created': 0, 'updated': 0, 'unchanged': 0, 'errors': 0}
+        self.missing_images = 0
+
+        started = time.perf_counter()
+        processed = 0
+        batch = []
+        with self.open(options['path'], options['encoding']) as f:
+            for line_number, row in self.read_rows(f, fmt, options['delimiter']):
+                processed += 1
+                batch.append((line_number, row))
+                if len(batch) >= options['batch_size']:
+                    self.import_batch(batch)
+                    batch = []
+                    self.report(processed, started)
+            if batch:
+                self.import_batch(batch)
+                self.report(processed, started)
+
+        if not self.dry_run and (self.stats['created'] or self.stats['updated']):
+            # bulk_create не отправляет post_save - сбрасываем кеш каталога один раз
+            products_updated.send(sender=Product)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'Создано: {self.stats["created"]}, обновлено: {self.stats["updated"]}, '
+            f'без изменений: {self.stats["unchanged"]}, с ошибками: {self.stats["errors"]}'
+        )
+        if self.missing_images:
+            self.stdout.write(self.style.WARNING(f'ℹ️ Не найдено изображений: {self.missing_images}'))
+        message = f'Обработано {processed} строк за {elapsed:.1f} с'
+        if self.dry_run:
+            message += ' (проверка, база не изменена)'
+        self.stdout.write(self.style.SUCCESS(f'✅ {message}'))
+
+    def open(self, path, encoding):
+        if path == '-':
+            return io.TextIOWrapper(sys.stdin.buffer, encoding=encoding, newline='')
+        try:
+            return open(path, encoding=encoding, newline='')
+        except OSError as e:
+            raise CommandError(f'Не удалось открыть {path}: {e}')
+
+    def read_rows(self, f, fmt, delimiter):
+        """Построчно читает файл, не загружая его в память целиком"""
+        if fmt == 'csv':
+            reader = csv.DictReader(f, delimiter=delimiter)
+            if not reader.fieldnames or 'sku' not in reader.fieldnames:
+                raise CommandError('В CSV нет столбца sku')
+            for row in reader:
+                yield reader.line_num, {key: value for key, value in row.items() if key and value is not None}
+            return
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                self.row_error(line_number, f'некорректный JSON: {e}')
+                continue
+            if not isinstance(row, dict):
+                self.row_error(line_number, 'строка должна быть объектом JSON')
+                continue
+            yield line_number, row
+
+    def load_image_names(self):
+        """Имена файлов в products/ читаются один раз, а не проверяются для каждой строки"""
+        try:
+            directories, files = product_image_storage.listdir(IMAGE_DIR)
+        except (FileNotFoundError, NotImplementedError):
+            return set()
+        return set(files)
+
+    def hashed_image(self, name):
+        """Имя изображения в хранилище по содержимому; каждый файл читается один раз за импорт"""
+        if name not in self.hashed_images:
+            path = f'{IMAGE_DIR}/{name}'
+            with product_image_storage.open(path) as f:
+                self.hashed_images[name] = (
+                    product_image_storage.hashed_name(path, f) if self.dry_run
+                    else product_image_storage.save(path, f)
+                )
+        return self.hashed_images[name]
+
+    def row_error(self, line_number, message):
+        self.stats['errors'] += 1
+        if self.stats['errors'] <= 20:
+            self.stderr.write(f'Строка {line_number}: {message}')
+        elif self.stats['errors'] == 21:
+            self.stderr.write('Остальные ошибки не выводятся')
+
+    def build(self, row, current):
+        """Значения полей товара из строки прайс-листа; current - текущие значения или None для нового товара"""
+        sku = parse_text(row.get('sku', ''))
+        if not sku:
+            raise RowError('не указан артикул')
+        values = {}
+        for field, parse in FIELDS.items():
+            # Пустая ячейка означает "оставить как есть"
+            if row.get(field, '') != '':
+                try:
+                    values[field] = parse(row[field])
+                except ValueError as e:
+                    raise RowError(f'{field}: {e}')
+
+        if row.get('category'):
+            slug = parse_text(row['category'])
+            if slug not in self.categories:
+                raise RowError(f'неизвестная категория "{slug}"')
+            values['category_id'] = self.categories[slug]
+
+        if row.get('image'):
+            name = PurePosixPath(parse_text(row['image'])).name
+            if name in self.images:
+                values['image'] = self.hashed_image(name)
+            else:
+                self.missing_images += 1
+
+        if current is None:
+            missing = [field for field in REQUIRED_FOR_NEW
+                       if (field if field != 'category' else 'category_id') not in values]
+            if missing:
+                raise RowError(f'для нового товара не хватает полей: {", ".join(missing)}')
+        return sku, values
+
+    def import_batch(self, batch):
+        skus = [str(row.get('sku', '')).strip() for line_number, row in batch]
+        # Текущие значения читаются словарями: создавать 100k моделей ради
+        # сравнения заметно дольше, чем сама запись
+        existing, product_ids = {}, {}
+        current_rows = inventory.with_available(
+            Product.objects.filter(sku__in=[sku for sku in skus if sku])
+        ).values('sku', 'id', 'on_hand_quantity', *COPY_ATTRS)
+        for values in current_rows:
+            sku = values.pop('sku')
+            product_ids[sku] = values.pop('id')
+            values['stock_quantity'] = values.pop('on_hand_quantity')
+            existing[sku] = values
+
+        products = {}
+        for (line_number, row), sku in zip(batch, skus):
+            # Если артикул повторяется в файле, более поздняя строка дополняет предыдущую
+            current = products.get(sku) or existing.get(sku)
+            try:
+                sku, values = self.build(row, current)
+            except RowError as e:
+                self.row_error(line_number, e)
+                continue
+            products[sku] = {**(current or NEW_PRODUCT_DEFAULTS), **values}
+
+        to_write, stock_targets = [], {}
+        for sku, attrs in products.items():
+            old = existing.get(sku)
+            if old is None:
+                self.stats['created'] += 1
+                # То же правило, что в Product.save
+                to_write.append(Product(sku=sku, in_stock=attrs['stock_quantity'] > 0, **attrs))
+                continue
+            if old == attrs:
+                self.stats['unchanged'] += 1
+                continue
+            self.stats['updated'] += 1
+            if attrs['stock_quantity'] != old['stock_quantity']:
+                stock_targets[product_ids[sku]] = attrs['stock_quantity']
+            if any(attrs[attname] != old[attname] for attname in COPY_ATTRS):
+                # Объект без id: существующая строка находится по sku в ON CONFLICT
+                to_write.append(Product(sku=sku, **attrs))
+
+        if self.dry_run:
+            return
+        with transaction.atomic():
+            if to_write:
+                # Один INSERT ... ON CONFLICT (sku) DO UPDATE на пачку
+                Product.objects.bulk_create(
+                    to_write,
+                    update_conflicts=True,
+                    unique_fields=['sku'],
+                    update_fields=UPDATE_FIELDS,
+                )
+                # bulk_create не отправляет post_save - индекс поиска обновляется здесь
+                search.index_products(
+                    Product.objects.filter(sku__in=[product.sku for product in to_write]).values_list('id', flat=True)
+                )
+            inventory.stock_take(stock_targets, comment='Импорт прайс-листа')
+
+    def report(self, processed, started):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Обработано строк: {processed} ({processed / elapsed:.0f} строк/с)')
@@ -0,0 +1,22 @@
+# main/management/commands/rebuild_search_index.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main import search
+
+
+class Command(BaseCommand):
+    help = 'Строит полнотекстовый индекс товаров заново (после изменения стеммера или загрузки в обход ORM)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if not search.is_enabled():
+            raise CommandError('Полнотекстовый индекс поддерживается только для SQLite')
+        started = time.perf_counter()
+        total = search.rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ Проиндексировано товаров: {total} за {time.perf_counter() - started:.1f} с'
+        ))
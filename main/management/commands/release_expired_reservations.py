@@ -0,0 +1,35 @@
+# main/management/commands/release_expired_reservations.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import inventory, metrics
+
+
+class Command(BaseCommand):
+    help = 'Снимает истекшие резервы товаров в корзинах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Сколько резервов снимать одним запросом')
+        parser.add_argument('--interval', type=float,
+                            help='Повторять каждые N секунд вместо однократного запуска')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            total = 0
+            while True:
+                released = inventory.release_expired(limit=options['batch_size'])
+                total += released
+                if released < options['batch_size']:
+                    break
+            if total:
+                metrics.reservations_released.inc(total)
+            if total or not options['interval']:
+                self.stdout.write(self.style.SUCCESS(
+                    f'✅ Снято резервов: {total} за {time.perf_counter() - started:.2f} с'
+                ))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
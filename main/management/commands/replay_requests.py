@@ -0,0 +1,289 @@
+# main/management/commands/replay_requests.py
+import http.client
+import io
+import json
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import quote, unquote_to_bytes, urlencode, urlsplit
+from wsgiref.util import setup_testing_defaults
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.urls import Resolver404, resolve, reverse
+
+from main import benchmark
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class WSGITransport:
+    """Вызывает WSGI-приложение проекта в текущем процессе"""
+
+    def __init__(self, host):
+        from toyshop.wsgi import application
+        self.application = application
+        self.host = host
+
+    def send(self, method, path, headers, body):
+        url = urlsplit(path)
+        environ = {
+            'REQUEST_METHOD': method,
+            # WSGI передает путь байтами UTF-8, декодированными как latin-1 (PEP 3333)
+            'PATH_INFO': unquote_to_bytes(url.path).decode('iso-8859-1'),
+            'QUERY_STRING': url.query,
+            'HTTP_HOST': self.host,
+            'SERVER_NAME': self.host.split(':')[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            environ[key if key == 'CONTENT_TYPE' else f'HTTP_{key}'] = value
+        setup_testing_defaults(environ)
+
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = response_headers
+
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            result = self.application(environ, start_response)
+            try:
+                content = b''.join(result)
+            finally:
+                # close() отправляет request_finished, как и настоящий сервер
+                result.close()
+        return response['status'], response['headers'], content, counter.count
+
+
+class HTTPTransport:
+    """Отправляет запросы на запущенный сервер, по одному соединению на поток"""
+
+    def __init__(self, base_url):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.local = threading.local()
+
+    def send(self, method, path, headers, body):
+        for attempt in (1, 2):
+            if getattr(self.local, 'connection', None) is None:
+                self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.local.connection.request(method, path, body=body, headers=headers)
+                response = self.local.connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # Сервер закрыл keep-alive соединение - переподключаемся один раз
+                self.local.connection.close()
+                self.local.connection = None
+                if attempt == 2:
+                    raise
+                continue
+            queries = benchmark.server_timing_queries(response.getheader('Server-Timing'))
+            return response.status, response.getheaders(), content, queries
+
+
+class Session:
+    """Cookie и CSRF-токен одного пользователя"""
+
+    def __init__(self):
+        # Django принимает несоленый секрет одинаковым в cookie и заголовке,
+        # поэтому получать форму ради токена не нужно. После входа Django
+        # выдает новый секрет, и заголовок берет его из обновленной cookie
+        self.cookies = {settings.CSRF_COOKIE_NAME: secrets.token_hex(16)}
+        self.lock = threading.Lock()
+
+    def headers(self):
+        return {
+            'Cookie': '; '.join(f'{name}={value}' for name, value in self.cookies.items()),
+            'X-CSRFToken': self.cookies.get(settings.CSRF_COOKIE_NAME, ''),
+        }
+
+    def update(self, response_headers):
+        for name, value in response_headers:
+            if name.lower() != 'set-cookie':
+                continue
+            for morsel in SimpleCookie(value).values():
+                if morsel['max-age'] == '0' or morsel.value == '':
+                    self.cookies.pop(morsel.key, None)
+                else:
+                    self.cookies[morsel.key] = morsel.value
+
+
+def encode_body(record):
+    body = record.get('body')
+    if body is None:
+        return b'', {}
+    if isinstance(body, dict):
+        return urlencode(body, doseq=True).encode(), {'Content-Type': 'application/x-www-form-urlencoded'}
+    return str(body).encode(), {'Content-Type': record.get('content_type', 'application/octet-stream')}
+
+
+def encode_path(path):
+    """Кодирует не-ASCII символы пути и запроса (/catalog/?q=кукла), уже закодированные не трогает"""
+    return quote(path, safe='/?&=%:+,;@')
+
+
+def url_name(path):
+    try:
+        return resolve(urlsplit(path).path).view_name
+    except Resolver404:
+        return 'unresolved'
+
+
+class Command(BaseCommand):
+    help = 'Воспроизводит запросы из JSONL-файла и выводит задержки, пропускную способность и ошибки по URL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('records', help='JSONL-файл: по записи {"method", "path", "user", "body"} на строку')
+        parser.add_argument('--url', help='Адрес запущенного сервера, например http://127.0.0.1:8000. '
+                                          'Без него запросы выполняются WSGI-приложением в этом процессе')
+        parser.add_argument('--host', default='localhost', help='Заголовок Host в режиме без сервера')
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--repeat', type=int, default=1, help='Сколько раз проиграть файл')
+        parser.add_argument('--warmup', type=int, default=0, help='Сколько первых записей выполнить без замера')
+        parser.add_argument('--password', default='password',
+                            help='Пароль пользователей, если в записи не указан свой')
+        parser.add_argument('--output', help='Сохранить результат в JSON')
+        parser.add_argument('--compare', help='JSON предыдущего прогона для сравнения')
+
+    def handle(self, *args, **options):
+        records = self.load(options['records'])
+        if options['url']:
+            self.transport = HTTPTransport(options['url'])
+            mode = f'http {options["url"]}'
+        else:
+            self.transport = WSGITransport(options['host'])
+            mode = 'wsgi'
+        self.password = options['password']
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+        warmup, records = records[:options['warmup']], records * options['repeat']
+        for record in warmup:
+            self.replay(record)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            samples = list(executor.map(self.replay, records))
+        wall_time = time.perf_counter() - started
+
+        summary = benchmark.summarize(samples, wall_time)
+        self.stdout.write(f'Режим: {mode}, запросов: {len(samples)}, '
+                          f'{len(samples) / wall_time:.1f} запр/с за {wall_time:.1f} с')
+        self.print_summary(summary)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump({
+                    'mode': mode,
+                    'concurrency': options['concurrency'],
+                    'requests': len(samples),
+                    'wall_time': round(wall_time, 3),
+                    'summary': summary,
+                }, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'✅ Результат сохранен в {options["output"]}'))
+
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as f:
+                baseline = json.load(f)['summary']
+            self.print_comparison(benchmark.compare(baseline, summary))
+
+    def load(self, path):
+        records = []
+        with open(path, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise CommandError(f'Строка {number}: {e}')
+                if 'path' not in record:
+                    raise CommandError(f'Строка {number}: нет поля "path"')
+                records.append(record)
+        if not records:
+            raise CommandError('В файле нет записей')
+        return records
+
+    def session_for(self, record):
+        username = record.get('user')
+        if not username:
+            return Session()
+        with self.sessions_lock:
+            session = self.sessions.setdefault(username, Session())
+        with session.lock:
+            if settings.SESSION_COOKIE_NAME not in session.cookies:
+                body = urlencode({'username': username, 'password': record.get('password', self.password)})
+                status, headers, content, queries = self.transport.send('POST', reverse('login'), {
+                    **session.headers(),
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                }, body.encode())
+                session.update(headers)
+                if settings.SESSION_COOKIE_NAME not in session.cookies:
+                    raise CommandError(f'Не удалось войти как {username}: {content[:200]!r}')
+        return session
+
+    def replay(self, record):
+        session = self.session_for(record)
+        method = record.get('method', 'GET').upper()
+        body, headers = encode_body(record)
+        headers.update(session.headers())
+        headers.update(record.get('headers', {}))
+
+        status, queries = None, None
+        started = time.perf_counter()
+        try:
+            status, response_headers, content, queries = self.transport.send(
+                method, encode_path(record['path']), headers, body,
+            )
+            session.update(response_headers)
+        except Exception as e:
+            # Ошибка одного запроса учитывается в отчете и не прерывает прогон
+            self.stderr.write(f'{method} {record["path"]}: {e!r}')
+        return {
+            'url_name': url_name(record['path']),
+            'time_ms': (time.perf_counter() - started) * 1000,
+            'status': status,
+            'queries': queries,
+        }
+
+    def print_summary(self, summary):
+        self.stdout.write(f'{"URL":<40}{"запросов":>9}{"запр/с":>9}{"p50":>9}{"p95":>9}{"p99":>9}'
+                          f'{"SQL":>7}{"ошибки":>8}')
+        for name, row in summary.items():
+            queries = '-' if row['queries'] is None else f'{row["queries"]:g}'
+            self.stdout.write(
+                f'{name:<40}{row["requests"]:>9}{row["rps"]:>9.1f}{row["p50_ms"]:>9.1f}{row["p95_ms"]:>9.1f}'
+                f'{row["p99_ms"]:>9.1f}{queries:>7}{row["error_rate"]:>8.1%}'
+            )
+
+    def print_comparison(self, diff):
+        self.stdout.write('')
+        self.stdout.write('Изменение относительно базового прогона, %:')
+        self.stdout.write(f'{"URL":<40}{"запр/с":>9}{"p50":>9}{"p95":>9}{"p99":>9}{"SQL":>9}')
+        for name, row in diff.items():
+            if row is None:
+                self.stdout.write(f'{name:<40}  есть только в одном из прогонов')
+                continue
+            cells = ''.join(
+                f'{"-" if row[key] is None else f"{row[key]:+.1f}":>9}'
+                for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries')
+            )
+            style = self.style.ERROR if (row['p95_ms'] or 0) > 10 else self.style.SUCCESS
+            self.stdout.write(style(f'{name:<40}{cells}'))
@@ -0,0 +1,33 @@
+# main/management/commands/snapshot_stock.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from main import inventory
+
+
+class Command(BaseCommand):
+    help = 'Переносит неучтенные движения журнала в остатки товаров (Product.stock_quantity)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Сколько движений учитывать в одной транзакции')
+        parser.add_argument('--interval', type=float,
+                            help='Повторять каждые N секунд вместо однократного запуска')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            total = 0
+            while True:
+                folded = inventory.fold(limit=options['batch_size'])
+                total += folded
+                if folded < options['batch_size']:
+                    break
+            if total or not options['interval']:
+                self.stdout.write(self.style.SUCCESS(
+                    f'✅ Учтено движений: {total} за {time.perf_counter() - started:.2f} с'
+                ))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,63 @@
+# main/management/commands/warm_catalog_cache.py
+from urllib.parse import urlencode
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.urls import reverse
+
+from main import catalog, catalog_cache, views
+from main.models import Category
+
+
+class Command(BaseCommand):
+    help = 'Прогревает кеш каталога после деплоя: карточки, результаты запросов и страницы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=3,
+                            help='Сколько первых страниц каталога прогревать для каждой категории')
+        parser.add_argument('--host', default='127.0.0.1:8000',
+                            help='Хост, под которым сайт открывают пользователи (входит в ключ кеша страниц)')
+        parser.add_argument('--with-details', action='store_true',
+                            help='Также прогреть страницы всех товаров')
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if catalog_cache.is_process_local():
+            raise CommandError('Кеш локален для процесса команды и не виден сайту: настройте общий кеш в CACHES')
+        stats_before = catalog_cache.get_stats()
+        version = catalog_cache.get_version()
+
+        # Карточки всех товаров каталога
+        product_ids = list(catalog.base_queryset().order_by('id').values_list('id', flat=True))
+        chunk_size = options['chunk_size']
+        for start in range(0, len(product_ids), chunk_size):
+            catalog_cache.render_cards(product_ids[start:start + chunk_size], version)
+        self.stdout.write(f'Карточек товаров: {len(product_ids)}')
+
+        # Первые страницы каталога целиком и по каждой категории
+        slugs = Category.objects.filter(is_active=True).values_list('slug', flat=True)
+        param_sets = [{}] + [{'category': slug} for slug in slugs]
+        factory = RequestFactory(HTTP_HOST=options['host'])
+        catalog_url = reverse('catalog')
+        pages = 0
+        for params in param_sets:
+            for number in range(1, options['pages'] + 1):
+                query = urlencode({**params, 'page': number}) if number > 1 else urlencode(params)
+                url = f'{catalog_url}?{query}' if query else catalog_url
+                views.catalog(factory.get(url))
+                pages += 1
+        self.stdout.write(f'Страниц каталога: {pages}')
+
+        views.home(factory.get(reverse('home')))
+        views.contacts(factory.get(reverse('contacts')))
+
+        if options['with_details']:
+            for product_id in product_ids:
+                views.product_detail(factory.get(reverse('product_detail', args=[product_id])), product_id=product_id)
+            self.stdout.write(f'Страниц товаров: {len(product_ids)}')
+
+        for kind, values in catalog_cache.get_stats().items():
+            hits = values['hits'] - stats_before[kind]['hits']
+            misses = values['misses'] - stats_before[kind]['misses']
+            self.stdout.write(f'{kind}: попаданий {hits}, промахов {misses}')
+        self.stdout.write(self.style.SUCCESS('✅ Кеш каталога прогрет'))
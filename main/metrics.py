@@ -0,0 +1,312 @@
+"""
+Счетчики и гистограммы магазина в формате Prometheus.
+
+Каждый процесс копит значения в памяти и периодически сохраняет снимок
+в отдельный файл каталога METRICS_DIR. При чтении /metrics/ снимки всех
+процессов суммируются, поэтому метрики не зависят от того, какой
+воркер обработал запрос. Снимки остановленных процессов переносятся
+в общий архив, чтобы счетчики не уменьшались после перезапуска
+воркеров, а число файлов не росло (на POSIX: перенос идет под fcntl-блокировкой).
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+
+# Границы гистограмм в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Сумма снимков завершившихся процессов
+ARCHIVE_NAME = 'archive.json'
+
+logger = logging.getLogger(__name__)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, registry, name, help_text, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name}: ожидаются метки {self.labelnames}, получены {tuple(labels)}')
+        return json.dumps([str(labels[name]) for name in self.labelnames], ensure_ascii=False)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.changed()
+
+    def get(self, **labels):
+        """Значение в текущем процессе"""
+        return self.values.get(self.key(labels), 0)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.registry.lock:
+            data = self.values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data['buckets'][index] += 1
+            data['sum'] += value
+            data['count'] += 1
+        self.registry.changed()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        # Запись файла снимка: запросы, таймер и collect() сохраняют снимок
+        # по очереди, и более старый снимок не перезапишет более новый
+        self.write_lock = threading.Lock()
+        self.flush_timer = None
+        self.last_flush = 0.0
+        self.process_id = None
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.metrics.setdefault(name, Counter(self, name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(self, name, help_text, labelnames, buckets))
+
+    def directory(self):
+        return Path(settings.METRICS_DIR)
+
+    def snapshot_path(self):
+        # pid может повториться после перезапуска, поэтому добавляем случайный суффикс
+        if self.process_id != os.getpid():
+            self.process_id = os.getpid()
+            self.suffix = uuid.uuid4().hex[:8]
+        return self.directory() / f'{self.process_id}-{self.suffix}.json'
+
+    def changed(self):
+        """Сохраняет снимок не чаще раза в METRICS_FLUSH_INTERVAL секунд"""
+        delay = self.last_flush + settings.METRICS_FLUSH_INTERVAL - time.monotonic()
+        if delay <= 0:
+            self.flush()
+            return
+        with self.lock:
+            if self.flush_timer is None:
+                # Отложенное сохранение, чтобы последние события не потерялись,
+                # если процесс больше не получит запросов
+                self.flush_timer = threading.Timer(delay, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                if self.flush_timer is not None:
+                    self.flush_timer.cancel()
+                    self.flush_timer = None
+                snapshot = {name: {'values': metric.values} for name, metric in self.metrics.items()}
+                data = json.dumps(snapshot, ensure_ascii=False)
+                self.last_flush = time.monotonic()
+            try:
+                _write_atomic(self.snapshot_path(), data)
+            except OSError as e:
+                # Метрики не должны ломать запрос, в котором изменился счетчик
+                logger.warning('Не удалось сохранить снимок метрик: %s', e)
+
+    def merge(self, totals, snapshot):
+        """Добавляет значения снимка к totals ({метрика: {метки: значение}})"""
+        for name, data in snapshot.items():
+            metric = self.metrics.get(name)
+            if metric is None:
+                continue
+            for key, value in data['values'].items():
+                if metric.kind == 'counter':
+                    totals[name][key] = totals[name].get(key, 0) + value
+                    continue
+                total = totals[name].setdefault(
+                    key, {'buckets': [0] * len(metric.buckets), 'sum': 0.0, 'count': 0}
+                )
+                if len(value['buckets']) != len(metric.buckets):
+                    continue
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], value['buckets'])]
+                total['sum'] += value['sum']
+                total['count'] += value['count']
+
+    def archive_dead_snapshots(self):
+        """Переносит снимки завершившихся процессов в ARCHIVE_NAME и удаляет их"""
+        try:
+            import fcntl
+        except ImportError:
+            # Без блокировки два процесса перенесли бы один снимок дважды; на
+            # платформах без fcntl снимки остановленных процессов остаются как есть
+            return
+        directory = self.directory()
+        dead = [path for path in directory.glob('*-*.json') if not _process_alive(path)]
+        if not dead:
+            return
+        # Архив пополняют все процессы, читающие /metrics/, поэтому под общей блокировкой
+        with open(directory / 'archive.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            archive_path = directory / ARCHIVE_NAME
+            totals = {name: {} for name in self.metrics}
+            self.merge(totals, _read_snapshot(archive_path) or {})
+            merged = []
+            for path in dead:
+                snapshot = _read_snapshot(path)
+                # Снимок уже перенес другой процесс
+                if snapshot is not None:
+                    self.merge(totals, snapshot)
+                    merged.append(path)
+            if not merged:
+                return
+            archive = {name: {'values': values} for name, values in totals.items()}
+            _write_atomic(archive_path, json.dumps(archive, ensure_ascii=False))
+            for path in merged:
+                path.unlink(missing_ok=True)
+
+    def collect(self):
+        """Суммирует снимки всех процессов"""
+        self.flush()
+        try:
+            self.archive_dead_snapshots()
+        except OSError as e:
+            logger.warning('Не удалось перенести снимки метрик в архив: %s', e)
+        totals = {name: {} for name in self.metrics}
+        for path in sorted(self.directory().glob('*.json')):
+            snapshot = _read_snapshot(path)
+            if snapshot is not None:
+                self.merge(totals, snapshot)
+        return totals
+
+    def render(self):
+        """Текстовый формат Prometheus"""
+        lines = []
+        totals = self.collect()
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f'# HELP {name} {metric.help_text}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, value in sorted(totals[name].items()):
+                labels = dict(zip(metric.labelnames, json.loads(key)))
+                if metric.kind == 'counter':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+                    continue
+                for bound, count in zip(metric.buckets, value['buckets']):
+                    lines.append(f'{name}_bucket{_format_labels({**labels, "le": _format_number(bound)})} {count}')
+                lines.append(f'{name}_bucket{_format_labels({**labels, "le": "+Inf"})} {value["count"]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_number(value["sum"])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Сбрасывает значения текущего процесса и удаляет все снимки (для тестов)"""
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            for metric in self.metrics.values():
+                metric.values.clear()
+        for path in self.directory().glob('*.json'):
+            path.unlink()
+
+
+def _process_alive(path):
+    """Жив ли процесс, записавший снимок <pid>-<суффикс>.json (каталог метрик у каждого сервера свой)"""
+    try:
+        pid = int(path.stem.split('-', 1)[0])
+    except ValueError:
+        return True
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Процесс есть, но принадлежит другому пользователю
+        return True
+    return True
+
+
+def _read_snapshot(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Запись через временный файл: читатель не увидит снимок наполовину
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(data, encoding='utf-8')
+    os.replace(tmp_path, path)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+checkout_seconds = registry.histogram(
+    'shop_checkout_seconds', 'Время оформления заказа', ['result'],
+)
+checkouts = registry.counter(
+    'shop_checkouts_total', 'Попытки оформления заказа по результату: success, conflict, empty, invalid', ['result'],
+)
+stock_conflicts = registry.counter(
+    'shop_stock_conflict_items_total', 'Позиции корзины, отклоненные из-за нехватки товара на складе',
+)
+cart_events = registry.counter(
+    'shop_cart_events_total', 'Изменения корзины', ['action', 'result'],
+)
+reservations_released = registry.counter(
+    'shop_cart_reservations_released_total', 'Истекшие резервы корзин, снятые release_expired_reservations',
+)
+order_transitions = registry.counter(
+    'shop_order_transitions_total', 'Переходы статусов заказов', ['action'],
+)
+catalog_cache_events = registry.counter(
+    'shop_catalog_cache_total', 'Обращения к кешу каталога: page, query, card; hit или miss', ['kind', 'result'],
+)
+request_seconds = registry.histogram(
+    'shop_request_seconds', 'Время обработки запросов из выборки PerformanceMiddleware', ['url_name', 'method'],
+)
+
+
+def record_checkout(result, started, conflicts=0):
+    """Учитывает попытку оформления заказа, начатую в момент started (time.perf_counter)"""
+    checkout_seconds.observe(time.perf_counter() - started, result=result)
+    checkouts.inc(result=result)
+    if conflicts:
+        stock_conflicts.inc(conflicts)
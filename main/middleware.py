@@ -0,0 +1,169 @@
+"""
+Замер времени обработки запросов.
+
+Для каждого запроса из выборки считаются SQL-запросы, время рендера
+шаблонов, время хеширования паролей и время view. Итоги уходят в
+заголовок Server-Timing и в JSONL-лог main.performance.
+"""
+import heapq
+import json
+import logging
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hashers
+from django.db import connection
+from django.template.backends.django import Template as DjangoTemplate
+from django.urls import resolve, Resolver404
+
+from . import metrics
+
+logger = logging.getLogger('main.performance')
+
+_current = ContextVar('performance_stats', default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.view_started = None
+        self.view_ms = 0.0
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        # Самые медленные запросы: куча из (время, порядковый номер, SQL)
+        self.slow_sql = []
+        self.timers = {'template': 0.0, 'hashing': 0.0}
+        self.depth = {'template': 0, 'hashing': 0}
+
+    def add_sql(self, sql, duration_ms):
+        self.sql_count += 1
+        self.sql_ms += duration_ms
+        item = (duration_ms, self.sql_count, sql)
+        if len(self.slow_sql) < settings.PERF_SLOW_QUERIES:
+            heapq.heappush(self.slow_sql, item)
+        else:
+            heapq.heappushpop(self.slow_sql, item)
+
+    def __call__(self, execute, sql, params, many, context):
+        """Обертка выполнения SQL для connection.execute_wrapper"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add_sql(sql, (time.perf_counter() - started) * 1000)
+
+
+def _timed(kind, func):
+    """Добавляет время вызова к счетчику kind текущего запроса; вложенные вызовы не считаются дважды"""
+    def wrapper(*args, **kwargs):
+        stats = _current.get()
+        if stats is None:
+            return func(*args, **kwargs)
+        stats.depth[kind] += 1
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.depth[kind] -= 1
+            if not stats.depth[kind]:
+                stats.timers[kind] += (time.perf_counter() - started) * 1000
+    wrapper.perf_timed = True
+    return wrapper
+
+
+def _instrument(cls, name, kind):
+    method = getattr(cls, name)
+    if not getattr(method, 'perf_timed', False):
+        setattr(cls, name, _timed(kind, method))
+
+
+def install_timers():
+    """Один раз оборачивает рендер шаблонов и хешеры паролей"""
+    _instrument(DjangoTemplate, 'render', 'template')
+    for hasher in get_hashers():
+        _instrument(type(hasher), 'encode', 'hashing')
+        _instrument(type(hasher), 'verify', 'hashing')
+
+
+class PerformanceMiddleware:
+    """
+    Должен стоять первым в MIDDLEWARE, чтобы учитывать время всех
+    остальных middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        install_timers()
+
+    def __call__(self, request):
+        if random.random() >= settings.PERF_SAMPLE_RATE:
+            return self.get_response(request)
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        try:
+            with connection.execute_wrapper(stats):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        if stats.view_started is not None and not stats.view_ms:
+            stats.view_ms = (time.perf_counter() - stats.view_started) * 1000
+        total_ms = (time.perf_counter() - stats.started) * 1000
+
+        response['Server-Timing'] = ', '.join([
+            f'total;dur={total_ms:.1f}',
+            f'view;dur={stats.view_ms:.1f}',
+            f'sql;dur={stats.sql_ms:.1f};desc="{stats.sql_count} queries"',
+            f'template;dur={stats.timers["template"]:.1f}',
+            f'hashing;dur={stats.timers["hashing"]:.1f}',
+        ])
+        self.log(request, response, stats, total_ms)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = _current.get()
+        if stats is not None:
+            stats.view_started = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # Для TemplateResponse (админка) рендер идет после view -
+        # фиксируем время view до него
+        stats = _current.get()
+        if stats is not None and stats.view_started is not None:
+            stats.view_ms = (time.perf_counter() - stats.view_started) * 1000
+        return response
+
+    def log(self, request, response, stats, total_ms):
+        url_name = self.url_name(request)
+        metrics.request_seconds.observe(total_ms / 1000, url_name=url_name or '', method=request.method)
+        record = {
+            'time': round(time.time(), 3),
+            'method': request.method,
+            'path': request.path,
+            'url_name': url_name,
+            'status': response.status_code,
+            'total_ms': round(total_ms, 2),
+            'view_ms': round(stats.view_ms, 2),
+            'sql_count': stats.sql_count,
+            'sql_ms': round(stats.sql_ms, 2),
+            'template_ms': round(stats.timers['template'], 2),
+            'hashing_ms': round(stats.timers['hashing'], 2),
+        }
+        if total_ms >= settings.PERF_SLOW_REQUEST_MS:
+            record['slow_sql'] = [
+                {'ms': round(duration, 2), 'sql': sql}
+                for duration, number, sql in sorted(stats.slow_sql, reverse=True)
+            ]
+        logger.info(json.dumps(record, ensure_ascii=False))
+
+    def url_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            try:
+                match = resolve(request.path_info)
+            except Resolver404:
+                return None
+        return match.view_name
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.7 on 2026-10-17 20:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_product_sku'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('sell', 'Продажа'), ('return', 'Возврат'), ('adjust', 'Корректировка')], max_length=10, verbose_name='Тип')),
+                ('quantity', models.IntegerField(verbose_name='Изменение количества')),
+                ('comment', models.CharField(blank=True, default='', max_length=200, verbose_name='Комментарий')),
+                ('applied', models.BooleanField(default=False, verbose_name='Учтено в остатке товара')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.order', verbose_name='Заказ')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Движение товара',
+                'verbose_name_plural': 'Движения товаров',
+                'ordering': ['-id'],
+                'indexes': [models.Index(condition=models.Q(('applied', False)), fields=['product', 'quantity'], name='movement_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-17 20:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_stock_movement_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cartitem',
+            name='reserved_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Резерв до'),
+        ),
+        migrations.AddIndex(
+            model_name='cartitem',
+            index=models.Index(condition=models.Q(('reserved_until__isnull', False)), fields=['product', 'reserved_until', 'quantity'], name='cartitem_hold_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cartitem',
+            index=models.Index(condition=models.Q(('reserved_until__isnull', False)), fields=['reserved_until'], name='cartitem_hold_expiry_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-17 20:22
+
+from django.db import migrations, models
+import main.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_order_history_keyset_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='image',
+            field=models.ImageField(blank=True, storage=main.storage.ContentAddressedStorage(), upload_to='products/', verbose_name='Изображение'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+# Схема задана здесь, а не берется из main.search: миграция должна создавать
+# ту же таблицу, что и в момент написания. Индекс заполняется после migrate
+# (signals.build_search_index) текущим кодом стеммера
+
+
+def create_index(apps, schema_editor):
+    # FTS5 есть только в SQLite; на других СУБД поиск работает без индекса
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        'CREATE VIRTUAL TABLE main_product_search USING fts5(name, model, sku, description, tokenize="unicode61")'
+    )
+    # Ранжирование по умолчанию для столбца rank: bm25 с весами полей
+    schema_editor.execute(
+        "INSERT INTO main_product_search (main_product_search, rank) VALUES ('rank', 'bm25(10.0, 4.0, 4.0, 1.0)')"
+    )
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE main_product_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_product_image_storage'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -1,7 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 import re
 from django.core.exceptions import ValidationError
+from .storage import product_image_storage
 
 class CustomUser(AbstractUser):
     patronymic = models.CharField(
@@ -39,6 +41,10 @@ class CustomUser(AbstractUser):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        indexes = [
+            # Проверка уникальности email при регистрации
+            models.Index(fields=['email'], name='user_email_idx'),
+        ]
 
 class Category(models.Model):
     name = models.CharField(max_length=100, verbose_name='Название категории')
@@ -56,11 +62,15 @@ class Category(models.Model):
         return self.name
 
 class Product(models.Model):
+    # Артикул поставщика - ключ для импорта прайс-листов
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True, verbose_name='Артикул')
     name = models.CharField(max_length=200, verbose_name='Наименование')
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Цена')
     description = models.TextField(verbose_name='Описание', blank=True)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, verbose_name='Категория')
-    image = models.ImageField(upload_to='products/', verbose_name='Изображение', blank=True)
+    image = models.ImageField(
+        upload_to='products/', storage=product_image_storage, verbose_name='Изображение', blank=True,
+    )
     year = models.IntegerField(verbose_name='Год производства')
     country = models.CharField(max_length=100, verbose_name='Страна производства', default='Россия')
     model = models.CharField(max_length=100, verbose_name='Модель', blank=True)
@@ -73,15 +83,48 @@ class Product(models.Model):
         verbose_name = 'Товар'
         verbose_name_plural = 'Товары'
         ordering = ['-created_at']
+        indexes = [
+            # Каталог показывает только опубликованные товары в наличии,
+            # поэтому индексы частичные и не содержат скрытых товаров
+            models.Index(
+                fields=['category', '-created_at'],
+                name='product_category_recent_idx',
+                condition=models.Q(in_stock=True, is_published=True),
+            ),
+            models.Index(
+                fields=['-created_at'],
+                name='product_recent_idx',
+                condition=models.Q(in_stock=True, is_published=True),
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
     def save(self, *args, **kwargs):
-        """При сохранении автоматически обновляем поле in_stock"""
-        self.in_stock = self.stock_quantity > 0
+        """При сохранении автоматически обновляем поле in_stock по остатку на складе"""
+        self.in_stock = self.on_hand > 0
         super().save(*args, **kwargs)
 
+    def _stock_levels(self):
+        # Для списков товаров значения заранее проставляет inventory.attach_available
+        if 'available_quantity' in self.__dict__:
+            return self.on_hand_quantity, self.available_quantity
+        if self.pk is None:
+            return self.stock_quantity, self.stock_quantity
+        from .inventory import stock_levels
+        return stock_levels([self.pk])[self.pk]
+
+    @property
+    def on_hand(self):
+        """Остаток на складе: снимок stock_quantity плюс еще не учтенные движения"""
+        return self._stock_levels()[0]
+
+    @property
+    def available(self):
+        """Остаток, который еще можно зарезервировать: на складе минус активные резервы корзин"""
+        return self._stock_levels()[1]
+
 class Cart(models.Model):
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, verbose_name='Пользователь')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
@@ -104,11 +147,26 @@ class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items', verbose_name='Корзина')
     product = models.ForeignKey(Product, on_delete=models.CASCADE, verbose_name='Товар')
     quantity = models.PositiveIntegerField(default=1, verbose_name='Количество')
+    reserved_until = models.DateTimeField(null=True, blank=True, verbose_name='Резерв до')
 
     class Meta:
         verbose_name = 'Элемент корзины'
         verbose_name_plural = 'Элементы корзины'
         unique_together = ['cart', 'product']
+        indexes = [
+            # Сумма активных резервов товара читается только из индекса
+            models.Index(
+                fields=['product', 'reserved_until', 'quantity'],
+                name='cartitem_hold_idx',
+                condition=models.Q(reserved_until__isnull=False),
+            ),
+            # Поиск истекших резервов для release_expired_reservations
+            models.Index(
+                fields=['reserved_until'],
+                name='cartitem_hold_expiry_idx',
+                condition=models.Q(reserved_until__isnull=False),
+            ),
+        ]
 
     def __str__(self):
         return f'{self.product.name} x {self.quantity}'
@@ -116,6 +174,21 @@ class CartItem(models.Model):
     def get_total_price(self):
         return self.product.price * self.quantity
 
+    @property
+    def held_quantity(self):
+        """Сколько единиц товара удерживает активный резерв этого элемента"""
+        if self.reserved_until and self.reserved_until > timezone.now():
+            return self.quantity
+        return 0
+
+    @property
+    def max_quantity(self):
+        """Сколько единиц может быть в этом элементе: свободный остаток плюс свой резерв"""
+        return max(self.product.available + self.held_quantity, 0)
+
+    def exceeds_stock(self):
+        return self.quantity > self.max_quantity
+
 class Order(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Новый'),
@@ -136,6 +209,14 @@ class Order(models.Model):
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
         ordering = ['-created_at']
+        indexes = [
+            # История заказов в профиле: страницы по ключу (created_at, id)
+            models.Index(fields=['user', '-created_at', '-id'], name='order_user_recent_idx'),
+            # Фильтр по статусу в админке
+            models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+            # Фильтр по дате в админке и экспорт за период
+            models.Index(fields=['created_at'], name='order_created_idx'),
+        ]
 
     def __str__(self):
         return f'Заказ #{self.id} от {self.user.username}'
@@ -157,4 +238,43 @@ class OrderItem(models.Model):
         verbose_name_plural = 'Элементы заказа'
 
     def __str__(self):
-        return f'{self.product.name} x {self.quantity}'
\ No newline at end of file
+        return f'{self.product.name} x {self.quantity}'
+
+class StockMovement(models.Model):
+    """
+    Запись журнала остатков. Строки только добавляются: продажа и отмена
+    заказа не переписывают строку товара, а снимок Product.stock_quantity
+    периодически догоняет журнал (команда snapshot_stock).
+    """
+    SELL = 'sell'
+    RETURN = 'return'
+    ADJUST = 'adjust'
+    KIND_CHOICES = [
+        (SELL, 'Продажа'),
+        (RETURN, 'Возврат'),
+        (ADJUST, 'Корректировка'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, verbose_name='Товар')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='Заказ')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name='Тип')
+    quantity = models.IntegerField(verbose_name='Изменение количества')
+    comment = models.CharField(max_length=200, blank=True, default='', verbose_name='Комментарий')
+    applied = models.BooleanField(default=False, verbose_name='Учтено в остатке товара')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата')
+
+    class Meta:
+        verbose_name = 'Движение товара'
+        verbose_name_plural = 'Движения товаров'
+        ordering = ['-id']
+        indexes = [
+            # Сумма неучтенных движений при расчете доступного остатка
+            models.Index(
+                fields=['product', 'quantity'],
+                name='movement_pending_idx',
+                condition=models.Q(applied=False),
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.get_kind_display()} {self.product_id}: {self.quantity:+d}'
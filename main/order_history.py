@@ -0,0 +1,100 @@
+"""
+История заказов в профиле.
+
+Заказы листаются по ключу (created_at, id), а не по номеру страницы:
+следующая страница начинается сразу после последнего показанного
+заказа, поэтому запрос читает из индекса order_user_recent_idx ровно
+одну страницу, сколько бы заказов ни было у покупателя. Состав заказа
+загружается отдельно, когда покупатель раскрывает заказ.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import Order, OrderItem
+
+PAGE_SIZE = 20
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def encode_cursor(order):
+    """Позиция заказа в списке: микросекунды created_at и id"""
+    return f'{(order.created_at - EPOCH) // MICROSECOND}-{order.id}'
+
+
+def decode_cursor(cursor):
+    """Разбирает курсор; некорректный курсор означает первую страницу"""
+    try:
+        microseconds, order_id = (int(part) for part in cursor.split('-'))
+        return EPOCH + microseconds * MICROSECOND, order_id
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def _items_subquery(aggregate):
+    return Coalesce(
+        Subquery(
+            OrderItem.objects
+            .filter(order_id=OuterRef('pk'))
+            .order_by()
+            .values('order_id')
+            .annotate(total=aggregate)
+            .values('total'),
+            output_field=IntegerField(),
+        ),
+        Value(0),
+    )
+
+
+def orders_queryset(user):
+    """Заказы пользователя в порядке ключа страниц, с количеством позиций и товаров"""
+    return (
+        Order.objects
+        .filter(user=user)
+        .annotate(
+            # Подзапросы по индексу order_id считаются только для заказов страницы
+            items_count=_items_subquery(Count('id')),
+            items_quantity=_items_subquery(Sum('quantity')),
+        )
+        .order_by('-created_at', '-id')
+    )
+
+
+def orders_page(user, cursor=None, page_size=PAGE_SIZE):
+    """
+    Одна страница заказов пользователя.
+    Возвращает заказы и курсор следующей страницы (None, если она последняя).
+    """
+    orders = orders_queryset(user)
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        created_at, order_id = position
+        orders = orders.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=order_id))
+
+    # Лишний заказ показывает, есть ли следующая страница, без COUNT
+    orders = list(orders[:page_size + 1])
+    next_cursor = encode_cursor(orders[page_size - 1]) if len(orders) > page_size else None
+    return orders[:page_size], next_cursor
+
+
+def order_items(user, order_id):
+    """Состав заказа пользователя одним запросом; пустой список, если заказ чужой"""
+    items = (
+        OrderItem.objects
+        .filter(order_id=order_id, order__user=user)
+        .order_by('id')
+        .values('product_id', 'product__name', 'quantity', 'price')
+    )
+    return [
+        {
+            'product_id': item['product_id'],
+            'name': item['product__name'],
+            'quantity': item['quantity'],
+            'price': str(item['price']),
+            'total': str(item['price'] * item['quantity']),
+        }
+        for item in items
+    ]
@@ -0,0 +1,70 @@
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from . import inventory, metrics
+from .models import Order, OrderItem, StockMovement
+
+# Допустимые переходы статусов заказа: действие -> (из какого статуса, в какой)
+TRANSITIONS = {
+    'confirm': ('pending', 'processing'),
+    'complete': ('processing', 'completed'),
+    'cancel': ('pending', 'cancelled'),
+}
+
+# Переходы, при которых товары возвращаются на склад
+RESTOCK_ACTIONS = {'cancel'}
+
+
+def restock_orders(order_ids):
+    """Возвращает на склад товары заказов: по строке журнала на товар каждого заказа"""
+    returned = (
+        OrderItem.objects
+        .filter(order_id__in=order_ids)
+        .values('order_id', 'product_id')
+        .annotate(quantity=Sum('quantity'))
+        .order_by('order_id', 'product_id')
+    )
+    inventory.record([
+        StockMovement(
+            product_id=row['product_id'],
+            order_id=row['order_id'],
+            kind=StockMovement.RETURN,
+            quantity=row['quantity'],
+        )
+        for row in returned
+    ])
+
+
+def apply_transition(orders, action, reason=None):
+    """
+    Применяет переход статуса ко всем подходящим заказам из queryset.
+
+    Заказы в другом статусе пропускаются. Возвращает количество
+    измененных заказов.
+    """
+    source, target = TRANSITIONS[action]
+
+    with transaction.atomic():
+        # Блокируем строки через подзапрос: queryset из админки может
+        # содержать DISTINCT или JOIN, несовместимые с FOR UPDATE
+        order_ids = list(
+            Order.objects
+            .filter(id__in=orders.values('id'), status=source)
+            .select_for_update()
+            .order_by('id')
+            .values_list('id', flat=True)
+        )
+        if not order_ids:
+            return 0
+
+        if action in RESTOCK_ACTIONS:
+            restock_orders(order_ids)
+
+        changes = {'status': target, 'updated_at': timezone.now()}
+        if reason is not None:
+            changes['cancellation_reason'] = reason
+        Order.objects.filter(id__in=order_ids).update(**changes)
+
+    metrics.order_transitions.inc(len(order_ids), action=action)
+    return len(order_ids)
@@ -0,0 +1,40 @@
+"""
+Недавнее подтверждение пароля.
+
+После входа или заказа с паролем пользователь получает подписанную
+cookie с меткой времени. Пока она моложе REAUTH_GRACE_PERIOD секунд,
+следующий заказ оформляется без повторного ввода пароля, и PBKDF2 не
+считается еще раз. Cookie привязана к сессии: после выхода, смены
+пароля или входа с другого устройства она перестает действовать.
+"""
+from django.conf import settings
+
+COOKIE_SALT = 'main.reauth'
+
+
+def _token(request):
+    return f'{request.user.pk}:{request.session.session_key}'
+
+
+def is_recent(request):
+    """Пароль подтвержден в этой сессии не раньше REAUTH_GRACE_PERIOD секунд назад"""
+    if not request.user.is_authenticated or not request.session.session_key:
+        return False
+    # Подпись с меткой времени: просроченная или поддельная cookie дает default
+    value = request.get_signed_cookie(
+        settings.REAUTH_COOKIE, default=None, salt=COOKIE_SALT, max_age=settings.REAUTH_GRACE_PERIOD,
+    )
+    return value == _token(request)
+
+
+def remember(request, response):
+    """Отмечает в ответе, что пользователь только что ввел пароль"""
+    response.set_signed_cookie(
+        settings.REAUTH_COOKIE,
+        _token(request),
+        salt=COOKIE_SALT,
+        max_age=settings.REAUTH_GRACE_PERIOD,
+        httponly=True,
+        samesite='Strict',
+    )
+    return response
@@ -0,0 +1,280 @@
+"""
+Полнотекстовый поиск товаров.
+
+Название, модель, артикул и описание товара разбиваются на слова, слова
+приводятся к основе стеммером Портера для русского языка («куклы»,
+«куклой» -> «кукл») и хранятся в таблице SQLite FTS5 main_product_search
+с rowid = id товара. Запрос приводится к основам так же, каждое слово
+ищется как префикс основы, результаты ранжируются bm25 с весами полей
+(веса заданы в миграции).
+
+Индекс обновляется сигналами post_save/post_delete товара; массовые
+загрузки через bulk_create обновляют его сами: import_products -
+index_products по id, generate_shop_data - index_instances по созданным
+объектам. Пустой индекс заполняется после migrate, полная перестройка -
+команда rebuild_search_index. На других СУБД таблицы нет, и поиск
+сводится к icontains по названию.
+"""
+import re
+from functools import lru_cache
+
+from django.db import connection, transaction
+
+TABLE = 'main_product_search'
+
+# Поля товара в порядке столбцов таблицы индекса
+FIELDS = ('name', 'model', 'sku', 'description')
+
+# Веса столбцов для bm25: совпадение в названии важнее, чем в описании
+WEIGHTS = (10.0, 4.0, 4.0, 1.0)
+
+BATCH_SIZE = 1000
+
+# Больше совпадений не ранжируется по bm25, см. rank_ordering
+RANK_LIMIT = 2000
+
+WORD_RE = re.compile(r'[0-9a-zа-я]+')
+
+# Предлоги и союзы не индексируются: «куклы и мишки» не должно требовать слова на «и»
+STOP_WORDS = frozenset('а без в во для до за и из или к ко на над не о об от по под при с со у'.split())
+
+# Стеммер Портера для русского языка (snowballstem.org/algorithms/russian/stemmer.html).
+# Окончания ищутся в RV - части слова после первой гласной; группы с (?<=[ая])
+# снимаются, только если перед ними стоит «а» или «я», которые остаются в основе
+VOWELS = 'аеиоуыэюя'
+RV_RE = re.compile(f'^(.*?[{VOWELS}])(.*)$')
+PERFECTIVE_GERUND_RE = re.compile(r'(?:(?:ив|ивши|ившись|ыв|ывши|ывшись)|(?<=[ая])(?:в|вши|вшись))$')
+REFLEXIVE_RE = re.compile(r'(?:ся|сь)$')
+ADJECTIVE_RE = re.compile(
+    r'(?:ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$'
+)
+PARTICIPLE_RE = re.compile(r'(?:(?:ивш|ывш|ующ)|(?<=[ая])(?:ем|нн|вш|ющ|щ))$')
+VERB_RE = re.compile(
+    r'(?:(?:ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)'
+    r'|(?<=[ая])(?:ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно))$'
+)
+NOUN_RE = re.compile(
+    r'(?:а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$'
+)
+R2_DERIVATIONAL_RE = re.compile(f'[{VOWELS}][^{VOWELS}].*[{VOWELS}][^{VOWELS}].*ость?$')
+DERIVATIONAL_RE = re.compile(r'ость?$')
+SUPERLATIVE_RE = re.compile(r'(?:ейше|ейш)$')
+
+
+def _strip(pattern, text):
+    """(текст без окончания, найдено ли окончание)"""
+    stripped = pattern.sub('', text, count=1)
+    return stripped, stripped != text
+
+
+@lru_cache(maxsize=100_000)
+def stem(word):
+    """Основа слова; слова не на кириллице возвращаются без изменений"""
+    word = word.lower().replace('ё', 'е')
+    match = RV_RE.match(word)
+    if match is None:
+        return word
+    prefix, rv = match.groups()
+
+    # Шаг 1: деепричастие, иначе возвратная частица и прилагательное, глагол или существительное
+    rv, found = _strip(PERFECTIVE_GERUND_RE, rv)
+    if not found:
+        rv, found = _strip(REFLEXIVE_RE, rv)
+        rv, found = _strip(ADJECTIVE_RE, rv)
+        if found:
+            rv, found = _strip(PARTICIPLE_RE, rv)
+        else:
+            rv, found = _strip(VERB_RE, rv)
+            if not found:
+                rv, found = _strip(NOUN_RE, rv)
+    # Шаг 2
+    if rv.endswith('и'):
+        rv = rv[:-1]
+    # Шаг 3: словообразовательное окончание в R2
+    if R2_DERIVATIONAL_RE.search(prefix + rv):
+        rv, found = _strip(DERIVATIONAL_RE, rv)
+    # Шаг 4
+    if rv.endswith('ь'):
+        rv = rv[:-1]
+    else:
+        rv, found = _strip(SUPERLATIVE_RE, rv)
+        if rv.endswith('нн'):
+            rv = rv[:-1]
+    return prefix + rv
+
+
+def tokens(text):
+    """Основы слов текста в порядке появления"""
+    words = WORD_RE.findall(str(text).lower().replace('ё', 'е'))
+    return [stem(word) for word in words if word not in STOP_WORDS]
+
+
+def is_enabled():
+    return connection.vendor == 'sqlite'
+
+
+def match_expression(text):
+    """
+    Запрос FTS5: все слова должны встретиться, каждое как префикс основы,
+    чтобы находилось и недописанное слово. None, если слов нет.
+    Основы состоят только из букв и цифр, поэтому кавычки не экранируются.
+    """
+    stems = tokens(text)
+    if not stems:
+        return None
+    return ' '.join(f'"{token}"*' for token in dict.fromkeys(stems))
+
+
+def count_matches(text):
+    """Количество товаров в индексе, подходящих под запрос (без учета фильтров каталога)"""
+    match = match_expression(text)
+    if match is None:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT count(*) FROM {TABLE} WHERE {TABLE} MATCH %s', [match])
+        return cursor.fetchone()[0]
+
+
+def _join(queryset, match, select=None):
+    # Индекс присоединяется к запросу: SQLite идет по совпадениям FTS5 и берет
+    # товары по первичному ключу. Подзапрос id IN (...) на общих запросах
+    # вдвое медленнее: он сначала собирает все id во временный индекс
+    return queryset.extra(
+        tables=[TABLE],
+        where=[f'{TABLE}.rowid = {queryset.model._meta.db_table}.id', f'{TABLE} MATCH %s'],
+        params=[match],
+        select=select,
+    )
+
+
+def filter_queryset(queryset, text):
+    """
+    Оставляет товары, подходящие под запрос. Присоединенную таблицу
+    не видят UPDATE и DELETE, поэтому для изменения найденных товаров
+    нужен подзапрос: Product.objects.filter(pk__in=queryset.values('pk')).
+    """
+    if not is_enabled():
+        return queryset.filter(name__icontains=text)
+    match = match_expression(text)
+    if match is None:
+        return queryset.none()
+    return _join(queryset, match)
+
+
+def rank_ordering(total):
+    """
+    Сортировка найденных товаров по полю search_rank из ranked_queryset.
+    bm25 считается для каждого совпадения (около 2 мкс на строку), поэтому
+    при total > RANK_LIMIT запрос считается слишком общим: товары идут от
+    новых к старым по rowid, который FTS5 отдает в порядке индекса без сортировки.
+    """
+    if total > RANK_LIMIT:
+        return ['-search_rank']
+    return ['search_rank', '-id']
+
+
+def ranked_queryset(queryset, text, total=None):
+    """
+    Товары, подходящие под запрос, по убыванию релевантности. total - число
+    найденных товаров, если оно уже известно (например, из фасетов каталога).
+    """
+    if not is_enabled():
+        return filter_queryset(queryset, text).order_by('-id')
+    match = match_expression(text)
+    if match is None:
+        return queryset.none()
+    if total is None:
+        total = count_matches(text)
+    rank = 'rowid' if total > RANK_LIMIT else 'rank'
+    return _join(queryset, match, select={'search_rank': f'{TABLE}.{rank}'}).order_by(*rank_ordering(total))
+
+
+def _rows(products):
+    return [
+        (product['id'], *(' '.join(tokens(product[field] or '')) for field in FIELDS))
+        for product in products
+    ]
+
+
+def _write(cursor, products, replace=True):
+    # FTS5 поддерживает OR REPLACE по rowid: старая запись товара заменяется одним запросом
+    cursor.executemany(
+        f'INSERT {"OR REPLACE " if replace else ""}INTO {TABLE} (rowid, {", ".join(FIELDS)}) VALUES (%s, %s, %s, %s, %s)',
+        _rows(products),
+    )
+
+
+def _delete(cursor, product_ids):
+    cursor.execute(f'DELETE FROM {TABLE} WHERE rowid IN ({", ".join(["%s"] * len(product_ids))})', product_ids)
+
+
+def index_instances(products):
+    """Индексирует сохраненные товары без повторного чтения из базы"""
+    if not is_enabled():
+        return
+    with connection.cursor() as cursor:
+        _write(cursor, [{'id': product.pk, **{field: getattr(product, field) for field in FIELDS}}
+                        for product in products])
+
+
+def index_products(product_ids):
+    """Переиндексирует товары после массовых изменений; id удаленных товаров убираются из индекса"""
+    if not is_enabled():
+        return
+    from .models import Product
+
+    product_ids = list(product_ids)
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(product_ids), BATCH_SIZE):
+            batch = product_ids[start:start + BATCH_SIZE]
+            products = list(Product.objects.filter(id__in=batch).values('id', *FIELDS))
+            _write(cursor, products)
+            missing = set(batch) - {product['id'] for product in products}
+            if missing:
+                _delete(cursor, list(missing))
+
+
+def remove_products(product_ids):
+    if not is_enabled():
+        return
+    product_ids = list(product_ids)
+    with connection.cursor() as cursor:
+        for start in range(0, len(product_ids), BATCH_SIZE):
+            _delete(cursor, product_ids[start:start + BATCH_SIZE])
+
+
+def needs_rebuild():
+    """Таблица индекса есть, но пуста, хотя товары есть: ее только что создала миграция"""
+    if not is_enabled() or TABLE not in connection.introspection.table_names():
+        return False
+    from .models import Product
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT 1 FROM {TABLE} LIMIT 1')
+        empty = cursor.fetchone() is None
+    return empty and Product.objects.exists()
+
+
+def rebuild(batch_size=5000):
+    """Строит индекс заново по всем товарам, пачками по id. Возвращает количество товаров."""
+    if not is_enabled():
+        return 0
+    from .models import Product
+
+    total = 0
+    last_id = 0
+    # Одна транзакция: в режиме autocommit каждая строка executemany фиксировалась бы отдельно
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+        while True:
+            products = list(
+                Product.objects.filter(id__gt=last_id).order_by('id').values('id', *FIELDS)[:batch_size]
+            )
+            if not products:
+                break
+            _write(cursor, products, replace=False)
+            total += len(products)
+            last_id = products[-1]['id']
+        # Сливает сегменты индекса в один: после массовой загрузки поиск быстрее
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+    return total
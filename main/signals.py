@@ -0,0 +1,44 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import Signal, receiver
+
+from . import catalog_cache, image_variants, search
+from .models import Category, Product
+
+# Отправляется после массовых изменений товаров через queryset.update(),
+# которые не вызывают post_save
+products_updated = Signal()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(products_updated)
+def invalidate_catalog_cache(sender, **kwargs):
+    catalog_cache.invalidate()
+
+
+@receiver(post_save, sender=Product)
+def generate_image_variants(sender, instance, **kwargs):
+    """Уменьшенные копии нового изображения строятся в пуле процессов после коммита"""
+    if instance.image and image_variants.missing_variants(instance.image.name):
+        name = instance.image.name
+        transaction.on_commit(lambda: image_variants.schedule(name))
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_instances([instance])
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_index(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+
+
+@receiver(post_migrate)
+def build_search_index(sender, **kwargs):
+    """Заполняет пустой индекс поиска после миграции, которая его создала или пересоздала"""
+    if sender.name == 'main' and search.needs_rebuild():
+        search.rebuild()
@@ -0,0 +1,63 @@
+"""
+Хранилище изображений товаров с именами по содержимому.
+
+Имя файла - SHA-256 его содержимого: products/ab/ab12...ef.jpg.
+Повторная загрузка того же файла через админку возвращает уже
+сохраненное имя и ничего не пишет на диск. Файл под таким именем
+никогда не меняется, поэтому браузеры могут кешировать его на год
+(views.product_image).
+"""
+import hashlib
+import posixpath
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.utils import validate_file_name
+from django.utils.deconstruct import deconstructible
+
+# Файл хешируется кусками, чтобы большое изображение не читалось в память целиком
+HASH_CHUNK_SIZE = 64 * 1024
+
+HASHED_NAME_RE = re.compile(r'(?:^|/)([0-9a-f]{2})/\1[0-9a-f]{62}\.[0-9a-z]+$')
+
+
+def file_digest(content):
+    """SHA-256 содержимого файла Django, прочитанного кусками"""
+    digest = hashlib.sha256()
+    for chunk in content.chunks(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_hashed_name(name):
+    return bool(HASHED_NAME_RE.search(name))
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    def hashed_name(self, name, content):
+        """Имя по содержимому в том же каталоге, что и name; расширение сохраняется"""
+        digest = file_digest(content)
+        directory, filename = posixpath.split(name.replace('\\', '/'))
+        extension = posixpath.splitext(filename)[1].lower()
+        return posixpath.join(directory, digest[:2], digest + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        validate_file_name(name, allow_relative_path=True)
+        if self.exists(name):
+            return name
+        saved = self._save(name, content)
+        if saved != name:
+            # Тот же файл одновременно сохранил другой процесс,
+            # и FileSystemStorage выбрал для копии свободное имя
+            self.delete(saved)
+        return name
+
+
+product_image_storage = ContentAddressedStorage()
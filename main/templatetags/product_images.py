@@ -0,0 +1,30 @@
+from django import template
+
+from ..image_variants import FORMATS, WIDTHS, variant_name
+from ..storage import product_image_storage
+
+register = template.Library()
+
+
+@register.inclusion_tag('includes/product_picture.html')
+def product_picture(image, alt, sizes, css_class='', style='', loading=''):
+    """
+    <picture> с уменьшенными копиями WebP и JPEG: браузер выбирает ширину
+    по sizes. Изображения со старыми именами выводятся обычным <img>.
+    """
+    context = {'alt': alt, 'sizes': sizes, 'css_class': css_class, 'style': style, 'loading': loading}
+    if variant_name(image.name, WIDTHS[0], 'jpg') is None:
+        context['src'] = image.url
+        return context
+    srcsets = {
+        extension: ', '.join(
+            f'{product_image_storage.url(variant_name(image.name, width, extension))} {width}w' for width in WIDTHS
+        )
+        for extension in FORMATS
+    }
+    context.update(
+        src=product_image_storage.url(variant_name(image.name, WIDTHS[len(WIDTHS) // 2], 'jpg')),
+        webp_srcset=srcsets['webp'],
+        jpeg_srcset=srcsets['jpg'],
+    )
+    return context
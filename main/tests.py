@@ -1,3 +1,955 @@
-from django.test import TestCase
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import catalog_cache, image_variants, inventory, metrics, order_history, search
+from .signals import products_updated
+from .storage import product_image_storage
+from .models import Cart, CartItem, Category, CustomUser, Order, OrderItem, Product, StockMovement
+
+# Отчет с количеством запросов и временем ответа каждой страницы.
+# Файлы отчетов разных релизов можно сравнивать обычным diff.
+REPORT_PATH = Path(os.environ.get('QUERY_BUDGET_REPORT', settings.BASE_DIR / 'var' / 'query_budgets.json'))
+REPORT = {}
+
+PASSWORD = 'Secret-pass-123'
+
+ADMIN_PREFIX = '/adminplyshevy-mir/main/'
+
+
+# Метрики и кеш тестов не должны попадать в каталоги работающего сайта
+_metrics_dir = tempfile.TemporaryDirectory()
+_cache_dir = tempfile.TemporaryDirectory()
+_metrics_settings = override_settings(
+    METRICS_DIR=_metrics_dir.name,
+    CACHES={'default': {**settings.CACHES['default'], 'LOCATION': _cache_dir.name}},
+)
+
+
+def setUpModule():
+    _metrics_settings.enable()
+
+
+def tearDownModule():
+    metrics.registry.reset()
+    _metrics_settings.disable()
+    _metrics_dir.cleanup()
+    _cache_dir.cleanup()
+    if not REPORT:
+        return
+    REPORT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(REPORT_PATH, 'w', encoding='utf-8') as f:
+        json.dump(dict(sorted(REPORT.items())), f, ensure_ascii=False, indent=2)
+
+
+def seed_shop(products=300, customers=30, orders_per_customer=10, cart_items=20):
+    """Заполняет базу объемом данных, на котором видны N+1 запросы"""
+    categories = Category.objects.bulk_create([
+        Category(name=name, slug=slug) for name, slug in [
+            ('Плюшевые игрушки', 'plush'),
+            ('Конструкторы', 'constructor'),
+            ('Куклы', 'doll'),
+            ('Развивающие игрушки', 'educational'),
+            ('Творческие наборы', 'creative'),
+        ]
+    ])
+    Product.objects.bulk_create([
+        Product(
+            name=f'Игрушка {i}',
+            price=Decimal(100 + i),
+            category=categories[i % len(categories)],
+            year=2020 + i % 5,
+            stock_quantity=50,
+            in_stock=True,
+        )
+        for i in range(products)
+    ])
+    product_list = list(Product.objects.order_by('id'))
+
+    users = [CustomUser.objects.create_user(f'buyer{i}', f'buyer{i}@example.com', PASSWORD)
+             for i in range(customers)]
+    carts = Cart.objects.bulk_create([Cart(user=user) for user in users])
+    CartItem.objects.bulk_create([
+        CartItem(cart=cart, product=product_list[(n * 7 + k) % products], quantity=1)
+        for n, cart in enumerate(carts)
+        for k in range(cart_items)
+    ])
+
+    orders = Order.objects.bulk_create([
+        Order(user=user, total_price=Decimal('300.00'), status=['pending', 'processing', 'completed'][k % 3])
+        for user in users
+        for k in range(orders_per_customer)
+    ])
+    OrderItem.objects.bulk_create([
+        OrderItem(order=order, product=product_list[(order.id + k) % products], quantity=1, price=Decimal('100.00'))
+        for order in orders
+        for k in range(3)
+    ])
+    return users
+
+
+class QueryBudgetMixin:
+    """Проверяет точное количество запросов и записывает время ответа в отчет"""
+
+    def measure(self, name, budget, request):
+        started = time.perf_counter()
+        try:
+            with self.assertNumQueries(budget) as queries:
+                response = request()
+                if hasattr(response, 'streaming_content'):
+                    b''.join(response.streaming_content)
+        finally:
+            REPORT[name] = {
+                'budget': budget,
+                'queries': len(queries),
+                'time_ms': round((time.perf_counter() - started) * 1000, 2),
+            }
+        self.assertLess(response.status_code, 400, name)
+        return response
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class StorefrontQueryBudgetTests(QueryBudgetMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_shop()
+        cls.user = cls.users[0]
+        cls.product = Product.objects.order_by('id').first()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_home(self):
+        self.measure('home', 0, lambda: self.client.get(reverse('home')))
+
+    def test_catalog(self):
+        url = reverse('catalog')
+        self.measure('catalog', 4, lambda: self.client.get(url))
+        self.measure('catalog_cached', 0, lambda: self.client.get(url))
+        self.measure('catalog_filtered', 2, lambda: self.client.get(
+            url, {'category': 'doll', 'min_price': 150, 'sort': 'price_desc', 'page': 2}
+        ))
+
+    def test_product_detail(self):
+        url = reverse('product_detail', args=[self.product.id])
+        self.measure('product_detail', 1, lambda: self.client.get(url))
+
+    def test_contacts(self):
+        self.measure('contacts', 0, lambda: self.client.get(reverse('contacts')))
+
+    def test_header_state(self):
+        url = reverse('header_state')
+        self.measure('header_state_anonymous', 0, lambda: self.client.get(url))
+        self.client.force_login(self.user)
+        self.measure('header_state', 3, lambda: self.client.get(url))
+
+    def test_metrics(self):
+        self.measure('metrics', 0, lambda: self.client.get(reverse('metrics')))
+
+    def test_register(self):
+        url = reverse('register')
+        self.measure('register_form', 0, lambda: self.client.get(url))
+        self.measure('register', 12, lambda: self.client.post(url, {
+            'surname': 'Иванова', 'name': 'Мария', 'patronymic': '',
+            'username': 'maria-new', 'email': 'maria@example.com',
+            'password1': PASSWORD, 'password2': PASSWORD, 'rules': 'on',
+        }))
+
+    def test_login(self):
+        url = reverse('login')
+        self.measure('login_form', 0, lambda: self.client.get(url))
+        self.measure('login', 9, lambda: self.client.post(url, {
+            'username': self.user.username, 'password': PASSWORD,
+        }))
+
+    def test_logout(self):
+        self.client.force_login(self.user)
+        self.measure('logout', 4, lambda: self.client.post(reverse('logout')))
+
+    def test_cart(self):
+        self.client.force_login(self.user)
+        self.measure('cart', 4, lambda: self.client.get(reverse('cart')))
+
+    def test_checkout(self):
+        self.client.force_login(self.user)
+        # Блокировка строк товаров и чтение остатков - отдельные запросы (checkout.place_order)
+        response = self.measure('checkout', 13, lambda: self.client.post(reverse('cart'), {'password': PASSWORD}))
+        self.assertTrue(response.json()['success'])
+
+    def test_cart_endpoints(self):
+        self.client.force_login(self.user)
+        product_id = self.product.id
+        self.measure('add_to_cart', 4, lambda: self.client.post(reverse('add_to_cart', args=[product_id])))
+        self.measure('remove_from_cart', 4, lambda: self.client.post(reverse('remove_from_cart', args=[product_id])))
+        self.measure('delete_from_cart', 4, lambda: self.client.post(reverse('delete_from_cart', args=[product_id])))
+
+    def test_sync_cart(self):
+        self.client.force_login(self.user)
+        # Двадцать позиций корзины и пять новых товаров одним запросом
+        product_ids = list(Product.objects.order_by('id').values_list('id', flat=True)[:25])
+        body = json.dumps({'items': [{'product_id': product_id, 'quantity': 2} for product_id in product_ids]})
+        response = self.measure('sync_cart', 8, lambda: self.client.post(
+            reverse('sync_cart'), body, content_type='application/json'
+        ))
+        self.assertEqual(len(response.json()['items']), 25)
+
+    def test_profile(self):
+        self.client.force_login(self.user)
+        self.measure('profile', 3, lambda: self.client.get(reverse('profile')))
+        order_id = Order.objects.filter(user=self.user).values_list('id', flat=True).first()
+        response = self.measure('order_items', 3, lambda: self.client.get(reverse('order_items', args=[order_id])))
+        self.assertTrue(response.json()['items'])
+
+    def test_profile_keyset_pages(self):
+        # Заказы с одинаковым временем создания не должны теряться на границе страниц
+        tied = Order.objects.filter(user=self.user).order_by('id').values_list('id', flat=True)[:5]
+        Order.objects.filter(id__in=list(tied)).update(created_at=timezone.now())
+        seen = []
+        cursor = None
+        while True:
+            orders, cursor = order_history.orders_page(self.user, cursor, page_size=3)
+            seen += [order.id for order in orders]
+            if cursor is None:
+                break
+        expected = Order.objects.filter(user=self.user).order_by('-created_at', '-id').values_list('id', flat=True)
+        self.assertEqual(seen, list(expected))
+
+    def test_order_items_of_other_user(self):
+        self.client.force_login(self.user)
+        order = Order.objects.exclude(user=self.user).first()
+        self.assertEqual(self.client.get(reverse('order_items', args=[order.id])).status_code, 404)
+
+    def test_cancel_order(self):
+        self.client.force_login(self.user)
+        order = Order.objects.filter(user=self.user, status='pending').first()
+        url = reverse('cancel_order', args=[order.id])
+        response = self.measure('cancel_order', 9, lambda: self.client.post(url))
+        self.assertTrue(response.json()['success'])
+
+
+class CatalogCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_shop(products=30, customers=1, orders_per_customer=1, cart_items=1)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_invalidation_changes_version(self):
+        self.assertFalse(catalog_cache.is_process_local())
+        url = reverse('catalog')
+        self.client.get(url)
+        version = catalog_cache.get_version()
+        Product.objects.filter(id=Product.objects.latest('id').id).update(name='Новая игрушка')
+        products_updated.send(sender=Product)
+        self.assertNotEqual(catalog_cache.get_version(), version)
+        self.assertContains(self.client.get(url), 'Новая игрушка')
+        page_hits = catalog_cache.get_stats()['page']['hits']
+        self.client.get(url)
+        self.assertEqual(catalog_cache.get_stats()['page']['hits'], page_hits + 1)
+
+    def test_warm_refuses_process_local_cache(self):
+        call_command('warm_catalog_cache', pages=1, host='testserver', stdout=io.StringIO())
+        self.assertGreater(catalog_cache.get_stats()['card']['misses'], 0)
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with self.assertRaises(CommandError):
+                call_command('warm_catalog_cache', stdout=io.StringIO())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AdminQueryBudgetTests(QueryBudgetMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        seed_shop()
+        cls.admin = CustomUser.objects.create_superuser('admin', 'admin@example.com', PASSWORD)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def changelist(self, model):
+        return f'{ADMIN_PREFIX}{model}/'
+
+    def test_changelists(self):
+        for model, budget in [('order', 5), ('product', 6), ('category', 5), ('cart', 5),
+                              ('orderitem', 5), ('cartitem', 5), ('customuser', 5)]:
+            self.measure(f'admin_{model}_changelist', budget, lambda: self.client.get(self.changelist(model)))
+
+    def test_sorted_changelists(self):
+        self.measure('admin_order_changelist_by_items', 5,
+                     lambda: self.client.get(self.changelist('order'), {'o': '4'}))
+        self.measure('admin_cart_changelist_by_price', 5,
+                     lambda: self.client.get(self.changelist('cart'), {'o': '-5'}))
+
+    def test_order_change(self):
+        order = Order.objects.first()
+        self.measure('admin_order_change', 8, lambda: self.client.get(f'{ADMIN_PREFIX}order/{order.id}/change/'))
+
+    def run_action(self, action, queryset, **extra):
+        data = {
+            'action': action,
+            '_selected_action': list(queryset.values_list('id', flat=True)),
+            **extra,
+        }
+        return lambda: self.client.post(self.changelist('order'), data)
+
+    def test_confirm_orders(self):
+        orders = Order.objects.filter(status='pending')
+        self.measure('admin_confirm_orders', 8, self.run_action('confirm_selected_orders', orders))
+
+    def test_complete_orders(self):
+        orders = Order.objects.filter(status='processing')
+        self.measure('admin_complete_orders', 8, self.run_action('complete_selected_orders', orders))
+
+    def test_cancel_orders(self):
+        orders = Order.objects.filter(status='pending')
+        self.measure('admin_cancel_orders', 13, self.run_action(
+            'cancel_selected_orders', orders, apply='1', cancellation_reason='Нет на складе'
+        ))
+        self.assertFalse(Order.objects.filter(status='pending').exists())
+
+    def test_export_orders(self):
+        self.measure('admin_export_orders', 5, self.run_action('export_orders_csv', Order.objects.all()))
+
+    def test_export_orders_by_period(self):
+        url = f'{ADMIN_PREFIX}order/export/'
+        self.measure('admin_export_orders_by_period', 3, lambda: self.client.get(url, {
+            'export': '1', 'date_from': '2000-01-01', 'date_to': '2100-01-01',
+        }))
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MetricsEndpointTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_shop(products=20, customers=2, orders_per_customer=3, cart_items=5)
+
+    def setUp(self):
+        settings_override = override_settings(METRICS_FLUSH_INTERVAL=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+
+    def scrape(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        return response.content.decode()
+
+    def test_scrape_after_traffic(self):
+        buyer, other = self.users
+        self.client.force_login(buyer)
+        product = Product.objects.order_by('id').first()
+        self.client.post(reverse('add_to_cart', args=[product.id]))
+        self.client.post(reverse('remove_from_cart', args=[product.id]))
+        self.client.post(reverse('delete_from_cart', args=[product.id]))
+
+        # Конфликт: в корзине больше, чем на складе
+        conflict_item = CartItem.objects.filter(cart__user=buyer).select_related('product').first()
+        Product.objects.filter(id=conflict_item.product_id).update(stock_quantity=0)
+        self.assertFalse(self.client.post(reverse('cart'), {'password': PASSWORD}).json()['success'])
+        conflict_item.delete()
+        self.assertTrue(self.client.post(reverse('cart'), {'password': PASSWORD}).json()['success'])
+
+        order = Order.objects.filter(user=buyer, status='pending').first()
+        self.client.post(reverse('cancel_order', args=[order.id]))
+
+        body = self.scrape()
+        self.assertIn('shop_checkouts_total{result="conflict"} 1', body)
+        self.assertIn('shop_checkouts_total{result="success"} 1', body)
+        self.assertIn('shop_stock_conflict_items_total 1', body)
+        self.assertIn('shop_checkout_seconds_count{result="success"} 1', body)
+        self.assertIn('shop_checkout_seconds_bucket{result="conflict",le="+Inf"} 1', body)
+        self.assertIn('shop_cart_events_total{action="add",result="ok"} 1', body)
+        self.assertIn('shop_cart_events_total{action="remove",result="ok"} 1', body)
+        self.assertIn('shop_cart_events_total{action="delete",result="ok"} 1', body)
+        self.assertIn('shop_order_transitions_total{action="cancel"} 1', body)
+        self.assertIn('shop_request_seconds_count{url_name="cart",method="POST"} 2', body)
+
+    def test_sums_snapshots_of_all_processes(self):
+        metrics.order_transitions.inc(2, action='confirm')
+        other_process = {'shop_order_transitions_total': {'values': {'["confirm"]': 3}}}
+        Path(settings.METRICS_DIR, '1-other.json').write_text(json.dumps(other_process))
+        self.assertIn('shop_order_transitions_total{action="confirm"} 5', self.scrape())
+
+    def test_archives_snapshots_of_dead_processes(self):
+        metrics.order_transitions.inc(2, action='confirm')
+        # pid больше максимального в Linux - такого процесса нет
+        dead_process = {'shop_order_transitions_total': {'values': {'["confirm"]': 3}}}
+        dead_path = Path(settings.METRICS_DIR, '4194305-dead.json')
+        dead_path.write_text(json.dumps(dead_process))
+        self.assertIn('shop_order_transitions_total{action="confirm"} 5', self.scrape())
+        self.assertFalse(dead_path.exists())
+        self.assertTrue(Path(settings.METRICS_DIR, metrics.ARCHIVE_NAME).exists())
+        self.assertIn('shop_order_transitions_total{action="confirm"} 5', self.scrape())
+
+    def test_concurrent_flushes(self):
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(50):
+                    metrics.cart_events.inc(action='add', result='ok')
+                    metrics.registry.flush()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertIn('shop_cart_events_total{action="add",result="ok"} 400', self.scrape())
+
+    def test_forbidden_for_remote_anonymous(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.5')
+        self.assertEqual(response.status_code, 403)
+        self.client.force_login(CustomUser.objects.create_superuser('admin', 'admin@example.com', PASSWORD))
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.5')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class StockLedgerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Куклы', slug='doll')
+        cls.product = Product.objects.create(name='Кукла', price=Decimal('500'), category=category,
+                                             year=2024, stock_quantity=2)
+        cls.user = CustomUser.objects.create_user('buyer', 'buyer@example.com', PASSWORD)
+        cart = Cart.objects.create(user=cls.user)
+        CartItem.objects.create(cart=cart, product=cls.product, quantity=2)
+
+    def checkout(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('cart'), {'password': PASSWORD})
+        self.assertTrue(response.json()['success'])
+        return Order.objects.get(id=response.json()['order_id'])
+
+    def test_checkout_and_cancel_append_movements(self):
+        order = self.checkout()
+        self.product.refresh_from_db()
+        # Снимок не переписан, продажа записана в журнал
+        self.assertEqual(self.product.stock_quantity, 2)
+        self.assertEqual(self.product.available, 0)
+        self.assertFalse(self.product.in_stock)
+        self.assertEqual(
+            list(StockMovement.objects.values_list('kind', 'quantity', 'order_id')),
+            [(StockMovement.SELL, -2, order.id)],
+        )
+
+        self.client.post(reverse('cancel_order', args=[order.id]))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.available, 2)
+        self.assertTrue(self.product.in_stock)
+        self.assertEqual(StockMovement.objects.filter(kind=StockMovement.RETURN, order=order).count(), 1)
+
+    def test_fold_moves_pending_into_snapshot(self):
+        self.checkout()
+        self.assertEqual(inventory.fold(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 0)
+        self.assertEqual(self.product.available, 0)
+        self.assertFalse(StockMovement.objects.filter(applied=False).exists())
+        self.assertEqual(inventory.fold(), 0)
+
+    def test_stock_take_records_adjustment(self):
+        self.checkout()
+        self.assertEqual(inventory.stock_take({self.product.id: 5}, comment='Инвентаризация'), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 5)
+        self.assertEqual(self.product.available, 5)
+        self.assertTrue(self.product.in_stock)
+        adjustment = StockMovement.objects.get(kind=StockMovement.ADJUST)
+        self.assertEqual((adjustment.quantity, adjustment.applied), (5, True))
+
+    def test_changelist_edit_records_adjustment(self):
+        self.checkout()
+        self.client.force_login(CustomUser.objects.create_superuser('admin', 'admin@example.com', PASSWORD))
+        response = self.client.post(f'{ADMIN_PREFIX}product/', {
+            'form-TOTAL_FORMS': '1', 'form-INITIAL_FORMS': '1',
+            'form-0-id': self.product.id, 'form-0-price': '450', 'form-0-stock_quantity': '3',
+            'form-0-is_published': 'on', '_save': 'Сохранить',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.price, self.product.available), (Decimal('450'), 3))
+        self.assertEqual(StockMovement.objects.get(kind=StockMovement.ADJUST).quantity, 3)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CartReservationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Машинки', slug='cars')
+        cls.product = Product.objects.create(name='Машинка', price=Decimal('300'), category=category,
+                                             year=2024, stock_quantity=1)
+        cls.first = CustomUser.objects.create_user('first', 'first@example.com', PASSWORD)
+        cls.second = CustomUser.objects.create_user('second', 'second@example.com', PASSWORD)
+
+    def add(self, user):
+        self.client.force_login(user)
+        return self.client.post(reverse('add_to_cart', args=[self.product.id])).json()
+
+    def expire_holds(self):
+        CartItem.objects.update(reserved_until=timezone.now() - timedelta(seconds=1))
+
+    def test_reservation_blocks_other_carts_until_expired(self):
+        self.assertTrue(self.add(self.first)['success'])
+        self.assertEqual(self.product.available, 0)
+        self.assertEqual(self.product.on_hand, 1)
+        self.assertFalse(self.add(self.second)['success'])
+
+        self.expire_holds()
+        self.assertEqual(inventory.release_expired(), 1)
+        self.assertFalse(CartItem.objects.filter(reserved_until__isnull=False).exists())
+        self.assertTrue(self.add(self.second)['success'])
+
+    def test_add_and_remove_respect_own_reservation(self):
+        self.assertEqual(self.add(self.first)['item_quantity'], 1)
+        response = self.add(self.first)
+        self.assertFalse(response['success'])
+        self.assertIn('больше 1', response['message'])
+
+        response = self.client.post(reverse('remove_from_cart', args=[self.product.id])).json()
+        self.assertEqual((response['item_quantity'], response['cart_total']), (0, 0))
+        self.assertFalse(CartItem.objects.exists())
+        response = self.client.post(reverse('delete_from_cart', args=[self.product.id])).json()
+        self.assertFalse(response['success'])
+
+    def sync(self, items):
+        response = self.client.post(reverse('sync_cart'), json.dumps({'items': items}), content_type='application/json')
+        return response.json()
+
+    def test_sync_clamps_increase_and_deletes_zero(self):
+        self.client.force_login(self.first)
+        response = self.sync([{'product_id': self.product.id, 'delta': 3}])
+        self.assertEqual(response['items'], [{'product_id': self.product.id, 'quantity': 1, 'max_quantity': 1}])
+        self.assertEqual(response['conflicts'][0]['requested'], 3)
+        self.assertEqual(response['cart_total'], 1)
+        self.assertIsNotNone(CartItem.objects.get().reserved_until)
+
+        response = self.sync([{'product_id': self.product.id, 'quantity': 0}])
+        self.assertEqual(response['cart_total'], 0)
+        self.assertFalse(CartItem.objects.exists())
+
+        response = self.client.post(reverse('sync_cart'), '{"items": [{"product_id": "x"}]}',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_checkout_converts_reservation(self):
+        self.add(self.first)
+        response = self.client.post(reverse('cart'), {'password': PASSWORD}).json()
+        self.assertTrue(response['success'])
+        self.assertEqual(self.product.on_hand, 0)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_expired_reservation_is_rechecked_at_checkout(self):
+        self.add(self.first)
+        self.expire_holds()
+        self.add(self.second)
+        self.client.force_login(self.first)
+        response = self.client.post(reverse('cart'), {'password': PASSWORD}).json()
+        self.assertFalse(response['success'])
+        self.assertEqual(response['conflicts'][0]['available'], 0)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class GuestCartTests(QueryBudgetMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Кубики', slug='cubes')
+        cls.product = Product.objects.create(name='Кубики', price=Decimal('250'), category=category,
+                                             year=2024, stock_quantity=5)
+        cls.user = CustomUser.objects.create_user('guest', 'guest@example.com', PASSWORD)
+
+    def add(self):
+        return self.client.post(reverse('add_to_cart', args=[self.product.id]))
+
+    def test_guest_cart_lives_in_cookie(self):
+        self.measure('guest_add_to_cart', 1, self.add)
+        response = self.add()
+        self.assertEqual(response.json()['item_quantity'], 2)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertEqual(self.client.get(reverse('header_state')).json()['cart_total'], 2)
+        self.assertContains(self.client.get(reverse('cart')), 'Кубики')
+
+        response = self.client.post(reverse('cart'), {'password': PASSWORD})
+        self.assertFalse(response.json()['success'])
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies[settings.GUEST_CART_COOKIE] = f'{self.product.id}:3:forged'
+        self.assertEqual(self.client.get(reverse('header_state')).json()['cart_total'], 0)
+
+    def test_login_merges_guest_cart(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+        self.add()
+        self.add()
+
+        response = self.client.post(reverse('login'), {'username': 'guest', 'password': PASSWORD})
+        self.assertEqual(response.json()['redirect'], reverse('cart'))
+        self.assertEqual(response.cookies[settings.GUEST_CART_COOKIE].value, '')
+        item = CartItem.objects.get(cart=cart)
+        self.assertEqual(item.quantity, 3)
+        self.assertIsNotNone(item.reserved_until)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ReauthTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Мячи', slug='balls')
+        cls.product = Product.objects.create(name='Мяч', price=Decimal('150'), category=category,
+                                             year=2024, stock_quantity=10)
+        cls.user = CustomUser.objects.create_user('reauth', 'reauth@example.com', PASSWORD)
+        cls.cart = Cart.objects.create(user=cls.user)
+
+    def checkout(self, data=None):
+        CartItem.objects.get_or_create(cart=self.cart, product=self.product)
+        return self.client.post(reverse('cart'), data or {}).json()
+
+    def test_login_hashes_password_once(self):
+        with mock.patch.object(CustomUser, 'check_password', autospec=True,
+                               side_effect=CustomUser.check_password) as check_password:
+            self.client.post(reverse('login'), {'username': 'reauth', 'password': PASSWORD})
+        self.assertEqual(check_password.call_count, 1)
+
+    def test_checkout_after_login_skips_password(self):
+        self.client.post(reverse('login'), {'username': 'reauth', 'password': PASSWORD})
+        with mock.patch.object(CustomUser, 'check_password') as check_password:
+            self.assertTrue(self.checkout()['success'])
+            self.assertTrue(self.checkout()['success'])
+        check_password.assert_not_called()
+
+    def test_grace_window_is_bound_to_session_and_time(self):
+        self.client.force_login(self.user)
+        self.assertIn('password', self.checkout()['errors'])
+        self.assertTrue(self.checkout({'password': PASSWORD})['success'])
+
+        # Новая сессия того же пользователя не наследует подтверждение
+        reauth_cookie = self.client.cookies[settings.REAUTH_COOKIE].value
+        self.client.logout()
+        self.client.force_login(self.user)
+        self.client.cookies[settings.REAUTH_COOKIE] = reauth_cookie
+        self.assertIn('password', self.checkout()['errors'])
+
+        self.checkout({'password': PASSWORD})
+        with override_settings(REAUTH_GRACE_PERIOD=-1):
+            self.assertIn('password', self.checkout()['errors'])
+
+
+class MediaRootMixin:
+    """Файлы тестов сохраняются во временный MEDIA_ROOT"""
+
+    def setUp(self):
+        media_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(media_dir.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_dir.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.category = Category.objects.create(name='Куклы', slug='dolls')
+
+    def create_product(self, image):
+        return Product.objects.create(name='Кукла', price=Decimal('500'), category=self.category,
+                                      year=2024, image=image)
+
+
+class ProductImageStorageTests(MediaRootMixin, TestCase):
+
+    def test_same_upload_is_stored_once(self):
+        first = self.create_product(ContentFile(b'doll', name='dolls.jpg'))
+        second = self.create_product(ContentFile(b'doll', name='Dolls_copy.JPG'))
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertRegex(first.image.name, r'^products/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        directories, files = product_image_storage.listdir(os.path.dirname(first.image.name))
+        self.assertEqual(files, [os.path.basename(first.image.name)])
+
+        response = self.client.get(first.image.url)
+        self.assertEqual(b''.join(response.streaming_content), b'doll')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_dedupe_command_merges_legacy_files(self):
+        for name in ['dolls.jpg', 'dolls_OjRSew1.jpg']:
+            product_image_storage._save(f'products/{name}', ContentFile(b'doll'))
+        product_image_storage._save('products/bunny.jpg', ContentFile(b'bunny'))
+        products = [self.create_product(name) for name in
+                    ['products/dolls.jpg', 'products/dolls_OjRSew1.jpg', 'products/bunny.jpg']]
+        self.assertNotIn('immutable', self.client.get('/products/dolls.jpg').get('Cache-Control', ''))
+
+        call_command('dedupe_product_images', stdout=io.StringIO())
+
+        names = [Product.objects.get(id=product.id).image.name for product in products]
+        self.assertEqual(names[0], names[1])
+        self.assertNotEqual(names[0], names[2])
+        self.assertEqual(product_image_storage.listdir('products')[1], [])
+        for name in names:
+            with product_image_storage.open(name) as f:
+                self.assertIn(f.read(), [b'doll', b'bunny'])
+
+
+class ImageVariantTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        photo = Image.new('RGB', (1200, 800), (200, 40, 40))
+        exif = Image.Exif()
+        exif[0x0110] = 'Camera'
+        exif[0x0112] = 6  # повернуто на 90°
+        content = io.BytesIO()
+        photo.save(content, 'JPEG', exif=exif)
+        self.product = self.create_product(ContentFile(content.getvalue(), name='photo.jpg'))
+        self.name = self.product.image.name
+
+    def test_generate_builds_all_widths_without_exif(self):
+        self.assertEqual(image_variants.generate([self.name], workers=1), len(image_variants.variant_names(self.name)))
+        self.assertEqual(image_variants.missing_variants(self.name), [])
+        with Image.open(product_image_storage.path(image_variants.variant_name(self.name, 320, 'webp'))) as variant:
+            # Поворот из EXIF применен, сами метаданные не сохранены
+            self.assertEqual(variant.size, (320, 480))
+            self.assertFalse(variant.getexif())
+        self.assertEqual(image_variants.generate([self.name], workers=1), 0)
+
+        cache.clear()
+        response = self.client.get(reverse('product_detail', args=[self.product.id]))
+        self.assertContains(response, f'{image_variants.variant_name(self.name, 960, "webp")} 960w')
+        self.assertContains(response, 'type="image/webp"')
+
+    def test_missing_variant_is_built_on_request(self):
+        url = product_image_storage.url(image_variants.variant_name(self.name, 640, 'jpg'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as variant:
+            self.assertEqual((variant.format, variant.width), ('JPEG', 640))
+        self.assertEqual(self.client.get(url.replace('-640w', '-641w')).status_code, 404)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SearchTests(QueryBudgetMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        dolls = Category.objects.create(name='Куклы', slug='doll')
+        plush = Category.objects.create(name='Плюшевые игрушки', slug='plush')
+        cls.doll = Product.objects.create(name='Кукла Маша', price=Decimal('900'), category=dolls, year=2024)
+        cls.clothes = Product.objects.create(name='Набор одежды', description='Платья и обувь для куклы',
+                                             price=Decimal('300'), category=dolls, year=2024)
+        cls.bear = Product.objects.create(name='Пушистый медвежонок', model='MB-15', sku='PL-0042',
+                                          price=Decimal('700'), category=plush, year=2023)
+        cls.admin = CustomUser.objects.create_superuser('admin', 'admin@example.com', PASSWORD)
+
+    def setUp(self):
+        cache.clear()
+
+    def found(self, query, **params):
+        response = self.client.get(reverse('catalog'), {'q': query, **params})
+        return [card.split('product/')[1].split('/')[0] for card in response.context['product_cards']]
+
+    def test_stemmer_matches_word_forms(self):
+        self.assertEqual({search.stem(word) for word in ['кукла', 'куклы', 'куклой', 'Кукле']}, {'кукл'})
+        self.assertEqual(search.tokens('Куклы и мишки, ёлка'), ['кукл', 'мишк', 'елк'])
+
+    def test_catalog_ranks_name_matches_first(self):
+        self.assertEqual(self.found('куклы'), [str(self.doll.id), str(self.clothes.id)])
+        self.assertEqual(self.found('мед'), [str(self.bear.id)])
+        self.assertEqual(self.found('pl-0042'), [str(self.bear.id)])
+        self.assertEqual(self.found('куклы', sort='price_asc'), [str(self.clothes.id), str(self.doll.id)])
+        self.assertEqual(self.found('кукла медвежонок'), [])
+        self.measure('catalog_search', 2, lambda: self.client.get(reverse('catalog'), {'q': 'платье'}))
+
+    def test_index_follows_product_changes(self):
+        self.bear.name = 'Плюшевый зайчик'
+        self.bear.save()
+        self.assertEqual(self.found('медвежонок'), [])
+        self.assertEqual(self.found('зайчики'), [str(self.bear.id)])
+        self.doll.delete()
+        self.assertEqual(search.count_matches('кукла'), 1)
+
+    def test_empty_index_is_built_after_migrate(self):
+        self.assertFalse(search.needs_rebuild())
+        search.remove_products([self.doll.id, self.clothes.id, self.bear.id])
+        self.assertTrue(search.needs_rebuild())
+        emit_post_migrate_signal(verbosity=0, interactive=False, db='default')
+        self.assertEqual(self.found('куклы'), [str(self.doll.id), str(self.clothes.id)])
+
+    def test_admin_search_and_actions(self):
+        self.client.force_login(self.admin)
+        url = f'{ADMIN_PREFIX}product/'
+        response = self.measure('admin_product_search', 7, lambda: self.client.get(url, {'q': 'куклы'}))
+        self.assertEqual(list(response.context['cl'].result_list), [self.doll, self.clothes])
+        # Действие над найденными товарами выполняет UPDATE без присоединенной таблицы поиска
+        self.client.post(f'{url}?q=куклы', {
+            'action': 'unpublish_products', '_selected_action': [self.doll.id, self.clothes.id], 'select_across': '1',
+        })
+        self.assertEqual(set(Product.objects.filter(is_published=False)), {self.doll, self.clothes})
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ReplayRequestsTests(TransactionTestCase):
+    """Запросы выполняются в потоках пула со своими подключениями к базе, поэтому без общей транзакции теста"""
+
+    def setUp(self):
+        cache.clear()
+        self.users = seed_shop(products=20, customers=2, orders_per_customer=2, cart_items=3)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_replay_requests(self):
+        product = Product.objects.order_by('id').first()
+        records = Path(self.tmp.name, 'records.jsonl')
+        records.write_text('\n'.join(json.dumps(record, ensure_ascii=False) for record in [
+            {'path': reverse('catalog') + '?q=кукла'},
+            {'path': '/каталог-которого-нет/'},
+            {'path': reverse('product_detail', args=[product.id])},
+            {'path': reverse('cart'), 'user': self.users[0].username},
+        ]), encoding='utf-8')
+        output = str(Path(self.tmp.name, 'result.json'))
+        call_command('replay_requests', str(records), host='testserver', password=PASSWORD, concurrency=1,
+                     output=output, stdout=io.StringIO(), stderr=io.StringIO())
+        summary = json.loads(Path(output).read_text(encoding='utf-8'))['summary']
+        self.assertEqual(summary['catalog']['error_rate'], 0)
+        self.assertEqual(summary['cart']['error_rate'], 0)
+        self.assertEqual(summary['unresolved']['error_rate'], 1)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ManagementCommandTests(TestCase):
+    """Команды управления на маленьких входных данных"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = seed_shop(products=20, customers=2, orders_per_customer=2, cart_items=3)
+
+    def setUp(self):
+        cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, name, lines):
+        path = Path(self.tmp.name, name)
+        path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        return str(path)
+
+    def run_command(self, *args, **options):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command(*args, stdout=stdout, stderr=stderr, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import_products_creates_and_updates(self):
+        path = self.write('prices.csv', [
+            'sku,name,price,category,year,stock_quantity',
+            'IMP-1,Кукла Вера,"1 200,50",doll,2024,3',
+            'IMP-2,Конструктор,500,constructor,2023,0',
+        ])
+        self.run_command('import_products', path)
+        vera = Product.objects.get(sku='IMP-1')
+        self.assertEqual((vera.name, vera.price, vera.category.slug), ('Кукла Вера', Decimal('1200.50'), 'doll'))
+        self.assertTrue(vera.in_stock)
+        self.assertFalse(Product.objects.get(sku='IMP-2').in_stock)
+        self.assertEqual(search.count_matches('вера'), 1)
+
+        # Остаток существующего товара меняется корректировкой через журнал
+        path = self.write('update.jsonl', [
+            json.dumps({'sku': 'IMP-1', 'price': '1100', 'stock_quantity': 0}),
+            json.dumps({'sku': 'IMP-2', 'stock_quantity': 4}),
+        ])
+        stdout, stderr = self.run_command('import_products', path)
+        self.assertIn('Создано: 0, обновлено: 2', stdout)
+        vera = inventory.with_available(Product.objects.filter(sku='IMP-1')).get()
+        self.assertEqual((vera.price, vera.available_quantity, vera.in_stock), (Decimal('1100'), 0, False))
+        self.assertTrue(Product.objects.get(sku='IMP-2').in_stock)
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(kind=StockMovement.ADJUST).values_list('product__sku', 'quantity')),
+            [('IMP-1', -3), ('IMP-2', 4)],
+        )
+
+    def test_import_products_reports_bad_rows(self):
+        path = self.write('bad.jsonl', [
+            json.dumps({'sku': 'IMP-3', 'name': 'Мяч', 'price': '100', 'category': 'balls', 'year': 2024}),
+            json.dumps({'sku': 'IMP-4', 'name': 'Мяч', 'price': 'дорого', 'category': 'doll', 'year': 2024}),
+            json.dumps({'sku': 'IMP-5', 'name': 'Мяч'}),
+            '[1, 2]',
+            '"строка"',
+            '{не json',
+            json.dumps({'sku': 'IMP-6', 'name': 'Мяч', 'price': '100', 'category': 'doll', 'year': 2024}),
+        ])
+        stdout, stderr = self.run_command('import_products', path)
+        self.assertIn('с ошибками: 6', stdout)
+        self.assertIn('Строка 1: неизвестная категория "balls"', stderr)
+        self.assertIn('Строка 4: строка должна быть объектом JSON', stderr)
+        self.assertEqual(list(Product.objects.filter(sku__startswith='IMP-').values_list('sku', flat=True)), ['IMP-6'])
+
+    def test_check_query_plans(self):
+        output = str(Path(self.tmp.name, 'plans.json'))
+        stdout, stderr = self.run_command('check_query_plans', output=output)
+        self.assertNotIn('❌', stdout)
+        report = json.loads(Path(output).read_text(encoding='utf-8'))
+        self.assertTrue(report)
+        self.assertEqual([entry['query'] for entry in report if entry['full_scans']], [])
+
+    def test_check_query_plans_needs_data(self):
+        Order.objects.all().delete()
+        with self.assertRaisesMessage(CommandError, 'База пуста'):
+            self.run_command('check_query_plans')
+
+    def test_generate_shop_data(self):
+        product_ids = set(Product.objects.values_list('id', flat=True))
+        orders = Order.objects.count()
+        self.run_command('generate_shop_data', products=20, users=5, orders=10, days=30, password=PASSWORD)
+
+        new_products = Product.objects.exclude(id__in=product_ids)
+        self.assertEqual(new_products.count(), 20)
+        self.assertEqual(CustomUser.objects.filter(username__startswith='gen42-').count(), 5)
+        self.assertEqual(Order.objects.count(), orders + 10)
+        self.assertFalse(Order.objects.filter(orderitem__isnull=True).exists())
+        # bulk_create не отправляет post_save: товары индексируются самой командой
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT count(*) FROM {search.TABLE} WHERE rowid IN '
+                           f'({", ".join(str(product_id) for product_id in new_products.values_list("id", flat=True))})')
+            self.assertEqual(cursor.fetchone()[0], 20)
+
+        with self.assertRaisesMessage(CommandError, 'уже созданы'):
+            self.run_command('generate_shop_data', products=1, users=1, orders=1)
+
+    def test_bench_auth_flows(self):
+        output = str(Path(self.tmp.name, 'auth.json'))
+        users = CustomUser.objects.count()
+        stdout, stderr = self.run_command('bench_auth_flows', iterations=2, host='testserver', output=output)
+        results = json.loads(Path(output).read_text(encoding='utf-8'))
+        self.assertEqual(list(results), ['password_hash', 'login_double_hash', 'login',
+                                         'checkout_password', 'checkout_reauth'])
+        self.assertIsNotNone(results['checkout_password']['queries'])
+        # Повторный ввод пароля не нужен - хеш при оформлении не считается
+        self.assertEqual(results['checkout_reauth']['hashing_ms'], 0)
+        # Пользователь, товар и заказы замера откатываются
+        self.assertEqual(CustomUser.objects.count(), users)
+        self.assertFalse(Product.objects.filter(name='Товар для замера').exists())
@@ -6,13 +6,18 @@ urlpatterns = [
     path('', views.home, name='home'),
     path('catalog/', views.catalog, name='catalog'),
     path('product/<int:product_id>/', views.product_detail, name='product_detail'),
+    path('products/<path:path>', views.product_image, name='product_image'),
     path('profile/', views.profile, name='profile'),
     path('profile/cancel-order/<int:order_id>/', views.cancel_order, name='cancel_order'),
+    path('profile/orders/<int:order_id>/items/', views.order_items, name='order_items'),
     path('contacts/', views.contacts, name='contacts'),
+    path('header/', views.header_state, name='header_state'),
+    path('metrics/', views.metrics_view, name='metrics'),
     path('register/', views.register_view, name='register'),
     path('login/', views.login_view, name='login'),
     path('logout/', LogoutView.as_view(next_page='home'), name='logout'),
     path('cart/', views.cart_view, name='cart'),
+    path('cart/sync/', views.sync_cart, name='sync_cart'),
     path('cart/add/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
     path('cart/remove/<int:product_id>/', views.remove_from_cart, name='remove_from_cart'),
     path('cart/delete/<int:product_id>/', views.delete_from_cart, name='delete_from_cart'),
@@ -1,46 +1,67 @@
+import json
+import time
+
 from django.shortcuts import render, redirect, get_object_or_404
-from django.contrib.auth import login, authenticate
+from django.urls import reverse
+from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse
 from django.views.decorators.http import require_POST
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.static import serve
 from .forms import RegistrationForm, LoginForm, OrderConfirmationForm
-from .models import Product, Cart, CartItem, Order, OrderItem
+from .models import Product, Cart, Order
+from .catalog import SORT_CHOICES
+from . import catalog_cache
+from . import cart as cart_ops
+from .cart import get_cart_summary
+from .guest_cart import get_guest_cart
+from .decorators import public_page
+from .checkout import place_order, EmptyCartError, StockConflictError
+from .inventory import with_available
+from .order_workflow import apply_transition
+from . import image_variants, metrics, order_history, reauth
+from .storage import is_hashed_name, product_image_storage
 
 @login_required
 def profile(request):
-    orders = Order.objects.filter(user=request.user).prefetch_related(
-        'orderitem_set__product'
-    ).order_by('-created_at')
+    orders, next_cursor = order_history.orders_page(request.user, request.GET.get('after'))
     
     return render(request, 'profile.html', {
-        'orders': orders
+        'orders': orders,
+        'next_cursor': next_cursor,
+        'is_first_page': 'after' not in request.GET,
     })
 
+@login_required
+def order_items(request, order_id):
+    """Состав заказа для раскрывающейся строки в профиле"""
+    items = order_history.order_items(request.user, order_id)
+    if not items:
+        raise Http404('Заказ не найден')
+    return JsonResponse({'items': items})
+
 @login_required
 @require_POST
 def cancel_order(request, order_id):
-    order = get_object_or_404(Order, id=order_id, user=request.user)
+    orders = Order.objects.filter(id=order_id, user=request.user)
     
-    if order.status == 'pending':
-        # Возвращаем товары на склад
-        for order_item in order.orderitem_set.all():
-            product = order_item.product
-            product.stock_quantity += order_item.quantity
-            product.in_stock = True
-            product.save()
-        
-        order.status = 'cancelled'
-        order.save()
+    # Товары возвращаются на склад внутри перехода статуса
+    if apply_transition(orders, 'cancel'):
         return JsonResponse({
             'success': True, 
-            'message': f'Заказ #{order.id} успешно отменен! Товары возвращены на склад.'
-        })
-    else:
-        return JsonResponse({
-            'success': False,
-            'message': 'Невозможно отменить заказ в текущем статусе'
+            'message': f'Заказ #{order_id} успешно отменен! Товары возвращены на склад.'
         })
+    
+    get_object_or_404(orders)
+    return JsonResponse({
+        'success': False,
+        'message': 'Невозможно отменить заказ в текущем статусе'
+    })
 
+@public_page
 def home(request):
     slides = [
         {
@@ -61,27 +82,90 @@ def home(request):
     ]
     return render(request, 'home.html', {'slides': slides})
 
+@public_page
 def catalog(request):
-    products = Product.objects.filter(in_stock=True)
+    result = catalog_cache.catalog_page(request.GET, request.GET.get('page'))
+
+    # Параметры фильтров без номера страницы - для ссылок пагинации
+    query = request.GET.copy()
+    query.pop('page', None)
+
     context = {
-        'products': products,
+        'product_cards': result['page'].object_list,
+        'page_obj': result['page'],
+        'filters': result['filters'],
+        'categories': result['facets'],
+        'products_count': result['total'],
+        'sort_choices': SORT_CHOICES,
+        'query_string': query.urlencode(),
+        **catalog_cache.filter_options(),
     }
     return render(request, 'catalog.html', context)
 
+@public_page
 def product_detail(request, product_id):
-    product = get_object_or_404(Product, id=product_id, in_stock=True)
+    product = get_object_or_404(with_available(Product.objects.all()), id=product_id, in_stock=True)
     return render(request, 'product_detail.html', {'product': product})
 
+def product_image(request, path):
+    """
+    Изображение товара из хранилища с именами по содержимому. Такой файл
+    не меняется, поэтому кешируется на PRODUCT_IMAGE_MAX_AGE; файлы со старыми
+    именами (до dedupe_product_images) отдаются без срока кеширования.
+    Недостающая уменьшенная копия строится при первом запросе.
+    В продакшене файлы лучше отдавать веб-сервером с теми же заголовками,
+    передавая в Django только промахи по копиям.
+    """
+    name = f'products/{path}'
+    variant = name.startswith(f'{image_variants.VARIANTS_DIR}/')
+    if variant and not image_variants.ensure_variant(name):
+        raise Http404('Изображение не найдено')
+    response = serve(request, name, document_root=product_image_storage.location)
+    if variant or is_hashed_name(name):
+        response['Cache-Control'] = f'public, max-age={settings.PRODUCT_IMAGE_MAX_AGE}, immutable'
+    return response
+
+@public_page
 def contacts(request):
     return render(request, 'contacts.html')
 
+@never_cache
+@ensure_csrf_cookie
+def header_state(request):
+    """Пользовательская часть шапки для кешируемых страниц"""
+    if not request.user.is_authenticated:
+        return JsonResponse({
+            'authenticated': False,
+            'cart_total': get_guest_cart(request).total_quantity,
+        })
+    
+    return JsonResponse({
+        'authenticated': True,
+        'username': request.user.username,
+        'cart_total': get_cart_summary(request).total_quantity,
+    })
+
+@never_cache
+def metrics_view(request):
+    """Метрики магазина в текстовом формате Prometheus"""
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS and not request.user.is_staff:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def register_view(request):
     if request.method == 'POST':
         form = RegistrationForm(request.POST)
         if form.is_valid():
             user = form.save()
             login(request, user)
-            return JsonResponse({'success': True, 'message': 'Регистрация успешна!'})
+            merged = cart_ops.merge_guest_cart(request, user)
+            response = JsonResponse({
+                'success': True,
+                'message': 'Регистрация успешна!',
+                'redirect': reverse('cart') if merged else reverse('home'),
+            })
+            reauth.remember(request, response)
+            return get_guest_cart(request).save(response)
         else:
             errors = {field: error[0] for field, error in form.errors.items()}
             return JsonResponse({'success': False, 'errors': errors})
@@ -93,15 +177,19 @@ def login_view(request):
     if request.method == 'POST':
         form = LoginForm(request, data=request.POST)
         if form.is_valid():
-            username = form.cleaned_data.get('username')
-            password = form.cleaned_data.get('password')
-            user = authenticate(request, username=username, password=password)
-            if user is not None:
-                login(request, user)
-                return JsonResponse({
-                    'success': True, 
-                    'message': 'Вход выполнен успешно!'
-                })
+            # AuthenticationForm уже проверил пароль в is_valid() -
+            # второй authenticate посчитал бы PBKDF2 еще раз
+            user = form.get_user()
+            login(request, user)
+            # Корзина, собранная до входа, переносится в корзину пользователя
+            merged = cart_ops.merge_guest_cart(request, user)
+            response = JsonResponse({
+                'success': True, 
+                'message': 'Вход выполнен успешно!',
+                'redirect': reverse('cart') if merged else reverse('home'),
+            })
+            reauth.remember(request, response)
+            return get_guest_cart(request).save(response)
         
         errors = {}
         for field, error_list in form.errors.items():
@@ -116,151 +204,232 @@ def login_view(request):
         form = LoginForm()
     return render(request, 'registration/login.html', {'form': form})
 
-@login_required
-def cart_view(request):
+def checkout_response(request):
+    """Оформляет заказ из корзины пользователя после проверки пароля"""
     cart, created = Cart.objects.get_or_create(user=request.user)
-    cart_items = cart.items.all()
+    started = time.perf_counter()
+    try:
+        order = place_order(cart)
+    except EmptyCartError:
+        metrics.record_checkout('empty', started)
+        return JsonResponse({
+            'success': False,
+            'message': 'Корзина пуста'
+        })
+    except StockConflictError as e:
+        metrics.record_checkout('conflict', started, conflicts=len(e.conflicts))
+        return JsonResponse({
+            'success': False,
+            'message': e.message,
+            'conflicts': e.conflicts
+        })
     
+    metrics.record_checkout('success', started)
+    return JsonResponse({
+        'success': True, 
+        'message': f'Заказ #{order.id} успешно создан!',
+        'order_id': order.id
+    })
+
+def cart_view(request):
+    if request.method == 'POST' and not request.user.is_authenticated:
+        return JsonResponse({
+            'success': False,
+            'message': 'Войдите или зарегистрируйтесь, чтобы оформить заказ'
+        })
     if request.method == 'POST':
-        form = OrderConfirmationForm(request.POST, user=request.user)
+        recently_authenticated = reauth.is_recent(request)
+        form = OrderConfirmationForm(request.POST, user=request.user, recently_authenticated=recently_authenticated)
         if form.is_valid():
-            # Проверяем, что все товары есть в достаточном количестве
-            for cart_item in cart_items:
-                if cart_item.quantity > cart_item.product.stock_quantity:
-                    return JsonResponse({
-                        'success': False,
-                        'message': f'Недостаточно товара "{cart_item.product.name}" на складе. Доступно: {cart_item.product.stock_quantity} шт.'
-                    })
-            
-            # Создаем заказ
-            order = Order.objects.create(
-                user=request.user,
-                total_price=cart.get_total_price(),
-                status='pending'
-            )
-            
-            # Переносим товары из корзины в заказ и уменьшаем количество на складе
-            for cart_item in cart_items:
-                OrderItem.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    quantity=cart_item.quantity,
-                    price=cart_item.product.price
-                )
-                
-                # Уменьшаем количество товара на складе
-                product = cart_item.product
-                product.stock_quantity -= cart_item.quantity
-                
-                if product.stock_quantity <= 0:
-                    product.in_stock = False
-                    product.stock_quantity = 0
-                
-                product.save()
-            
-            # Очищаем корзину
-            cart.items.all().delete()
-            
-            return JsonResponse({
-                'success': True, 
-                'message': f'Заказ #{order.id} успешно создан!',
-                'order_id': order.id
-            })
+            response = checkout_response(request)
+            if not recently_authenticated:
+                # Пароль только что проверен: следующие заказы в течение
+                # REAUTH_GRACE_PERIOD оформляются без повторного хеширования
+                reauth.remember(request, response)
+            return response
         else:
+            metrics.checkouts.inc(result='invalid')
             errors = {field: error[0] for field, error in form.errors.items()}
             return JsonResponse({'success': False, 'errors': errors})
     
-    form = OrderConfirmationForm(user=request.user)
+    form = None
+    if request.user.is_authenticated:
+        form = OrderConfirmationForm(user=request.user, recently_authenticated=reauth.is_recent(request))
     
     context = {
-        'cart': cart,
-        'cart_items': cart_items,
+        'cart_summary': get_cart_summary(request),
         'form': form,
     }
     return render(request, 'cart.html', context)
 
-@login_required
 @require_POST
 def add_to_cart(request, product_id):
-    product = get_object_or_404(Product, id=product_id, in_stock=True)
-    cart, created = Cart.objects.get_or_create(user=request.user)
+    if not request.user.is_authenticated:
+        return guest_add_to_cart(request, product_id)
     
-    cart_item, created = CartItem.objects.get_or_create(
-        cart=cart,
-        product=product,
-        defaults={'quantity': 1}
-    )
+    # Проверка остатка, резерв и запись - один оператор INSERT ... ON CONFLICT
+    quantity = cart_ops.add_item(request.user, product_id)
     
-    if not created:
-        if cart_item.quantity + 1 > product.stock_quantity:
-            return JsonResponse({
-                'success': False,
-                'message': f'Нельзя добавить больше {product.stock_quantity} единиц товара. В корзине уже {cart_item.quantity} шт.'
-            })
-        cart_item.quantity += 1
-        cart_item.save()
+    if quantity is None:
+        state = cart_ops.add_rejection(request.user, product_id)
+        if state is None:
+            raise Http404('Товар не найден')
+        if not state['has_cart']:
+            # Первое добавление товара: корзины еще нет
+            Cart.objects.get_or_create(user=request.user)
+            quantity = cart_ops.add_item(request.user, product_id)
     
+    if quantity is None:
+        metrics.cart_events.inc(action='add', result='rejected')
+        if not state['in_cart']:
+            message = 'Все оставшиеся единицы товара уже зарезервированы другими покупателями'
+        else:
+            message = f'Нельзя добавить больше {state["limit"]} единиц товара. В корзине уже {state["in_cart"]} шт.'
+        return JsonResponse({
+            'success': False,
+            'message': message
+        })
+    
+    metrics.cart_events.inc(action='add', result='ok')
     return JsonResponse({
         'success': True,
         'message': 'Товар добавлен в корзину',
-        'cart_total': cart.get_total_quantity(),
-        'item_quantity': cart_item.quantity
+        'cart_total': get_cart_summary(request).total_quantity,
+        'item_quantity': quantity
     })
 
-@login_required
+@require_POST
+def sync_cart(request):
+    """Пакетное изменение количеств товаров в корзине одним запросом"""
+    try:
+        changes = cart_ops.parse_sync_changes(json.loads(request.body))
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': f'Некорректный запрос: {e}'}, status=400)
+    
+    guest = None if request.user.is_authenticated else get_guest_cart(request)
+    if guest is None:
+        items, conflicts = cart_ops.sync_items(request.user, changes)
+    else:
+        items, conflicts = cart_ops.sync_guest_items(guest, changes)
+    metrics.cart_events.inc(action='sync', result='adjusted' if conflicts else 'ok')
+    
+    summary = get_cart_summary(request)
+    response = {
+        'success': True,
+        'items': items,
+        'conflicts': conflicts,
+        'cart_total': summary.total_quantity,
+        'total_price': str(summary.total_price),
+    }
+    if conflicts:
+        first = conflicts[0]
+        response['message'] = f'Недостаточно товара "{first["name"]}" на складе. Доступно: {first["available"]} шт.'
+    response = JsonResponse(response)
+    return guest.save(response) if guest is not None else response
+
 @require_POST
 def remove_from_cart(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
-    cart = get_object_or_404(Cart, user=request.user)
+    if not request.user.is_authenticated:
+        return guest_remove_from_cart(request, product_id)
     
-    try:
-        cart_item = CartItem.objects.get(cart=cart, product=product)
-        if cart_item.quantity > 1:
-            cart_item.quantity -= 1
-            cart_item.save()
-            message = 'Количество товара уменьшено'
-        else:
-            cart_item.delete()
-            message = 'Товар удален из корзины'
-        
-        return JsonResponse({
-            'success': True,
-            'message': message,
-            'cart_total': cart.get_total_quantity(),
-            'item_quantity': cart_item.quantity if cart_item.quantity > 0 else 0
-        })
-    except CartItem.DoesNotExist:
+    # Резерв уменьшается и продлевается без проверки остатка; истекший
+    # резерв заново не берется - остаток проверит оформление заказа
+    quantity = cart_ops.remove_item(request.user, product_id)
+    
+    if quantity is None:
+        metrics.cart_events.inc(action='remove', result='not_found')
         return JsonResponse({
             'success': False,
             'message': 'Товар не найден в корзине'
         })
+    
+    metrics.cart_events.inc(action='remove', result='ok')
+    return JsonResponse({
+        'success': True,
+        'message': 'Количество товара уменьшено' if quantity else 'Товар удален из корзины',
+        'cart_total': get_cart_summary(request).total_quantity,
+        'item_quantity': quantity
+    })
 
-@login_required
 @require_POST
 def delete_from_cart(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
-    cart = get_object_or_404(Cart, user=request.user)
+    if not request.user.is_authenticated:
+        return guest_delete_from_cart(request, product_id)
     
-    try:
-        cart_item = CartItem.objects.get(cart=cart, product=product)
-        cart_item.delete()
-        
+    if not cart_ops.delete_item(request.user, product_id):
+        metrics.cart_events.inc(action='delete', result='not_found')
         return JsonResponse({
-            'success': True,
-            'message': 'Товар удален из корзины',
-            'cart_total': cart.get_total_quantity()
+            'success': False,
+            'message': 'Товар не найден в корзине'
         })
-    except CartItem.DoesNotExist:
+    
+    metrics.cart_events.inc(action='delete', result='ok')
+    return JsonResponse({
+        'success': True,
+        'message': 'Товар удален из корзины',
+        'cart_total': get_cart_summary(request).total_quantity
+    })
+
+# Корзина гостя: изменения пишутся только в cookie ответа
+
+def guest_add_to_cart(request, product_id):
+    guest = get_guest_cart(request)
+    product = get_object_or_404(with_available(Product.objects.all()), id=product_id, in_stock=True)
+    quantity = guest.quantity(product.id) + 1
+    
+    if quantity > max(product.available, 0):
+        metrics.cart_events.inc(action='add', result='rejected')
+        return JsonResponse({
+            'success': False,
+            'message': f'Нельзя добавить больше {max(product.available, 0)} единиц товара. В корзине уже {quantity - 1} шт.'
+        })
+    if not guest.set(product.id, quantity):
+        metrics.cart_events.inc(action='add', result='rejected')
+        return JsonResponse({
+            'success': False,
+            'message': 'Корзина заполнена. Войдите, чтобы добавить больше товаров'
+        })
+    
+    metrics.cart_events.inc(action='add', result='ok')
+    return guest.save(JsonResponse({
+        'success': True,
+        'message': 'Товар добавлен в корзину',
+        'cart_total': guest.total_quantity,
+        'item_quantity': quantity
+    }))
+
+def guest_remove_from_cart(request, product_id):
+    guest = get_guest_cart(request)
+    quantity = guest.quantity(product_id)
+    if not quantity:
+        metrics.cart_events.inc(action='remove', result='not_found')
         return JsonResponse({
             'success': False,
             'message': 'Товар не найден в корзине'
         })
-@login_required
-def profile(request):
-    orders = Order.objects.filter(user=request.user).prefetch_related(
-        'orderitem_set__product'
-    ).order_by('-created_at')
     
-    return render(request, 'profile.html', {
-        'orders': orders
-    })
\ No newline at end of file
+    guest.set(product_id, quantity - 1)
+    metrics.cart_events.inc(action='remove', result='ok')
+    return guest.save(JsonResponse({
+        'success': True,
+        'message': 'Количество товара уменьшено' if quantity > 1 else 'Товар удален из корзины',
+        'cart_total': guest.total_quantity,
+        'item_quantity': quantity - 1
+    }))
+
+def guest_delete_from_cart(request, product_id):
+    guest = get_guest_cart(request)
+    if not guest.quantity(product_id):
+        metrics.cart_events.inc(action='delete', result='not_found')
+        return JsonResponse({
+            'success': False,
+            'message': 'Товар не найден в корзине'
+        })
+    
+    guest.set(product_id, 0)
+    metrics.cart_events.inc(action='delete', result='ok')
+    return guest.save(JsonResponse({
+        'success': True,
+        'message': 'Товар удален из корзины',
+        'cart_total': guest.total_quantity
+    }))
@@ -17,6 +17,88 @@ DATABASES = {
     }
 }
 
+# Кеш страниц и карточек каталога. Он общий для всех воркеров и команд
+# управления: версия каталога, увеличенная импортом, должна дойти до сайта,
+# поэтому не LocMemCache. Если серверов несколько, нужен Redis
+# (django.core.cache.backends.redis.RedisCache)
+CACHES = {
+    'default': {
+        'BACKEND': 'main.cache_backends.SharedFileCache',
+        'LOCATION': BASE_DIR / 'var' / 'cache',
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    }
+}
+
+# Сколько секунд публичные страницы хранятся в серверном кеше.
+# Кеш сбрасывается при изменении товаров, но остаток на складе
+# в карточке товара может отставать не более чем на это время
+PUBLIC_PAGE_CACHE_TIMEOUT = 300
+
+# max-age для браузеров и прокси: их кеш сбросить нельзя, поэтому он короче
+PUBLIC_PAGE_MAX_AGE = 60
+
+# Время жизни карточек товаров и результатов запросов каталога. Изменения
+# сбрасывают кеш сразу; срок ограничивает устаревание, если сброс не дошел
+CATALOG_CACHE_TIMEOUT = 60 * 30
+
+# Сколько секунд товар, добавленный в корзину, зарезервирован за покупателем.
+# Истекшие резервы снимает команда release_expired_reservations
+CART_RESERVATION_TTL = 15 * 60
+
+# Корзина гостя хранится в подписанной cookie (main.guest_cart)
+GUEST_CART_COOKIE = 'guest_cart'
+GUEST_CART_MAX_AGE = 60 * 60 * 24 * 30
+
+# Сколько секунд после ввода пароля заказ оформляется без повторного
+# ввода (main.reauth), чтобы не считать хеш пароля на каждом заказе
+REAUTH_COOKIE = 'reauth'
+REAUTH_GRACE_PERIOD = 5 * 60
+
+# Изображения товаров называются по содержимому (main.storage) и не меняются,
+# поэтому браузеры хранят их год
+PRODUCT_IMAGE_MAX_AGE = 60 * 60 * 24 * 365
+
+# Замер времени запросов (main.middleware.PerformanceMiddleware):
+# доля замеряемых запросов, порог медленного запроса в мс и сколько
+# самых медленных SQL-запросов записывать в лог для медленных запросов
+PERF_SAMPLE_RATE = 1.0
+PERF_SLOW_REQUEST_MS = 500
+PERF_SLOW_QUERIES = 5
+
+# Метрики для Prometheus (main.metrics): снимки процессов, период их
+# сохранения в секундах и адреса, с которых можно читать /metrics/
+METRICS_DIR = BASE_DIR / 'var' / 'metrics'
+METRICS_FLUSH_INTERVAL = 1.0
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+LOG_DIR = BASE_DIR / 'var' / 'log'
+LOG_DIR.mkdir(parents=True, exist_ok=True)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'performance': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': LOG_DIR / 'performance.jsonl',
+            'maxBytes': 10 * 1024 * 1024,
+            'backupCount': 5,
+            'formatter': 'message',
+            'encoding': 'utf-8',
+        },
+    },
+    'loggers': {
+        'main.performance': {
+            'handlers': ['performance'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
@@ -30,6 +112,7 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'main.CustomUser'
 
 MIDDLEWARE = [
+    'main.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',